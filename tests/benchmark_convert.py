@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+"""Measure rows/sec of converting CSV rows into vw format in a single process.
+
+Usage: benchmark_convert.py [--repeat N] [--columnspec SPEC] [--preprocessor OPTS] [filename.csv]
+"""
+import sys
+import os
+import time
+import optparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import vwoptimize
+
+
+def main():
+    parser = optparse.OptionParser(usage=__doc__.strip().split('\n')[-1])
+    parser.add_option('--repeat', type=int, default=20, help='Number of copies of the input to convert [%default]')
+    parser.add_option('--columnspec', default='y,text,text')
+    parser.add_option('--preprocessor', default='')
+    options, args = parser.parse_args()
+
+    source = args[0] if args else os.path.join(os.path.dirname(os.path.abspath(__file__)), 'small_ag_news.csv')
+    data = open(source).read()
+    nrows = len(list(vwoptimize.open_anything(source, 'csv', ignoreheader=False)))
+
+    vwoptimize.TMP_PREFIX = '/tmp'
+    input_filename = vwoptimize.get_temp_filename('csv')
+    output_filename = vwoptimize.get_temp_filename('vw')
+
+    try:
+        with open(input_filename, 'w') as f:
+            for _ in xrange(options.repeat):
+                f.write(data)
+
+        start = time.time()
+        vwoptimize._convert_any_to_vw(
+            input_filename,
+            'csv',
+            output_filename,
+            weights=None,
+            preprocessor=vwoptimize.get_preprocessor(options.preprocessor),
+            columnspec=options.columnspec.split(','),
+            named_labels=None,
+            remap_label=None,
+            ignoreheader=False)
+        took = time.time() - start
+    finally:
+        vwoptimize.unlink(input_filename, output_filename)
+
+    total = nrows * options.repeat
+    print '%s rows in %.2f seconds: %.0f rows/sec' % (total, took, total / took)
+
+
+if __name__ == '__main__':
+    main()
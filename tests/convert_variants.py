@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+"""Convert a file into vw format with several preprocessor settings in a single pass over it.
+
+Usage: convert_variants.py [--columnspec SPEC] [--workers N] [--dedup] [--dedup_bucket_size BYTES] [--morelogs] filename output1.vw 'PREPROCESSOR OPTIONS' [output2.vw 'PREPROCESSOR OPTIONS' ...]
+"""
+import sys
+import os
+import optparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import vwoptimize
+
+
+def main():
+    parser = optparse.OptionParser(usage=__doc__.strip().split('\n')[-1])
+    parser.add_option('--columnspec', default='y,text,text')
+    parser.add_option('--workers', type=int, default=2)
+    parser.add_option('--dedup', action='store_true')
+    parser.add_option('--dedup_bucket_size', type=int)
+    parser.add_option('--morelogs', action='store_true')
+    # preprocessor options that follow the filename are not options of this script
+    parser.disable_interspersed_args()
+    options, args = parser.parse_args()
+
+    if len(args) < 3 or len(args) % 2 != 1:
+        parser.error('expected filename and pairs of output filename and preprocessor options')
+
+    source = args[0]
+    variants = [(preprocessor, output_filename) for (output_filename, preprocessor) in zip(args[1::2], args[2::2])]
+
+    vwoptimize.TMP_PREFIX = '.vwoptimize'
+    if options.morelogs:
+        vwoptimize.MINIMUM_LOG_IMPORTANCE = 0
+    if options.dedup_bucket_size:
+        vwoptimize.DEDUP_BUCKET_SIZE = options.dedup_bucket_size
+    try:
+        vwoptimize.convert_variants_to_vw(
+            source,
+            vwoptimize.get_format_from_filename(source),
+            variants,
+            columnspec=options.columnspec.split(','),
+            named_labels=None,
+            remap_label=None,
+            weights=None,
+            ignoreheader=False,
+            workers=options.workers,
+            dedup=options.dedup)
+    finally:
+        vwoptimize.shutdown_conversion_pool()
+
+
+if __name__ == '__main__':
+    main()
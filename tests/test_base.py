@@ -103,6 +103,14 @@ $ vwoptimize.py -d iris.vw --kfold 10 --oaa 3 --metric acc,num_features,vw_avera
 10-fold vw_average_loss = 0.32
 10-fold vw_train_passes_used = 7.4
 
+[prebuilt_cache]
+$ vwoptimize.py -d iris.vw --oaa 3 -c -k --passes 2 --metric acc --prebuilt_cache --morelogs 2>&1 | grep -c 'Built vw cache'
+1
+
+[prebuilt_cache_same_metric]
+$ vwoptimize.py -d iris.vw --oaa 3 -c -k --passes 2 --metric acc --prebuilt_cache 2>&1 | grep 'acc =' > tmp_prebuilt1; vwoptimize.py -d iris.vw --oaa 3 -c -k --passes 2 --metric acc 2>&1 | grep 'acc =' > tmp_prebuilt2; wc -l < tmp_prebuilt1; diff tmp_prebuilt1 tmp_prebuilt2; rm -f tmp_prebuilt1 tmp_prebuilt2 iris.vw.cache
+1
+
 [cv_bad_metrics_multiclass_mse]
 $ vwoptimize.py -d small_ag_news.csv --kfold 10 --oaa 4 --metric mse
 10-fold mse = 1.22
@@ -164,6 +172,64 @@ $ vwoptimize.py -d iris.vw --metric vw_train_weighted_example_sum,vw_average_los
 2-fold vw_train_weighted_example_sum = 75
 2-fold vw_average_loss = 0.32
 
+[kfold2_foldscript_files]
+$ vwoptimize.py -d iris.vw --metric vw_train_weighted_example_sum,vw_average_loss --oaa 3 --kfold 2 --foldscript files
+2-fold vw_train_weighted_example_sum = 75
+2-fold vw_average_loss = 0.32
+
+[kfold2_foldscript_awk]
+$ vwoptimize.py -d iris.vw --metric vw_train_weighted_example_sum,vw_average_loss --oaa 3 --kfold 2 --foldscript awk
+2-fold vw_train_weighted_example_sum = 75
+2-fold vw_average_loss = 0.32
+
+[kfold2_foldscript_fanout]
+$ vwoptimize.py -d iris.vw --metric vw_train_weighted_example_sum,vw_average_loss --oaa 3 --kfold 2 --foldscript fanout
+2-fold vw_train_weighted_example_sum = 75
+2-fold vw_average_loss = 0.32
+
+[kfold_foldassign_random_sizes]
+$ vwoptimize.py -d iris.vw --oaa 3 --kfold 4 --foldassign random --morelogs 2>&1 | grep Split | sed -E 's/ in [0-9.]+ seconds//'
+Split iris.vw into 4 folds of 38, 38, 37, 37 examples
+
+[kfold_foldassign_stratified_sizes]
+$ vwoptimize.py -d iris.vw --oaa 3 --kfold 4 --foldassign stratified --morelogs 2>&1 | grep Split | sed -E 's/ in [0-9.]+ seconds//'
+Split iris.vw into 4 folds of 38, 38, 37, 37 examples
+
+[kfold_foldassign_tagged]
+$ seq 150 | sed s/^/e/ > tmp_tags; cut -d'|' -f2- iris.vw > tmp_features; cut -d' ' -f1 iris.vw | paste -d' ' - tmp_tags | paste -d'|' - tmp_features > tmp_tagged.vw; head -n 2 tmp_tagged.vw
+3 e1| 0:7.7 1:3.0 2:6.1 3:2.3
+1 e2| 0:5.1 1:3.8 2:1.5 3:0.3
+
+[kfold_foldassign_random_order]
+$ vwoptimize.py -d tmp_tagged.vw --kfold 4 --foldassign random -r tmp_tagged_raw --quiet > /dev/null 2>&1; cut -d' ' -f2 tmp_tagged_raw | diff - tmp_tags
+<BLANKLINE>
+
+[kfold_foldassign_stratified_order]
+$ vwoptimize.py -d tmp_tagged.vw --kfold 4 --foldassign stratified -r tmp_tagged_raw --quiet > /dev/null 2>&1; cut -d' ' -f2 tmp_tagged_raw | diff - tmp_tags
+<BLANKLINE>
+
+[kfold_foldassign_cleanup]
+$ rm tmp_tagged.vw tmp_tags tmp_features tmp_tagged_raw
+<BLANKLINE>
+
+[kfold_tmpcompress_fold_files]
+$ vwoptimize.py -d iris.vw --metric acc --oaa 3 --kfold 3 --tmpcompress --morelogs 2>&1 | grep -o 'fold[0-9][.]vw[.a-z]*' | sort -u
+fold1.vw.gz
+fold2.vw.gz
+fold3.vw.gz
+
+[kfold_tmpcompress_same_metric]
+$ for assign in mod random; do vwoptimize.py -d iris.vw --metric acc --oaa 3 --kfold 3 --foldassign \\$assign --tmpcompress 2>&1 | grep 'acc =' > tmp_compressed_folds; vwoptimize.py -d iris.vw --metric acc --oaa 3 --kfold 3 --foldassign \\$assign 2>&1 | grep 'acc =' | diff - tmp_compressed_folds; done; wc -l < tmp_compressed_folds; rm tmp_compressed_folds
+1
+
+[kfold_shards_same_metric]
+$ for assign in mod random stratified; do vwoptimize.py -d iris_shards --metric acc --oaa 3 --kfold 3 --foldassign \\$assign 2>&1 | grep 'acc =' > tmp_shards_metric; vwoptimize.py -d iris.vw --metric acc --oaa 3 --kfold 3 --foldassign \\$assign 2>&1 | grep 'acc =' | diff - tmp_shards_metric; done; wc -l < tmp_shards_metric; rm tmp_shards_metric
+1
+
+[kfold_shards_fold_store_shared]
+$ vwoptimize.py -d 'iris_shards/*.vw' --oaa 3 --kfold 4 --foldassign random -l 0.1/0.5? --morelogs 2>&1 | grep Split | sed -E 's/ in [0-9.]+ seconds//'
+Split ['iris_shards/part1.vw', 'iris_shards/part2.vw', 'iris_shards/part3.vw'] into 4 folds of 38, 38, 37, 37 examples
+
 [kfold_extreme]
 $ head -n 50 iris.vw | vwoptimize.py -d - --metric vw_train_weighted_example_sum,vw_average_loss --oaa 3 --kfold 50
 50-fold vw_train_weighted_example_sum = 49
@@ -24,6 +24,12 @@ $ vwoptimize.py -d simple.csv --tovw /dev/stdout --weight_metric 1:0.5
 2 | Goodbye World. second class
 1 | hello first class again
 
+[tovw_num_cat]
+$ vwoptimize.py -d simple_w.csv --tovw /dev/stdout --columnspec y,num_w,text,cat_c
+1 |w 2:0.1 | Hello World! |c 4=first_class
+2 | Goodbye World. |c 4=second_class
+1 |w 2:1 | hello |c 4=first_class_again
+
 [fromvw_tovw]
 $ vwoptimize.py -d simple.vw --tovw /dev/stdout
 0 | price:.23 sqft:.25 age:.05 2006
@@ -194,6 +200,194 @@ $ printf '1 | one two one three\\n' | vwoptimize.py -d - --tovw /dev/stdout --re
 preprocessor = --remove_duplicate_words
 1 | one two three
 
+[tovw_multiline_ignoreheader]
+$ vwoptimize.py -d multiline.csv --tovw /dev/stdout --ignoreheader
+2 | Goodbye World.
+1 | hello
+
+[tovw_typed_columns]
+$ vwoptimize.py -d typed_columns.csv --columnspec y,num_n,cat_c --ignoreheader --tovw /dev/stdout | sed -E 's/ +$//'
+1 |n unit_price:2.5 |c country=FR
+0
+1 |c country=DE
+0 |c country=US
+
+[tovw_typed_columns_workers]
+$ vwoptimize.py -d typed_columns.csv --columnspec y,num_n,cat_c --ignoreheader --tovw /dev/stdout --workers 2 | sed -E 's/ +$//'
+1 |n unit_price:2.5 |c country=FR
+0
+1 |c country=DE
+0 |c country=US
+
+[tovw_typed_columns_without_header]
+$ tail -n +2 typed_columns.csv | vwoptimize.py -d - --format csv --columnspec y,num_n,cat_c --tovw /dev/stdout | sed -E 's/ +$//'
+1 |n 2:2.5 |c 3=FR
+0
+1 |c 3=DE
+0 |c 3=US
+
+[tovw_compressed_reference]
+$ vwoptimize.py -d small_ag_news.csv --columnspec y,text,text --tovw tmp_plain.vw
+<BLANKLINE>
+
+[tovw_compressed_output]
+$ for ext in gz zst xz bz2; do vwoptimize.py -d small_ag_news.csv --columnspec y,text,text --tovw tmp_out.vw.\\$ext; done; gzip -dc tmp_out.vw.gz | cmp - tmp_plain.vw; zstd -dc tmp_out.vw.zst | cmp - tmp_plain.vw; xz -dc tmp_out.vw.xz | cmp - tmp_plain.vw; bzip2 -dc tmp_out.vw.bz2 | cmp - tmp_plain.vw
+<BLANKLINE>
+
+[tovw_compressed_output_read_back]
+$ for ext in gz zst xz bz2; do vwoptimize.py -d tmp_out.vw.\\$ext --tovw /dev/stdout | cmp - tmp_plain.vw; done
+<BLANKLINE>
+
+[tovw_compressed_input]
+$ gzip -c small_ag_news.csv > tmp_ag.csv.gz; zstd -qc small_ag_news.csv > tmp_ag.csv.zst; xz -c small_ag_news.csv > tmp_ag.csv.xz; bzip2 -c small_ag_news.csv > tmp_ag.csv.bz2; for ext in gz zst xz bz2; do vwoptimize.py -d tmp_ag.csv.\\$ext --columnspec y,text,text --tovw /dev/stdout | cmp - tmp_plain.vw; done
+<BLANKLINE>
+
+[tovw_compressed_workers]
+$ for ext in gz zst xz bz2; do vwoptimize.py -d tmp_ag.csv.\\$ext --columnspec y,text,text --workers 3 --tovw tmp_out3.vw.\\$ext; vwoptimize.py -d tmp_out3.vw.\\$ext --tovw /dev/stdout | cmp - tmp_plain.vw; done; gzip -dc tmp_out3.vw.gz | cmp - tmp_plain.vw; zstd -dc tmp_out3.vw.zst | cmp - tmp_plain.vw
+<BLANKLINE>
+
+[tovw_compressed_tmpcompress]
+$ vwoptimize.py -d tmp_ag.csv.gz --columnspec y,text,text --workers 2 --dedup --tmpcompress --tovw /dev/stdout 2>/dev/null | cmp - tmp_plain.vw; cat small_ag_news.csv | vwoptimize.py -d - --format csv --columnspec y,text,text --workers 2 --tmpcompress --tovw tmp_out_stdin.vw.gz; gzip -dc tmp_out_stdin.vw.gz | cmp - tmp_plain.vw
+<BLANKLINE>
+
+[tovw_compressed_cleanup]
+$ rm tmp_plain.vw tmp_out.vw.* tmp_out3.vw.* tmp_ag.csv.* tmp_out_stdin.vw.gz
+<BLANKLINE>
+
+[tovw_shards_directory]
+$ vwoptimize.py -d iris_shards --tovw /dev/stdout | cmp - iris.vw
+<BLANKLINE>
+
+[tovw_shards_glob]
+$ vwoptimize.py -d 'iris_shards/part*.vw' --weight 3:2 --workers 2 --tovw /dev/stdout > tmp_shards.vw; vwoptimize.py -d iris.vw --weight 3:2 --tovw /dev/stdout | cmp - tmp_shards.vw; head -n 2 tmp_shards.vw; rm tmp_shards.vw
+3 2.0 | 0:7.7 1:3.0 2:6.1 3:2.3
+1 | 0:5.1 1:3.8 2:1.5 3:0.3
+
+[tovw_shards_manifest]
+$ vwoptimize.py -d @iris_shards.txt --workers 3 --tovw /dev/stdout > tmp_shards.vw; cat iris_shards/part3.vw iris_shards/part1.vw iris_shards/part2.vw | cmp - tmp_shards.vw; head -n 1 tmp_shards.vw; rm tmp_shards.vw
+2 | 0:5.8 1:2.7 2:4.1 3:1.0
+
+[min_token_count]
+$ vwoptimize.py -d rare_tokens.vw --min_token_count 2 --tovw /dev/stdout
+preprocessor = --min_token_count 2
+1 |a x y |b z
+0 |a x y |b z
+1 |a x |b
+
+[min_token_count_tuned]
+$ python convert_variants.py --morelogs rare_tokens.vw tmp_pruned1.vw '--min_token_count 1' tmp_pruned2.vw '--min_token_count 2' 2>&1 | grep Pruned | sed -E 's/[0-9]+[.][0-9]+[.]unpruned/N.unpruned/; s/ in [0-9.]+ seconds//'; cat tmp_pruned1.vw tmp_pruned2.vw
+Pruned .vwoptimize/N.unpruned.vw with min counts 1, 2
+1 |a x y z |b z
+0 |a x y |b z
+1 |a x w |b y
+1 |a x y |b z
+0 |a x y |b z
+1 |a x |b
+
+[min_token_count_tuned_with_unpruned]
+$ python convert_variants.py --morelogs rare_tokens.vw tmp_pruned1.vw '' tmp_pruned2.vw '--min_token_count 2' 2>&1 | grep Pruned | sed -E 's/ in [0-9.]+ seconds//'; cat tmp_pruned2.vw
+Pruned tmp_pruned1.vw with min counts 2
+1 |a x y |b z
+0 |a x y |b z
+1 |a x |b
+
+[min_token_count_cleanup]
+$ rm tmp_pruned1.vw tmp_pruned2.vw
+<BLANKLINE>
+
+[dedup]
+$ vwoptimize.py -d duplicates.vw --dedup --tovw /dev/stdout 2>&1 | sed -E 's/ in [0-9.]+ seconds//'
+1 4.0 | a b
+0 1.5 | a b
+-1 2.0 | c
+-1 | c d
+Merged duplicate examples of /dev/stdout: 8 lines -> 4 (50.0%)
+
+[dedup_buckets]
+$ python convert_variants.py --dedup --dedup_bucket_size 16 duplicates.vw tmp_dedup.vw '' 2>&1 | sed -E 's/ in [0-9.]+ seconds//'; cat tmp_dedup.vw
+Merged duplicate examples of tmp_dedup.vw: 8 lines -> 4 (50.0%)
+1 4.0 | a b
+0 1.5 | a b
+-1 2.0 | c
+-1 | c d
+
+[dedup_metric_on_merged_examples]
+$ vwoptimize.py -d duplicates.vw --dedup --metric mse 2>&1 | egrep 'loss|mse' > tmp_dedup_metric1; vwoptimize.py -d tmp_dedup.vw --metric mse 2>&1 | egrep 'loss|mse' > tmp_dedup_metric2; wc -l < tmp_dedup_metric1; diff tmp_dedup_metric1 tmp_dedup_metric2
+2
+
+[dedup_cleanup]
+$ rm tmp_dedup.vw tmp_dedup_metric1 tmp_dedup_metric2
+<BLANKLINE>
+
+[convert_cache_populate]
+$ vwoptimize.py -d simple.csv --tovw tmp_cached.vw --convert_cache 1M --tmp tmp_cache_dir
+<BLANKLINE>
+
+[convert_cache_reuse]
+$ vwoptimize.py -d simple.csv --tovw /dev/stdout --convert_cache 1M --tmp tmp_cache_dir --morelogs 2>&1 | grep -v 'preprocessor ='
+Reusing cached conversion of simple.csv
+1 | Hello World! first class
+2 | Goodbye World. second class
+1 | hello first class again
+
+[convert_cache_other_settings]
+$ vwoptimize.py -d simple.csv --tovw tmp_cached2.vw --convert_cache 1M --tmp tmp_cache_dir --lowercase --morelogs 2>&1 | grep -c Reusing; ls tmp_cache_dir/cache | wc -l
+0
+3
+
+[convert_cache_cleanup]
+$ rm -r tmp_cache_dir tmp_cached.vw tmp_cached2.vw
+<BLANKLINE>
+
+[convert_cache_same_output1]
+$ vwoptimize.py -d simple.csv --tovw tmp_cached3.vw --convert_cache 1G --tmp tmp_cache_dir
+<BLANKLINE>
+
+[convert_cache_same_output2]
+$ vwoptimize.py -d simple.csv --tovw tmp_cached3.vw --convert_cache 1G --tmp tmp_cache_dir --lowercase
+preprocessor = --lowercase
+
+[convert_cache_same_output3]
+$ vwoptimize.py -d simple.csv --tovw tmp_cached4.vw --convert_cache 1G --tmp tmp_cache_dir --morelogs 2>&1 | grep -v 'preprocessor ='; cat tmp_cached4.vw
+Reusing cached conversion of simple.csv
+1 | Hello World! first class
+2 | Goodbye World. second class
+1 | hello first class again
+
+[convert_cache_same_output_links]
+$ find tmp_cached3.vw tmp_cached4.vw tmp_cache_dir/cache -type f -links +1
+<BLANKLINE>
+
+[convert_cache_same_output_cleanup]
+$ rm -r tmp_cache_dir tmp_cached3.vw tmp_cached4.vw
+<BLANKLINE>
+
+[column_store_populate]
+$ vwoptimize.py -d typed_columns.csv --columnspec y,num_n,cat_c --ignoreheader --tovw tmp_columns1.vw --convert_cache 1M --tmp tmp_cache_dir; ls tmp_cache_dir/cache | grep -c columns
+1
+
+[column_store_reuse]
+$ vwoptimize.py -d typed_columns.csv --columnspec y,num_n,cat_c --ignoreheader --tovw tmp_columns2.vw --convert_cache 1M --tmp tmp_cache_dir --workers 2 --lowercase --morelogs 2>&1 | grep Reading | cut -d / -f 1; vwoptimize.py -d typed_columns.csv --columnspec y,num_n,cat_c --ignoreheader --tovw /dev/stdout --lowercase 2>/dev/null | cmp - tmp_columns2.vw; cmp tmp_columns1.vw tmp_columns2.vw
+Reading typed_columns.csv from tmp_cache_dir
+
+[column_store_cleanup]
+$ rm -r tmp_cache_dir tmp_columns1.vw tmp_columns2.vw
+<BLANKLINE>
+
+[convert_variants_shared]
+$ python convert_variants.py small_ag_news.csv tmp_variant1.vw '--lowercase' tmp_variant2.vw '--lowercase --strip_punct' tmp_variant3.vw '--lowercase --strip_punct --remove_duplicate_words'
+preprocessor = --lowercase
+preprocessor = --lowercase --strip_punct
+preprocessor = --lowercase --strip_punct --remove_duplicate_words
+
+[convert_variants_shared_same_as_separate]
+$ vwoptimize.py -d small_ag_news.csv --columnspec y,text,text --lowercase --tovw /dev/stdout 2>/dev/null | cmp - tmp_variant1.vw; vwoptimize.py -d small_ag_news.csv --columnspec y,text,text --lowercase --strip_punct --tovw /dev/stdout 2>/dev/null | cmp - tmp_variant2.vw; vwoptimize.py -d small_ag_news.csv --columnspec y,text,text --lowercase --strip_punct --remove_duplicate_words --tovw /dev/stdout 2>/dev/null | cmp - tmp_variant3.vw
+<BLANKLINE>
+
+[convert_variants_shared_cleanup]
+$ rm tmp_variant1.vw tmp_variant2.vw tmp_variant3.vw
+<BLANKLINE>
+
 [cleanup]
 $ ls .vwoptimize
 <BLANKLINE>
@@ -201,3 +395,4 @@ $ ls .vwoptimize
 
 import sys
 __doc__ = __doc__.replace('vwoptimize.py', '%s ../vwoptimize.py' % sys.executable)
+__doc__ = __doc__.replace('$ python ', '$ %s ' % sys.executable)
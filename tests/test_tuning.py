@@ -127,6 +127,27 @@ Best preprocessor options = <none>
 Best vw options = --quiet
 Best vw_average_loss = 2.396272
 
+[prebuilt_cache_fold_caches_shared_by_trials]
+$ vwoptimize.py -d iris.vw --oaa 3 -c -k --passes 1/2/5? --kfold 3 --prebuilt_cache --morelogs 2>&1 | grep 'Built vw cache' | cut -d ' ' -f 5 | sort | uniq -c | sed -E 's/^ +//'
+1 iris.vw
+3 paste
+
+[max_collision_rate]
+$ vwoptimize.py -d rare_tokens.vw -b 18/20/22? --max_collision_rate 0.01 2>&1 | grep 'Using -b'
+Using -b 18: the smallest candidate with collision rate within 0.01
+
+[max_collision_rate_bigger_bits]
+$ vwoptimize.py -d rare_tokens.vw -b 18/20/22? --max_collision_rate 0.00001 2>&1 | grep 'Using -b'
+Using -b 20: the smallest candidate with collision rate within 1e-05
+
+[max_collision_rate_oaa]
+$ vwoptimize.py -d rare_tokens.vw --oaa 3 -b 18/20/22? --max_collision_rate 0.00001 2>&1 | grep 'Using -b'
+Using -b 20: the smallest candidate with collision rate within 1e-05
+
+[max_collision_rate_none_within]
+$ vwoptimize.py -d rare_tokens.vw -b 18/20/22? --max_collision_rate 0.0000001 2>&1 | grep 'candidate'
+No -b candidate has collision rate within 1e-07, using 22
+
 [cleanup]
 $ ls .vwoptimize
 <BLANKLINE>
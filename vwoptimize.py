@@ -15,7 +15,9 @@ import time
 import json
 import pprint
 import unicodedata
-from itertools import izip, izip_longest
+import errno
+import operator
+from itertools import islice, izip, product
 from collections import deque
 from pipes import quote
 import numpy as np
@@ -37,18 +39,60 @@ VOWPAL_WABBIT_ERRORS = "error|won't work right|errno|can't open|vw::vw_exception
 DEFAULT_COLUMNSPEC = 'y,text,*'
 METRIC_FORMAT = 'mean'
 DEFAULT_METRICS = ['vw_average_loss']
+MIN_CONVERSION_CHUNK = 1 << 20
+CONVERSION_WRITE_BATCH = 1000
+READ_CHUNK = 1 << 20
+COLUMN_STORE_BATCH = 10000
+COMPRESSED_EXTENSIONS = ('gz', 'bz2', 'xz', 'zst')
+# parallel implementations first
+COMPRESSORS = {
+    'gz': ('pigz', 'gzip'),
+    'bz2': ('lbzip2', 'pbzip2', 'bzip2'),
+    'xz': ('xz', ),
+    'zst': ('zstd', ),
+}
+GZIP_LEVEL = 3
+COMPRESS_TMP = False
+PREBUILT_VW_CACHE = False
+# vw options that only affect learning, not the examples that vw writes to its cache file
+VW_LEARNING_FLAGS = ('-c', '--cache', '-k', '--kill_cache', '--quiet', '--holdout_off', '--adaptive', '--normalized', '--invariant',
+                     '--sgd', '--save_resume', '--compressed')
+VW_LEARNING_OPTIONS = ('--passes', '-l', '--learning_rate', '--l1', '--l2', '--power_t', '--initial_t', '--decay_learning_rate',
+                       '--holdout_period', '--holdout_after', '--early_terminate', '--loss_function', '--link', '-q', '--quadratic',
+                       '--cubic', '--interactions', '--minibatch', '--random_seed', '--initial_weight', '--quantile_tau',
+                       '--cache_file', '-f', '--final_regressor', '-i', '--initial_regressor', '-p', '--predictions',
+                       '-r', '--raw_predictions', '--readable_model')
+LINEMODE_DEADLINE = 0.005
+TOKEN_SKETCH_WIDTH = 1 << 21
+HLL_PRECISION = 14
+DEFAULT_VW_BITS = 18
+# bytes of examples merged in memory at once by a worker with --dedup, bigger files are partitioned by hash first
+DEDUP_BUCKET_SIZE = 1 << 28
 
 AWK_TRAINSET = "awk '(NR - $fold) % KFOLDS != 0' VW |"
 AWK_TESTSET = "awk '(NR - $fold) % KFOLDS == 0' VW |"
 PERL_TRAINSET = "perl -nE 'if ((++$NR - $fold) % KFOLDS != 0) { print $_ }' VW |"
 PERL_TESTSET = "perl -nE 'if ((++$NR - $fold) % KFOLDS == 0) { print $_ }' VW |"
+# with --foldassign random or stratified, FOLDINDEX has the fold of each example on each line;
+# it is passed as the first argument, so that its name is not parsed by awk or perl
+AWK_INDEXED_TRAINSET = "awk 'BEGIN { foldindex = ARGV[1]; delete ARGV[1] } { getline f < foldindex } f != $fold' FOLDINDEX VW |"
+AWK_INDEXED_TESTSET = "awk 'BEGIN { foldindex = ARGV[1]; delete ARGV[1] } { getline f < foldindex } f == $fold' FOLDINDEX VW |"
+PERL_INDEXED_TRAINSET = "perl -nE 'BEGIN { open(F, \"<\", shift @ARGV) } $f = <F>; print $_ if $f != $fold' FOLDINDEX VW |"
+PERL_INDEXED_TESTSET = "perl -nE 'BEGIN { open(F, \"<\", shift @ARGV) } $f = <F>; print $_ if $f == $fold' FOLDINDEX VW |"
 options = None
 
+# 'files' splits the data into fold files once, 'awk' and 'perl' filter the whole data for every fold of every run
+FOLDSCRIPT = 'files'
+
+# what --foldscript filter means
 if 'darwin' in sys.platform:
     # awk is slow on Mac OS X
-    FOLDSCRIPT = 'perl'
+    FOLDFILTER = 'perl'
 else:
-    FOLDSCRIPT = 'awk'
+    FOLDFILTER = 'awk'
+# 'mod' puts example number N into fold (N - 1) % kfold + 1, 'random' and 'stratified' (by label) shuffle them with FOLD_SEED
+FOLD_ASSIGN = 'mod'
+FOLD_SEED = 0
 
 
 def htmlparser_unescape(text, cache=[]):
@@ -95,33 +139,173 @@ def kill(*jobs, **kwargs):
                 sys.stderr.write('Failed to kill %r: %s\n' % (job, ex))
 
 
+def find_executable(name, cache={}):
+    if name not in cache:
+        from distutils.spawn import find_executable as _find_executable
+        cache[name] = _find_executable(name)
+    return cache[name]
+
+
+def _compressor_preexec():
+    import signal
+    # python ignores SIGPIPE and children inherit that; let the decompressor die quietly when its reader goes away
+    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+    die_if_parent_dies()
+
+
+def get_compressor(ext):
+    """Return path of the fastest installed (de)compressor for files with extension ext, or None"""
+    for name in COMPRESSORS.get(ext, ()):
+        path = find_executable(name)
+        if path:
+            return path
+
+
+class DecompressedInput(object):
+    """Read-only file object over the output of an external decompressor. Reading raises IOError if the decompressor failed."""
+
+    def __init__(self, filename, decompressor):
+        self.name = filename
+        self.popen = subprocess.Popen([decompressor, '-dc', filename], stdout=subprocess.PIPE, preexec_fn=_compressor_preexec)
+        self.stdout = self.popen.stdout
+
+    def _check(self):
+        if self.popen.wait() != 0:
+            raise IOError('Failed to decompress %s (exit code %s)' % (self.name, self.popen.returncode))
+
+    def read(self, size=-1):
+        data = self.stdout.read(size)
+        if not data or size < 0:
+            self._check()
+        return data
+
+    def readline(self, size=-1):
+        line = self.stdout.readline(size)
+        if not line:
+            self._check()
+        return line
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    def close(self):
+        self.stdout.close()
+        if self.popen.poll() is None:
+            self.popen.kill()
+        self.popen.wait()
+
+
+class CompressedOutput(object):
+    """Write-only file object that feeds an external compressor writing into filename"""
+
+    def __init__(self, filename, compressor):
+        self.name = filename
+        output = open(filename, 'wb')
+        try:
+            self.popen = subprocess.Popen([compressor, '-q', '-c'], stdin=subprocess.PIPE, stdout=output, preexec_fn=_compressor_preexec)
+        finally:
+            output.close()
+        self.stdin = self.popen.stdin
+
+    def write(self, data):
+        self.stdin.write(data)
+
+    def writelines(self, lines):
+        self.stdin.writelines(lines)
+
+    def flush(self):
+        self.stdin.flush()
+
+    def fileno(self):
+        return self.stdin.fileno()
+
+    def close(self):
+        self.stdin.close()
+        if self.popen.wait() != 0:
+            raise IOError('Failed to compress %s (exit code %s)' % (self.name, self.popen.returncode))
+
+
+def get_compression(filename):
+    if isinstance(filename, basestring):
+        ext = filename.rsplit('.', 1)[-1].lower()
+        if ext in COMPRESSED_EXTENSIONS:
+            return ext
+
+
 def open_regular_or_compressed(filename):
     if filename is None:
         return sys.stdin
 
     if hasattr(filename, 'read'):
-        fobj = filename
+        return filename
+
+    ext = get_compression(filename)
+    if ext is None:
+        return open(filename)
+
+    decompressor = get_compressor(ext)
+    if decompressor:
+        # runs in parallel with the parsing and is faster than python modules anyway
+        return DecompressedInput(filename, decompressor)
+
+    if ext == 'gz':
+        import gzip
+        fobj = gzip.GzipFile(filename)
+    elif ext == 'bz2':
+        import bz2
+        fobj = bz2.BZ2File(filename)
+    elif ext == 'xz':
+        import lzma
+        fobj = lzma.open(filename)
     else:
-        f = filename.lower()
-        ext = f.rsplit('.', 1)[-1]
-        if ext == 'gz':
-            import gzip
-            fobj = gzip.GzipFile(filename)
-        elif ext == 'bz2':
-            import bz2
-            fobj = bz2.BZ2File(filename)
-        elif ext == 'xz':
-            import lzma
-            fobj = lzma.open(filename)
-        else:
-            fobj = open(filename)
+        sys.exit('Cannot read %s: %s is not installed' % (filename, ' or '.join(COMPRESSORS[ext])))
     return fobj
 
 
+def unlink_hard_link(filename):
+    """Unlink regular file filename if it has other links, so that writing a new filename leaves their contents alone"""
+    import stat
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return
+    if stat.S_ISREG(st.st_mode) and st.st_nlink > 1:
+        os.unlink(filename)
+
+
+def open_output(filename):
+    """Open filename for writing, compressing the data if the extension says so.
+
+    Compressed files written in parts can be concatenated: both gzip and zstd read such files as a whole.
+    """
+    unlink_hard_link(filename)
+    ext = get_compression(filename)
+    if ext is None:
+        return open(filename, 'wb')
+
+    if ext == 'gz':
+        import gzip
+        return gzip.GzipFile(filename, 'wb', compresslevel=GZIP_LEVEL)
+    elif ext == 'bz2':
+        import bz2
+        return bz2.BZ2File(filename, 'wb')
+
+    compressor = get_compressor(ext)
+    if not compressor:
+        sys.exit('Cannot write %s: %s is not installed' % (filename, ' or '.join(COMPRESSORS[ext])))
+    return CompressedOutput(filename, compressor)
+
+
 def get_real_ext(filename):
     filename = filename.rsplit('/', 1)[-1]
     items = filename.rsplit('.', 2)
-    if len(items) >= 2 and items[-1] in 'gz bz2 xz'.split():
+    if len(items) >= 2 and items[-1] in COMPRESSED_EXTENSIONS:
         return items[-2]
     return items[-1]
 
@@ -134,6 +318,13 @@ def get_temp_filename(suffix, counter=[0]):
     return fname
 
 
+def get_temp_vw_filename(suffix):
+    """Temp filename for converted data, which vw reads gzipped with --tmpcompress"""
+    if COMPRESS_TMP:
+        suffix += '.gz'
+    return get_temp_filename(suffix)
+
+
 log_lock = threading.RLock()
 
 
@@ -166,10 +357,12 @@ def vw_failed(msg=''):
 
 
 def flush_and_close(fileobj):
-    fileobj.flush()
+    # bz2.BZ2File has neither flush() nor fileno(), close() writes everything out
+    if hasattr(fileobj, 'flush'):
+        fileobj.flush()
     try:
         os.fsync(fileobj.fileno())
-    except OSError:
+    except (OSError, AttributeError):
         pass
     fileobj.close()
 
@@ -184,12 +377,81 @@ def write_file(filename, data):
     if filename in STDOUT_NAMES:
         sys.stdout.write(data)
     else:
-        fobj = open(filename, 'w')
+        fobj = open_output(filename)
         fobj.write(data)
         flush_and_close(fobj)
 
 
+def get_shards(path):
+    """
+    Return list of files making up a sharded dataset or path itself if it is a regular file.
+
+    A sharded dataset is a directory (files directly in it), a glob or '@' followed by the name of a manifest
+    file that lists one shard per line (relative to the manifest's directory). Shards are sorted by name unless
+    they come from a manifest.
+    """
+    import glob
+    if path.startswith('@') and os.path.isfile(path[1:]):
+        directory = os.path.dirname(path[1:])
+        shards = []
+        for line in open(path[1:]):
+            line = line.strip()
+            if line and not line.startswith('#'):
+                shards.append(os.path.join(directory, line))
+    elif os.path.isdir(path):
+        shards = sorted(os.path.join(path, name) for name in os.listdir(path) if not name.startswith('.'))
+        shards = [x for x in shards if os.path.isfile(x)]
+    elif not os.path.exists(path) and glob.has_magic(path):
+        shards = sorted(x for x in glob.glob(path) if os.path.isfile(x))
+    else:
+        return path
+
+    if not shards:
+        sys.exit('No data files found in %s' % path)
+
+    for shard in shards:
+        if not os.path.isfile(shard):
+            sys.exit('File not found: %s (listed in %s)' % (shard, path))
+
+    if len(shards) == 1:
+        return shards[0]
+
+    return shards
+
+
+def get_data_pipeline(source):
+    """
+    Return shell pipeline that outputs contents of the files in source one after another, decompressing them as needed
+
+    >>> get_data_pipeline(['a.vw', 'b.vw'])
+    'cat a.vw b.vw |'
+    """
+    if isinstance(source, basestring):
+        source = [source]
+    commands = []
+    for filename in source:
+        compression = get_compression(filename)
+        if compression:
+            decompressor = get_compressor(compression)
+            if not decompressor:
+                sys.exit('Cannot read %s: %s is not installed' % (filename, ' or '.join(COMPRESSORS[compression])))
+            command = [decompressor, '-dc']
+        else:
+            command = ['cat']
+        if commands and commands[-1][:len(command)] == command:
+            commands[-1].append(filename)
+        else:
+            commands.append(command + [filename])
+    commands = [' '.join(quote(x) for x in items) for items in commands]
+    if len(commands) == 1:
+        return commands[0] + ' |'
+    return '{ %s; } |' % '; '.join(commands)
+
+
 def get_format_from_filename(filename):
+    if isinstance(filename, list):
+        filename = filename[0]
+
     items = filename.lower().split('.')
 
     for ext in reversed(items):
@@ -211,8 +473,132 @@ class simple_reader(object):
         return row
 
 
-def open_anything(source, format, ignoreheader, force_unbuffered=False):
-    source = open_regular_or_compressed(source)
+def read_byte_range_chunks(filename, start, end, size=READ_CHUNK):
+    """Yield about size bytes at a time of the lines of filename that start between byte offsets start and end"""
+    import mmap
+    fobj = open(filename, 'rb')
+    try:
+        if end <= start:
+            return
+        mm = mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            end = min(end, len(mm))
+            while start < end:
+                stop = min(start + size, end)
+                if mm[stop - 1] != '\n':
+                    # complete the last line
+                    newline = mm.find('\n', stop)
+                    stop = len(mm) if newline < 0 else newline + 1
+                yield mm[start:stop]
+                start = stop
+        finally:
+            mm.close()
+    finally:
+        fobj.close()
+
+
+def read_chunks(fileobj, size=READ_CHUNK):
+    """Yield about size bytes at a time of fileobj, ending on line boundaries"""
+    while True:
+        chunk = fileobj.read(size)
+        if not chunk:
+            break
+        if not chunk.endswith('\n'):
+            chunk += fileobj.readline()
+        yield chunk
+
+
+def last_record_end(data, quoted):
+    """
+    Return offset right after the last newline of data that is not inside quotes (0 if there is none)
+
+    >>> last_record_end('a,b\\nc,"d\\ne"\\nf', True)
+    12
+    >>> last_record_end('a,b\\nc,"d\\ne', True)
+    4
+    >>> last_record_end('a,b\\nc,"d\\ne', False)
+    9
+    >>> last_record_end('a,"b\\n', True)
+    0
+    """
+    pos = data.rfind('\n')
+    if quoted:
+        quotes = data.count('"', 0, pos + 1)
+        while pos >= 0 and quotes % 2:
+            previous = data.rfind('\n', 0, pos)
+            quotes -= data.count('"', previous + 1, pos + 1)
+            pos = previous
+    return pos + 1
+
+
+def read_records(fd, format, ignoreheader=False, size=READ_CHUNK, deadline=None, header=None):
+    """
+    Yield about size bytes at a time read from file descriptor fd, each chunk made of complete records.
+
+    If header is a list, the header skipped with ignoreheader is appended to it.
+
+    With deadline (in seconds) a chunk is yielded once no more input arrives within that time after its first
+    byte, instead of waiting for size bytes. Reading goes around the file object, so nothing must have been
+    read from fd through one.
+    """
+    import select
+    quoted = format in ('csv', 'tsv')
+    pending = ''
+    eof = False
+    while not eof:
+        # read at least once more, otherwise a record longer than size would never complete
+        target = max(size, len(pending) + 1)
+        until = None
+        while len(pending) < target:
+            if until is not None:
+                timeout = until - time.time()
+                if timeout <= 0 or not select.select([fd], [], [], timeout)[0]:
+                    break
+            data = os.read(fd, target - len(pending))
+            if not data:
+                eof = True
+                break
+            pending += data
+            if deadline is not None and until is None:
+                until = time.time() + deadline
+        end = len(pending) if eof else last_record_end(pending, quoted)
+        if not end:
+            continue
+        chunk = pending[:end]
+        pending = pending[end:]
+        if ignoreheader:
+            header_end = _find_record_end(chunk, 0, False, quoted)[0]
+            if header is not None:
+                header.append(chunk[:header_end])
+            chunk = chunk[header_end:]
+            ignoreheader = False
+        if chunk:
+            yield chunk
+
+
+def read_byte_range(filename, start, end):
+    """Yield lines of filename between byte offsets start and end (see get_record_boundaries)"""
+    for chunk in read_byte_range_chunks(filename, start, end):
+        lines = chunk.split('\n')
+        last = lines.pop()
+        for line in lines:
+            yield line + '\n'
+        if last:
+            yield last
+
+
+def open_anything(source, format, ignoreheader, force_unbuffered=False, byte_range=None):
+    if isinstance(source, list):
+        # shards are read one after another, each with its own header
+        from itertools import chain
+        return chain.from_iterable(open_anything(shard, format, ignoreheader, force_unbuffered) for shard in source)
+
+    if byte_range is not None:
+        # the header, if any, is not part of the range
+        source = read_byte_range(source, *byte_range)
+        ignoreheader = False
+    else:
+        source = open_regular_or_compressed(source)
 
     if force_unbuffered:
         # simply disabling buffering is not enough, see this for details: http://stackoverflow.com/a/6556862
@@ -239,6 +625,15 @@ def open_anything(source, format, ignoreheader, force_unbuffered=False):
     return reader
 
 
+def read_column_names(source, format):
+    """Header of csv, tsv or tab file source (of its first shard), which names its num and cat columns"""
+    if format == 'vw':
+        return None
+    if isinstance(source, list):
+        source = source[0]
+    return next(iter(open_anything(source, format, ignoreheader=False)), None)
+
+
 def limited_repr(obj, limit=80):
     s = repr(obj)
     if len(s) >= limit:
@@ -293,6 +688,38 @@ def system(cmd, importance=1, repeat_on_error=0):
     return (out or '') + (err or '')
 
 
+def run_with_streamed_input(cmd, fifo, writer):
+    """Run cmd that reads from named pipe fifo while writer() writes into it from a thread"""
+    errors = []
+
+    def write():
+        try:
+            writer()
+        except IOError, ex:
+            # the reader exited before reading everything, its exit status tells if that is a problem
+            if ex.errno != errno.EPIPE:
+                errors.append(sys.exc_info())
+        except BaseException:
+            errors.append(sys.exc_info())
+
+    thread = threading.Thread(target=write)
+    thread.daemon = True
+    thread.start()
+
+    try:
+        return system(cmd)
+    finally:
+        if thread.is_alive():
+            # if the reader exited without opening the pipe, the writer is still blocked in open()
+            try:
+                os.close(os.open(fifo, os.O_RDONLY | os.O_NONBLOCK))
+            except OSError:
+                pass
+        thread.join()
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+
+
 def split_file(source, nfolds=None, ignoreheader=False, importance=0, minfoldsize=10000):
     if nfolds is None:
         nfolds = 10
@@ -354,2308 +781,5088 @@ def split_file(source, nfolds=None, ignoreheader=False, importance=0, minfoldsiz
     return folds, total_lines
 
 
-def _workers(workers):
-    if workers is not None and workers <= 1:
-        return 1
-    if workers is None or workers <= 0:
-        import multiprocessing
-        return 1 + multiprocessing.cpu_count()
-    return workers
+def _count_quotes(mm, start, end, blocksize=1 << 24):
+    count = 0
+    while start < end:
+        count += mm[start:min(end, start + blocksize)].count('"')
+        start += blocksize
+    return count
 
 
-def die_if_parent_dies(signum=9):
-    if 'linux' not in sys.platform:
-        return
-    try:
-        import ctypes
-        libc = ctypes.CDLL('libc.so.6', use_errno=True)
-        PR_SET_PDEATHSIG = 1
-        result = libc.prctl(PR_SET_PDEATHSIG, signum)
-        if result == 0:
-            return True
-        else:
-            log('prctl failed: %s', os.strerror(ctypes.get_errno()))
-    except StandardError, ex:
-        sys.stderr.write(str(ex) + '\n')
+def _find_record_end(mm, pos, in_quotes, quoted):
+    """Return offset right after the first newline at or after pos that is not inside quotes"""
+    size = len(mm)
+    while pos < size:
+        newline = mm.find('\n', pos)
+        if newline < 0:
+            return size, in_quotes
+        if quoted and _count_quotes(mm, pos, newline) % 2:
+            in_quotes = not in_quotes
+        pos = newline + 1
+        if not in_quotes:
+            return pos, in_quotes
+    return size, in_quotes
 
 
-def get_command_name(params):
-    if not isinstance(params, dict):
-        return str(params)
-    name = params.get('name', None)
-    args = params.get('args')
+def get_record_boundaries(filename, nchunks, format, ignoreheader=False):
+    """
+    Split filename into at most nchunks byte ranges [start, end) that each consist of complete records.
 
-    if isinstance(args, list):
-        args = ' '.join(args)
+    For csv/tsv the newlines inside quoted fields are not considered record ends. The quote state is tracked
+    by counting quote characters, which assumes that a field containing quotes is itself quoted, as csv writers do.
 
-    if name:
-        return '[%s] %s' % (name, args)
-    else:
-        return str(args)
+    >>> get_record_boundaries('tests/multiline.csv', 3, 'csv')
+    [(0, 18), (18, 38), (38, 47)]
 
+    >>> get_record_boundaries('tests/multiline.csv', 1, 'csv', ignoreheader=True)
+    [(18, 47)]
+    """
+    import mmap
+    size = os.path.getsize(filename)
+    if not size:
+        return []
 
-def Popen(params, **kwargs):
-    command_name = get_command_name(params)
+    quoted = format in ('csv', 'tsv')
+    fobj = open(filename, 'rb')
+    try:
+        mm = mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            in_quotes = False
+            start = 0
 
-    if isinstance(params, dict):
-        params = params.copy()
-        args = params.pop('args')
-        params.pop('name', None)
-        params.update(kwargs)
-    else:
-        args = params
-        params = kwargs
+            if ignoreheader:
+                start, in_quotes = _find_record_end(mm, 0, in_quotes, quoted)
 
-    importance = params.pop('importance', None)
-    if importance is None:
-        importance = 0
+            chunksize = max(1, int(math.ceil((size - start) / float(nchunks))))
+            boundaries = []
 
-    params.setdefault('preexec_fn', die_if_parent_dies)
+            while start < size:
+                target = min(size, start + chunksize)
+                if quoted and _count_quotes(mm, start, target) % 2:
+                    in_quotes = not in_quotes
+                end, in_quotes = _find_record_end(mm, target, in_quotes, quoted)
+                boundaries.append((start, end))
+                start = end
 
-    log('+ %s', command_name, importance=importance)
+            return boundaries
+        finally:
+            mm.close()
+    finally:
+        fobj.close()
 
-    popen = subprocess.Popen(args, **params)
-    return popen
 
+def can_split_by_offsets(source):
+    if not isinstance(source, basestring) or source in STDIN_NAMES:
+        return False
+    if get_compression(source):
+        return False
+    return os.path.isfile(source)
 
-def run_subprocesses(cmds, workers=None, importance=None):
-    for item in cmds:
-        if isinstance(item, deque):
-            for subitem in item:
-                assert isinstance(subitem, dict), subitem
-        else:
-            assert isinstance(item, dict), item
 
-    workers = _workers(workers)
-    cmds_queue = deque(cmds)
-    queue = deque()
-    success = False
-    outputs = {}
+def get_conversion_chunks(source, workers):
+    """Number of byte ranges to convert in parallel: one per worker, but no less than MIN_CONVERSION_CHUNK bytes per range"""
+    size = os.path.getsize(source)
+    return max(1, min(workers, size // MIN_CONVERSION_CHUNK))
 
-    try:
-        while queue or cmds_queue:
-            if cmds_queue and len(queue) <= workers:
-                cmd = cmds_queue.popleft()
 
-                if isinstance(cmd, deque):
-                    this_cmd = cmd.popleft()
-                    followup = cmd
-                else:
-                    this_cmd = cmd
-                    followup = None
+def _libc_copy_function(name, cache={}):
+    if name in cache:
+        return cache[name]
+    func = None
+    if 'linux' in sys.platform:
+        try:
+            import ctypes
+            libc = ctypes.CDLL(None, use_errno=True)
+            func = getattr(libc, name)
+            func.restype = ctypes.c_ssize_t
+            if name in ('copy_file_range', 'splice'):
+                func.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint]
+            else:
+                func.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t]
+        except Exception:
+            func = None
+    cache[name] = func
+    return func
 
-                popen = Popen(this_cmd, shell=True, importance=importance)
-                popen._cmd = this_cmd
-                popen._name = this_cmd.get('name', '')
-                popen._followup = followup
-                queue.append(popen)
+
+def _copy_fd_in_kernel(in_fd, out_fd, count):
+    """Copy count bytes between file positions of in_fd and out_fd without passing them through userspace.
+
+    Returns number of bytes copied, which is less than count if neither copy_file_range nor sendfile is usable.
+    """
+    import ctypes
+    copied = 0
+    for name in ('copy_file_range', 'sendfile'):
+        func = _libc_copy_function(name)
+        if func is None:
+            continue
+        while copied < count:
+            chunk = min(count - copied, 1 << 30)
+            if name == 'copy_file_range':
+                result = func(in_fd, None, out_fd, None, chunk, 0)
             else:
-                popen = queue.popleft()
+                result = func(out_fd, in_fd, None, chunk)
+            if result <= 0:
+                if result < 0 and ctypes.get_errno() == errno.EINTR:
+                    continue
+                # not supported for this pair of files (e.g. different filesystems, output is a pipe); try the next method
+                break
+            copied += result
+        if copied >= count:
+            break
+    return copied
 
-                if popen.stdout is not None or popen.stderr is not None:
-                    out, err = popen.communicate()
-                    out = (out or '') + (err or '')
-                    outputs.setdefault(popen._name, []).append(out)
 
-                retcode = popen.wait()
+def open_output_fd(output_filename):
+    if output_filename in STDOUT_NAMES:
+        sys.stdout.flush()
+        return os.dup(sys.stdout.fileno())
+    unlink_hard_link(output_filename)
+    return os.open(output_filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0666)
 
-                if retcode:
-                    log_always('failed: %s', popen._cmd.get('args', get_command_name(popen._cmd)))
-                    return None, outputs
-                else:
-                    log('%s %s', '-' if retcode == 0 else '!', get_command_name(popen._cmd), importance=importance)
 
-                if popen._followup:
-                    cmds_queue.append(popen._followup)
+def is_pipe(filename):
+    import stat
+    try:
+        return stat.S_ISFIFO(os.stat(filename).st_mode)
+    except OSError:
+        return False
 
-        success = True
 
+def append_file(out_fd, filename):
+    """Append contents of filename to out_fd, using copy_file_range/sendfile where supported"""
+    import shutil
+    in_fd = os.open(filename, os.O_RDONLY)
+    try:
+        size = os.fstat(in_fd).st_size
+        copied = _copy_fd_in_kernel(in_fd, out_fd, size)
+        if copied < size:
+            # duplicated descriptors share file positions with the originals
+            src = os.fdopen(os.dup(in_fd), 'rb')
+            dst = os.fdopen(os.dup(out_fd), 'wb')
+            try:
+                shutil.copyfileobj(src, dst, 1 << 20)
+            finally:
+                src.close()
+                dst.close()
     finally:
-        if not success:
-            kill(*queue, verbose=True)
+        os.close(in_fd)
 
-    return success, outputs
 
+def concatenate_files(filenames, output_filename):
+    out_fd = open_output_fd(output_filename)
+    try:
+        for filename in filenames:
+            append_file(out_fd, filename)
+    finally:
+        os.close(out_fd)
 
-def _as_dict(lst, name):
-    if isinstance(lst, list):
-        lst = ' '.join(lst).strip()
-        lst = re.sub('\s+', ' ', lst)
-    return {'args': lst, 'shell': True, 'name': name}
 
+def _write_all(fd, data):
+    while data:
+        data = data[os.write(fd, data):]
 
-def get_vw_command(
-        to_cleanup,
-        source,
-        vw_args='',
-        initial_regressor=None,
-        final_regressor=None,
-        predictions=None,
-        raw_predictions=None,
-        audit=False,
-        readable_model=None,
-        only_test=False,
-        fix_cache_file=False,
-        name=''):
-    data_filename = ''
-    data_pipeline = ''
 
-    if source is None:
-        pass
-    elif isinstance(source, basestring):
-        if '|' in source:
-            data_pipeline = source
-            if not data_pipeline.strip().endswith('|'):
-                data_pipeline += ' |'
-        else:
-            assert os.path.exists(source), source
-            data_filename = '-d %s' % source
-    elif isinstance(source, list):
-        assert source and os.path.exists(source[0]), source
-        data_pipeline = 'cat %s |' % ' '.join(quote(x) for x in source)
-    else:
-        raise TypeError('Expected string or list, not %r' % (source, ))
+def _splice_all(in_fd, out_fd, size):
+    """Move everything from pipe in_fd into out_fd with splice(). Returns False if splice() is not usable there."""
+    import ctypes
+    func = _libc_copy_function('splice')
+    if func is None:
+        return False
+    copied = 0
+    while True:
+        result = func(in_fd, None, out_fd, None, size, 0)
+        if result == 0:
+            return True
+        if result < 0:
+            err = ctypes.get_errno()
+            if err == errno.EINTR:
+                continue
+            if not copied:
+                # e.g. in_fd is not a pipe
+                return False
+            raise OSError(err, os.strerror(err))
+        copied += result
 
-    intermediate_model_filename = final_regressor
 
-    final_options = []
+def spill_stdin(filename, tee_fd=None, size=READ_CHUNK):
+    """
+    Copy stdin into filename a block at a time, so that it is never held in memory as a whole.
 
-    if audit:
-        final_options += ['-a']
+    If tee_fd is given, the blocks are also written there as they arrive, until its reader goes away; tee_fd
+    is closed at the end. Otherwise a piped stdin is moved with splice() without passing through userspace.
+    """
+    in_fd = sys.stdin.fileno()
+    out_fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0666)
+    try:
+        if tee_fd is None and _splice_all(in_fd, out_fd, size):
+            return
+        while True:
+            data = os.read(in_fd, size)
+            if not data:
+                break
+            _write_all(out_fd, data)
+            if tee_fd is not None:
+                try:
+                    _write_all(tee_fd, data)
+                except OSError, ex:
+                    if ex.errno != errno.EPIPE:
+                        raise
+                    os.close(tee_fd)
+                    tee_fd = None
+    finally:
+        os.close(out_fd)
+        if tee_fd is not None:
+            os.close(tee_fd)
 
-    if readable_model:
-        final_options += ['--readable_model', readable_model]
 
-    vw_args = vw_args.split()
+def tee_stdin(filename, consume):
+    """Spill stdin into filename while consume(fileobj) reads the same data from a pipe. Returns what consume returned."""
+    import threading
+    read_fd, write_fd = os.pipe()
+    errors = []
 
-    if fix_cache_file:
-        if '--cache_file' in vw_args:
-            sys.exit('Dont provide --cache_file, one will be added automatically.')
+    def spill():
+        try:
+            spill_stdin(filename, tee_fd=write_fd)
+        except Exception, ex:
+            errors.append(ex)
 
-        if '-c' in vw_args or '--cache_file' in vw_args:
-            remove_option(vw_args, '-c', 0)
-            remove_option(vw_args, '--cache_file', 1)
-            if final_regressor:
-                cache_file = final_regressor + '.cache'
-            else:
-                cache_file = get_temp_filename('cache')
-            vw_args.extend(['--cache_file', cache_file])
-            to_cleanup.append(cache_file)
+    spiller = threading.Thread(target=spill)
+    spiller.daemon = True
+    spiller.start()
 
-    training_command = [
-        data_pipeline,
-        VW_CMD,
-        data_filename,
-        '-i %s' % initial_regressor if initial_regressor else '',
-        '-f %s' % intermediate_model_filename if intermediate_model_filename else '',
-        '-p %s' % predictions if predictions else '',
-        '-r %s' % raw_predictions if raw_predictions else '',
-        '-t' if only_test else '',
-    ] + vw_args
+    reader = os.fdopen(read_fd, 'rb')
+    try:
+        result = consume(reader)
+    finally:
+        # whatever consume did not read goes only to the file
+        reader.close()
 
-    if only_test:
-        return _as_dict(training_command + final_options, name=name)
+    while spiller.is_alive():
+        spiller.join(1)
 
-    return deque([_as_dict(training_command + final_options, name=name)])
+    if errors:
+        raise errors[0]
 
+    return result
 
-def vw_cross_validation(
-        vw_filename,
-        kfold,
-        vw_args,
-        vw_test_args,
-        workers=None,
-        with_predictions=False,
-        with_raw_predictions=False,
-        calc_num_features=False,
-        capture_output=False):
 
-    if hasattr(capture_output, '__contains__') and '' in capture_output:
-        capture_output = True
+def parse_size(size):
+    """
+    >>> parse_size('512')
+    512
+    >>> parse_size('10K')
+    10240
+    >>> parse_size('1.5G')
+    1610612736
+    """
+    size = size.strip().upper().rstrip('B')
+    for power, suffix in enumerate('KMGT'):
+        if size.endswith(suffix):
+            return int(float(size[:-1]) * 1024 ** (power + 1))
+    return int(size)
+
+
+def file_fingerprint(filename, sample_size=1 << 16):
+    """Identify contents of filename by its location, stat and first/last bytes, without reading all of it"""
+    import hashlib
+    filename = os.path.abspath(filename)
+    st = os.stat(filename)
+    h = hashlib.sha1(repr((filename, st.st_size, st.st_mtime, st.st_ino)))
+    fobj = open(filename, 'rb')
+    try:
+        h.update(fobj.read(sample_size))
+        if st.st_size > sample_size:
+            fobj.seek(max(sample_size, st.st_size - sample_size))
+            h.update(fobj.read(sample_size))
+    finally:
+        fobj.close()
+    return h.hexdigest()
 
-    workers = _workers(workers)
-    commands = []
-    p_filenames = []
-    r_filenames = []
-    readable_models = []
-    to_cleanup = []
 
-    vw_args = vw_args.replace('--quiet', '')
+def _path_size(path):
+    if os.path.isdir(path):
+        return sum(_path_size(os.path.join(path, name)) for name in os.listdir(path))
+    return os.path.getsize(path)
 
-    # Split into folds is done like this (example for 3 folds)
-    # Example -> fold:
-    # 1 -> 1
-    # 2 -> 2
-    # 3 -> 3
-    # 4 -> 1
-    # and so on
 
-    if kfold is None:
-        trainset = vw_filename
-        testset = None
-        kfold = 1
-    else:
-        assert kfold > 1, kfold
-        if FOLDSCRIPT == 'awk':
-            trainset = AWK_TRAINSET
-            testset = AWK_TESTSET
-        elif FOLDSCRIPT == 'perl':
-            trainset = PERL_TRAINSET
-            testset = PERL_TESTSET
+def _remove_path(path):
+    import shutil
+    try:
+        if os.path.isdir(path):
+            shutil.rmtree(path)
         else:
-            raise AssertionError('foldscript=%r not understood' % FOLDSCRIPT)
+            os.unlink(path)
+    except OSError:
+        # removed by a concurrent run
+        pass
 
-        trainset = trainset.replace('KFOLDS', str(kfold)).replace('VW', vw_filename)
-        testset = testset.replace('KFOLDS', str(kfold)).replace('VW', vw_filename)
 
-    model_prefix = get_temp_filename('model') + '.$fold'
-    model_filename = model_prefix + '.bin' if testset else None
+def link_or_copy(source, destination):
+    """
+    Hard-link source to destination if it is a temp file of this run, copy it otherwise.
 
-    if with_predictions:
-        p_filename = '%s.predictions' % model_prefix
-    else:
-        p_filename = None
+    Files named by the user are always copied: writing them later (e.g. converting something else into the same path)
+    would change source as well.
+    """
+    if TMP_PREFIX and os.path.dirname(os.path.abspath(destination)) == os.path.abspath(TMP_PREFIX):
+        try:
+            os.link(source, destination)
+            return
+        except OSError:
+            pass
+    concatenate_files([source], destination)
 
-    if with_raw_predictions:
-        r_filename = '%s.raw' % model_prefix
-    else:
-        r_filename = None
 
-    if calc_num_features:
-        readable_model = model_prefix + '.readable'
-    else:
-        readable_model = None
+class PersistentCache(object):
+    """Directory of entries that outlive the run, with LRU eviction by total size.
 
-    cleanup_tmpl = []
+    Entries are published by renaming a complete copy into place, so concurrent runs can share the directory.
+    """
 
-    base_training_command = get_vw_command(
-        cleanup_tmpl,
-        trainset,
-        vw_args=vw_args,
-        final_regressor=model_filename,
-        predictions=None if testset else p_filename,
-        raw_predictions=None if testset else r_filename,
-        readable_model=readable_model,
-        fix_cache_file=kfold > 1,
-        name='train' if testset else 'test')
+    def __init__(self, root, max_size):
+        self.root = root
+        self.max_size = max_size
+        if not os.path.exists(root):
+            try:
+                os.mkdir(root)
+            except OSError:
+                if not os.path.isdir(root):
+                    raise
 
-    for item in base_training_command:
-        if capture_output is True or item['name'] in capture_output:
-            item['stderr'] = subprocess.PIPE
-        else:
-            item['args'] += ' --quiet'
+    def get_path(self, key, suffix=''):
+        return os.path.join(self.root, key + suffix)
 
-    if testset:
-        testing_command = get_vw_command(
-            cleanup_tmpl,
-            testset,
-            vw_args=vw_test_args,
-            initial_regressor=model_filename,
-            predictions=p_filename,
-            raw_predictions=r_filename,
-            only_test=True,
-            fix_cache_file=kfold > 1,
-            name='test')
-
-        if capture_output is True or 'test' in capture_output:
-            testing_command['stderr'] = subprocess.PIPE
-        else:
-            testing_command['args'] += ' --quiet'
+    def lookup(self, key, suffix=''):
+        path = self.get_path(key, suffix)
+        try:
+            # mtime is used as last access time for eviction
+            os.utime(path, None)
+        except OSError:
+            return None
+        return path
 
-        base_training_command.append(testing_command)
+    def publish(self, filename, key, suffix=''):
+        path = self.get_path(key, suffix)
+        tmp_path = '%s.%s.tmp' % (path, os.getpid())
+        try:
+            # a copy of its own, filename can be overwritten later
+            concatenate_files([filename], tmp_path)
+            os.rename(tmp_path, path)
+        except (OSError, IOError), ex:
+            log('Failed to publish %s to %s: %s', filename, path, ex)
+            _remove_path(tmp_path)
+            return None
+        self.evict()
+        return path
 
-    for item in base_training_command:
-        log("+ %s", item['args'])
+    def evict(self):
+        entries = []
+        total_size = 0
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            try:
+                size = _path_size(path)
+                mtime = os.path.getmtime(path)
+            except OSError:
+                continue
+            entries.append((mtime, size, path))
+            total_size += size
+        entries.sort()
+        for mtime, size, path in entries:
+            if total_size <= self.max_size:
+                break
+            log('Evicting %s from cache', path)
+            _remove_path(path)
+            total_size -= size
+
+
+CONVERT_CACHE = None
+
+
+def get_conversion_cache_key(source, format, columnspec, named_labels, remap_label, weights, preprocessor, ignoreheader, dedup=False):
+    import hashlib
+    preprocessor = get_preprocessor(preprocessor)
+    settings = [
+        __version__,
+        [file_fingerprint(x) for x in source] if isinstance(source, list) else file_fingerprint(source),
+        format,
+        columnspec,
+        sorted(named_labels) if named_labels else None,
+        sorted((remap_label or {}).items()),
+        sorted((weights or {}).items()),
+        str(preprocessor) if preprocessor else '',
+        bool(ignoreheader),
+    ]
+    if dedup:
+        # keeps the keys of the other conversions as they were
+        settings.append('dedup')
+    return hashlib.sha1(json.dumps(settings)).hexdigest()
 
-    commands = []
 
-    for this_fold in xrange(1, kfold + 1):
-        this_fold = str(this_fold)
-        training_command = deque([x.copy() for x in base_training_command])
-        for cmd in training_command:
-            cmd['args'] = cmd['args'].replace('$fold', this_fold)
-        commands.append(training_command)
+class ColumnStore(object):
+    """Rows of a parsed csv/tsv/tab file, stored column by column so that readers load only the columns they need.
 
-        for filename in [model_filename, p_filename, r_filename, readable_model] + cleanup_tmpl:
-            if not filename:
+    Column N is kept as N.data, the cells concatenated, and N.offsets, int64 offsets of the cell ends preceded by 0.
+    Rows can have different numbers of cells; their lengths are kept in lengths (int32). Everything is memory-mapped.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        meta = json.load(open(os.path.join(path, 'meta.json')))
+        self.rows = meta['rows']
+        self.columns = meta['columns']
+        self.lengths = self._load_array('lengths', np.int32)
+        self._loaded = {}
+
+    def _load_array(self, name, dtype):
+        filename = os.path.join(self.path, name)
+        if not os.path.getsize(filename):
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(filename, dtype=dtype, mode='r')
+
+    def _load_column(self, index):
+        if index not in self._loaded:
+            import mmap
+            offsets = self._load_array('%s.offsets' % index, np.int64)
+            data = ''
+            fobj = open(os.path.join(self.path, '%s.data' % index), 'rb')
+            try:
+                if os.fstat(fobj.fileno()).st_size:
+                    data = mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ)
+            finally:
+                fobj.close()
+            self._loaded[index] = (data, offsets)
+        return self._loaded[index]
+
+    def get_cells(self, index, start, end):
+        """Cells of column index in rows [start, end), '' for the rows that are too short to have one"""
+        data, offsets = self._load_column(index)
+        offsets = offsets[start:end + 1].tolist()
+        base = offsets[0]
+        blob = data[base:offsets[-1]]
+        return [blob[x - base:y - base] for (x, y) in izip(offsets, offsets[1:])]
+
+    def iter_rows(self, start=0, end=None, columns=None):
+        """Yield rows [start, end) as lists. If columns is a set of indices, cells of other columns are left empty."""
+        from itertools import repeat
+        if end is None:
+            end = self.rows
+        for batch_start in xrange(start, end, COLUMN_STORE_BATCH):
+            batch_end = min(end, batch_start + COLUMN_STORE_BATCH)
+            lengths = self.lengths[batch_start:batch_end]
+            if not self.columns:
+                for _length in lengths:
+                    yield []
                 continue
-            filename = filename.replace('$fold', this_fold)
-            assert not os.path.exists(filename), filename
-            to_cleanup.append(filename)
+            cells = [self.get_cells(index, batch_start, batch_end) if columns is None or index in columns else repeat('')
+                     for index in xrange(self.columns)]
+            if (lengths == self.columns).all():
+                for row in map(list, izip(*cells)):
+                    yield row
+            else:
+                for row, length in izip(izip(*cells), lengths.tolist()):
+                    yield list(row[:length])
+
+
+class ColumnStoreWriter(object):
+    """Builds ColumnStore in a temp directory that publish() renames to path"""
+
+    def __init__(self, path):
+        self.path = path
+        self.tmp_path = '%s.%s.tmp' % (path, os.getpid())
+        os.mkdir(self.tmp_path)
+        self.rows = 0
+        self.lengths = self._open('lengths')
+        # [data file, offsets file, offset of the data end]
+        self.columns = []
+
+    def _open(self, name):
+        return open(os.path.join(self.tmp_path, name), 'wb')
+
+    def _add_column(self):
+        index = len(self.columns)
+        offsets = self._open('%s.offsets' % index)
+        # the rows stored so far do not have this column
+        np.zeros(self.rows + 1, dtype=np.int64).tofile(offsets)
+        self.columns.append([self._open('%s.data' % index), offsets, 0])
+
+    def add(self, rows):
+        lengths = np.array([len(row) for row in rows], dtype=np.int32)
+        if not len(lengths):
+            return
+        while len(self.columns) < lengths.max():
+            self._add_column()
+        lengths.tofile(self.lengths)
+        shortest = lengths.min()
+        for index, column in enumerate(self.columns):
+            if index < shortest:
+                cells = map(operator.itemgetter(index), rows)
+            else:
+                cells = [row[index] if index < len(row) else '' for row in rows]
+            column[0].write(''.join(cells))
+            ends = np.cumsum([len(cell) for cell in cells], dtype=np.int64) + column[2]
+            ends.tofile(column[1])
+            column[2] = int(ends[-1])
+        self.rows += len(rows)
+
+    def _close(self):
+        files = [self.lengths] + [fobj for column in self.columns for fobj in column[:2]]
+        for fobj in files:
+            if not fobj.closed:
+                fobj.close()
+
+    def publish(self):
+        self._close()
+        with open(os.path.join(self.tmp_path, 'meta.json'), 'w') as fobj:
+            json.dump({'rows': self.rows, 'columns': len(self.columns)}, fobj)
+        try:
+            os.rename(self.tmp_path, self.path)
+        except OSError, ex:
+            # e.g. published by a concurrent run
+            log('Failed to publish %s: %s', self.path, ex)
+        self.abort()
+
+    def abort(self):
+        self._close()
+        if os.path.exists(self.tmp_path):
+            _remove_path(self.tmp_path)
+
+
+def get_column_store_path(source, format, ignoreheader):
+    """Location of the column store of source in the --convert_cache directory, None if it cannot have one"""
+    import hashlib
+    if CONVERT_CACHE is None or format not in ('csv', 'tsv', 'tab'):
+        return None
+    if not isinstance(source, basestring) or not os.path.isfile(source):
+        return None
+    if TMP_PREFIX and os.path.dirname(os.path.abspath(source)) == os.path.abspath(TMP_PREFIX):
+        # copies of stdin and batches of this run are not read again
+        return None
+    key = hashlib.sha1(json.dumps([__version__, file_fingerprint(source), format, bool(ignoreheader)])).hexdigest()
+    return CONVERT_CACHE.get_path(key, '.columns')
 
-        if p_filename:
-            p_filenames.append(p_filename.replace('$fold', this_fold))
 
-        if r_filename:
-            r_filenames.append(r_filename.replace('$fold', this_fold))
+def get_column_store(source, format, ignoreheader):
+    path = get_column_store_path(source, format, ignoreheader)
+    if path is None or not CONVERT_CACHE.lookup(os.path.basename(path)):
+        return None
+    try:
+        store = ColumnStore(path)
+    except (IOError, OSError, ValueError), ex:
+        log('Cannot use %s: %s', path, ex)
+        return None
+    log('Reading %s from %s', source, path)
+    return store
 
-        if readable_model:
-            readable_models.append(readable_model.replace('$fold', this_fold))
 
+def _store_rows(rows, path):
+    writer = ColumnStoreWriter(path)
     try:
-        success, outputs = run_subprocesses(commands, workers=workers, importance=-1)
+        while True:
+            batch = list(islice(rows, COLUMN_STORE_BATCH))
+            if not batch:
+                break
+            writer.add(batch)
+            for row in batch:
+                yield row
+        writer.publish()
+        if CONVERT_CACHE is not None:
+            CONVERT_CACHE.evict()
+    finally:
+        # the reader might have stopped early
+        writer.abort()
 
-        # check outputs first, the might be a valuable error message there
-        outputs = dict((key, [parse_vw_output(out) for out in value]) for (key, value) in outputs.items())
 
-        if not success:
-            vw_failed()
+def open_rows(source, format, ignoreheader, columns=None):
+    """
+    Like open_anything(), but the rows of csv/tsv/tab files are read from their column store if --convert_cache has one.
+    Then only the cells of the given columns (set of indices, None for all) are filled in.
 
-        for name in to_cleanup:
-            if not os.path.exists(name):
-                vw_failed('missing %r' % (name, ))
+    Otherwise, when --convert_cache is enabled, the column store is built on the way and published once all rows are read.
+    """
+    if isinstance(source, list):
+        from itertools import chain
+        return chain.from_iterable(open_rows(shard, format, ignoreheader, columns) for shard in source)
+    store = get_column_store(source, format, ignoreheader)
+    if store is not None:
+        return store.iter_rows(columns=columns)
+    rows = open_anything(source, format, ignoreheader=ignoreheader)
+    path = get_column_store_path(source, format, ignoreheader)
+    if path is not None:
+        return _store_rows(rows, path)
+    return rows
+
+
+def get_used_columns(columnspec):
+    """
+    Return indices of the columns that conversion with columnspec needs, None if it needs all of them
 
-        predictions = []
-        for items in izip_longest(*[open(x) for x in p_filenames]):
-            predictions.extend([float(x.split()[0]) for x in items if x is not None])
+    >>> sorted(get_used_columns(['y', 'drop', 'text', '', 'weight_metric', 'info']))
+    [0, 2, 5]
+    >>> get_used_columns(['y', 'text', '*'])
+    """
+    if columnspec is None or '*' in columnspec:
+        return None
+    return set(index for (index, spec) in enumerate(columnspec) if spec not in ('drop', '', 'weight_metric'))
 
-        if predictions:
-            if np.equal(0, np.max(np.abs(np.mod(predictions[:10000], 1)))):
-                predictions = np.array(predictions, dtype=int)
-            else:
-                predictions = np.array(predictions)
 
-        raw_predictions = []
-        for items in izip_longest(*[open(x) for x in r_filenames]):
-            raw_predictions.extend([x for x in items if x is not None])
+def _workers(workers):
+    if workers is not None and workers <= 1:
+        return 1
+    if workers is None or workers <= 0:
+        import multiprocessing
+        return 1 + multiprocessing.cpu_count()
+    return workers
 
-        num_features = [get_num_features(name) for name in readable_models]
 
-        return predictions, raw_predictions, num_features, outputs
+def die_if_parent_dies(signum=9):
+    if 'linux' not in sys.platform:
+        return
+    try:
+        import ctypes
+        libc = ctypes.CDLL('libc.so.6', use_errno=True)
+        PR_SET_PDEATHSIG = 1
+        result = libc.prctl(PR_SET_PDEATHSIG, signum)
+        if result == 0:
+            return True
+        else:
+            log('prctl failed: %s', os.strerror(ctypes.get_errno()))
+    except StandardError, ex:
+        sys.stderr.write(str(ex) + '\n')
 
-    finally:
-        unlink(*to_cleanup)
 
+def get_command_name(params):
+    if not isinstance(params, dict):
+        return str(params)
+    name = params.get('name', None)
+    args = params.get('args')
 
-def extract_test_args(vw_args):
-    if isinstance(vw_args, basestring):
-        vw_args = vw_args.split()
+    if isinstance(args, list):
+        args = ' '.join(args)
 
-    test_args = []
+    if name:
+        return '[%s] %s' % (name, args)
+    else:
+        return str(args)
 
-    loss_function = read_argument(vw_args, '--loss_function')
 
-    if loss_function:
-        test_args.append('--loss_function ' + loss_function)
+# held while starting processes, so that descriptors being made non-inheritable are not leaked into them (see open_fifo_writer)
+SPAWN_LOCK = threading.Lock()
 
-    test_opts = [
-        '--probabilities',
-        '--onethread',
-    ]
 
-    for opt in test_opts:
-        if opt in vw_args:
-            test_args.append(opt)
+def Popen(params, **kwargs):
+    command_name = get_command_name(params)
 
-    return ' '.join(test_args)
+    if isinstance(params, dict):
+        params = params.copy()
+        args = params.pop('args')
+        params.pop('name', None)
+        params.update(kwargs)
+    else:
+        args = params
+        params = kwargs
 
+    importance = params.pop('importance', None)
+    if importance is None:
+        importance = 0
 
-def vw_validation(
-        to_cleanup,
-        vw_filename,
-        vw_validation_filename,
-        vw_args,
-        vw_test_args,
-        workers=None,
-        with_predictions=False,
-        with_raw_predictions=False,
-        calc_num_features=False,
-        capture_output=False):
+    params.setdefault('preexec_fn', die_if_parent_dies)
 
-    assert os.path.exists(vw_validation_filename), vw_validation_filename
+    log('+ %s', command_name, importance=importance)
 
-    if hasattr(capture_output, '__contains__') and '' in capture_output:
-        capture_output = True
+    with SPAWN_LOCK:
+        popen = subprocess.Popen(args, **params)
+    return popen
 
-    vw_args = vw_args.replace('--quiet', '')
-    model_prefix = get_temp_filename('model')
-    model_filename = model_prefix + '.bin'
-    to_cleanup.append(model_filename)
 
-    if with_predictions:
-        p_filename = '%s.predictions' % model_prefix
-        to_cleanup.append(p_filename)
-    else:
-        p_filename = None
+def start_output_readers(popen):
+    """Read the captured stdout and stderr of popen from threads, so that it never blocks on a full pipe while nobody waits for it"""
+    popen._readers = []
+    for fobj in (popen.stdout, popen.stderr):
+        if fobj is not None:
+            chunks = []
+            reader = threading.Thread(target=lambda fobj=fobj, chunks=chunks: chunks.append(fobj.read()))
+            reader.daemon = True
+            reader.start()
+            popen._readers.append((reader, chunks))
 
-    if with_raw_predictions:
-        r_filename = '%s.raw' % model_prefix
-        to_cleanup.append(r_filename)
-    else:
-        r_filename = None
 
-    if calc_num_features:
-        readable_model = model_prefix + '.readable'
-        to_cleanup.append(readable_model)
-    else:
-        readable_model = None
+def join_output_readers(popen):
+    """Return the output collected by start_output_readers(popen)"""
+    result = []
+    for reader, chunks in popen._readers:
+        reader.join()
+        result.extend(chunks)
+    return ''.join(result)
 
-    command = get_vw_command(
-        to_cleanup,
-        vw_filename,
-        vw_args=vw_args,
-        final_regressor=model_filename,
-        predictions=None,
-        raw_predictions=None,
-        readable_model=readable_model,
-        fix_cache_file=True,
-        name='train')
 
-    for item in command:
-        if capture_output is True or item['name'] in capture_output:
-            item['stderr'] = subprocess.PIPE
+def run_subprocesses(cmds, workers=None, importance=None, wait_any=False):
+    for item in cmds:
+        if isinstance(item, deque):
+            for subitem in item:
+                assert isinstance(subitem, dict), subitem
         else:
-            item['args'] += ' --quiet'
-
-    training_out = system(command, importance=-1, repeat_on_error=1)
+            assert isinstance(item, dict), item
 
+    workers = _workers(workers)
+    cmds_queue = deque(cmds)
+    queue = deque()
+    success = False
     outputs = {}
-    if training_out:
-        outputs['train'] = [parse_vw_output(training_out)]
 
-    testing_command = get_vw_command(
-        to_cleanup,
-        vw_validation_filename,
-        vw_args=vw_test_args,
-        initial_regressor=model_filename,
-        predictions=p_filename,
-        raw_predictions=r_filename,
-        only_test=True,
-        name='test')
+    try:
+        while queue or cmds_queue:
+            if cmds_queue and len(queue) <= workers:
+                cmd = cmds_queue.popleft()
 
-    if capture_output is True or 'test' in capture_output:
-        testing_command['stderr'] = subprocess.PIPE
-    else:
-        testing_command['args'] += ' --quiet'
+                if isinstance(cmd, deque):
+                    this_cmd = cmd.popleft()
+                    followup = cmd
+                else:
+                    this_cmd = cmd
+                    followup = None
 
-    validation_out = system(testing_command, importance=-1, repeat_on_error=1)
-    if validation_out:
-        outputs['test'] = [parse_vw_output(validation_out)]
+                popen = Popen(this_cmd, shell=True, importance=importance)
+                popen._cmd = this_cmd
+                popen._name = this_cmd.get('name', '')
+                popen._followup = followup
+                if wait_any:
+                    start_output_readers(popen)
+                queue.append(popen)
+            else:
+                if wait_any:
+                    # commands fed by the same reader (--foldscript fanout) wait for each other,
+                    # so a failed one has to be noticed before waiting for the rest
+                    popen = next((x for x in queue if x.poll() is not None), None)
+                    if popen is None:
+                        time.sleep(0.01)
+                        continue
+                    queue.remove(popen)
+                else:
+                    popen = queue.popleft()
 
-    for name in to_cleanup:
-        if not os.path.exists(name):
-            vw_failed('missing %r' % (name, ))
+                if wait_any:
+                    if popen._readers:
+                        outputs.setdefault(popen._name, []).append(join_output_readers(popen))
+                elif popen.stdout is not None or popen.stderr is not None:
+                    out, err = popen.communicate()
+                    out = (out or '') + (err or '')
+                    outputs.setdefault(popen._name, []).append(out)
 
-    if p_filename:
-        predictions = []
-        for line in open(p_filename):
-            predictions.append(float(line.split()[0]))
-        predictions = np.array(predictions)
-    else:
-        predictions = []
+                retcode = popen.wait()
 
-    if r_filename:
-        raw_predictions = open(r_filename).readlines()
-    else:
-        raw_predictions = []
+                if retcode:
+                    log_always('failed: %s', popen._cmd.get('args', get_command_name(popen._cmd)))
+                    return None, outputs
+                else:
+                    log('%s %s', '-' if retcode == 0 else '!', get_command_name(popen._cmd), importance=importance)
 
-    if readable_model:
-        num_features = get_num_features(readable_model)
-    else:
-        num_features = None
+                if popen._followup:
+                    cmds_queue.append(popen._followup)
 
-    return predictions, raw_predictions, num_features, outputs, model_filename
+        success = True
 
+    finally:
+        if not success:
+            kill(*queue, verbose=True)
 
-def get_num_features(filename):
-    counting = False
-    count = 0
-    for line in open(filename):
-        if counting:
-            count += 1
-        else:
-            if line.strip() == ':0':
-                counting = True
-    return count
+    return success, outputs
 
 
-def parse_vw_output(output):
-    result = {}
-    for line in output.split('\n'):
-        if line.count(' = ') == 1:
-            key, value = line.split(' = ')
-            key = key.replace(' ', '_').replace("'", '').lower()
-            result[key] = value
-        else:
-            if re.search(VOWPAL_WABBIT_ERRORS, line.lower()):
-                sys.exit('vw failed: %s' % line.strip())
-    return result
+def _as_dict(lst, name):
+    if isinstance(lst, list):
+        lst = ' '.join(lst).strip()
+        lst = re.sub('\s+', ' ', lst)
+    return {'args': lst, 'shell': True, 'name': name}
 
 
-def _load_predictions(file, size=None, with_text=False, named_labels=None, with_weights=False, examples=None):
-    filename = file
-    if isinstance(file, list):
-        filename = file
-    elif hasattr(file, 'read'):
-        pass
-    elif isinstance(file, basestring):
-        if file in STDOUT_NAMES:
-            sys.exit('Will not read %s' % file)
-        file = open_regular_or_compressed(file)
-    else:
-        raise AssertionError(limited_repr(file))
+def get_vw_version(cache=[]):
+    """Version reported by vw, detected once per run. None if vw could not be run."""
+    if not cache:
+        try:
+            popen = subprocess.Popen('%s --version' % VW_CMD, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            out, _err = popen.communicate()
+            cache.append(out.strip() if popen.returncode == 0 and out.strip() else None)
+        except OSError:
+            cache.append(None)
+        log('vw version = %s', cache[0], importance=-1)
+    return cache[0]
+
 
+def get_vw_cache_args(vw_args):
+    """Options of vw_args that can change the contents of vw's cache file
+
+    >>> get_vw_cache_args('-b 20 --l1=1e-7 --oaa 3 -c -k --passes 10 -q ab --ignore c --quiet'.split())
+    ['-b', '20', '--oaa', '3', '--ignore', 'c']
+    """
     result = []
-    result_text = []
-    importance_weights = [] if with_weights else None
+    skip_value = False
+    for arg in vw_args:
+        if not arg.startswith('-'):
+            if not skip_value:
+                result.append(arg)
+            skip_value = False
+            continue
+        name = arg.split('=', 1)[0]
+        skip_value = name in VW_LEARNING_OPTIONS and '=' not in arg
+        if name not in VW_LEARNING_FLAGS and name not in VW_LEARNING_OPTIONS:
+            result.append(arg)
+    return result
 
-    for line in file:
-        try:
-            text = line.strip()
-            if with_text:
-                result_text.append(text)
-            items = text.split()
-            label = items[0]
-            if importance_weights is not None:
-                if len(items) >= 2:
-                    w = items[1]
-                    if w.startswith("'") or '|' in w:
-                        w = 1.0
-                    else:
-                        w = float(w)
-                    importance_weights.append(w)
-            if named_labels is not None:
-                if label not in named_labels:
-                    sys.exit('Unexpected label %r from %r' % (label, filename))
-                result.append(label)
-            else:
-                result.append(float(label))
-        except:
-            sys.stderr.write('Error while parsing %r\nin %r\n' % (line, limited_repr(filename)))
-            raise
 
-        if examples is not None and len(result) >= examples:
-            break
+# (filename, vw cache arguments, vw version) -> (filename, path to the cache file or None if it could not be built)
+PREBUILT_VW_CACHES = {}
+PREBUILT_VW_CACHES_LOCK = threading.Lock()
 
-    if size is not None:
-        if len(result) < size:
-            sys.exit('Too few items in %s: found %r, expecting %r' % (limited_repr(filename), len(result), size))
 
-        if len(result) > size:
-            mult = int(len(result) / size)
-            if size * mult == len(result):
-                # if --passes N option was used, then the number of predictions will be N times higher
-                result = result[-size:]
-            else:
-                sys.exit('Too many items in %s: found %r, expecting multiply of %r' % (limited_repr(filename), len(result), size))
+def get_prebuilt_vw_cache(filename, vw_args, locks={}):
+    """
+    Return vw's cache file for filename (or shell pipeline that outputs the data, such as training set of a fold),
+    for use by all vw runs with vw_args, whatever their learning options.
 
-    retvalue = [np.array(result)]
+    The cache is built once per distinct set of the options that affect it, by a vw run that does no learning.
+    With --convert_cache, it is also kept for later runs. Returns None if it could not be built.
+    """
+    version = get_vw_version()
+    if version is None:
+        return None
 
-    if with_text:
-        retvalue.append(result_text)
+    compressed = ['--compressed'] if '--compressed' in vw_args else []
+    cache_args = get_vw_cache_args(vw_args)
+    key = json.dumps([filename if '|' in filename else os.path.abspath(filename), cache_args, version])
 
-    if with_weights:
-        if not importance_weights:
-            retvalue.append(None)
-        else:
-            if len(importance_weights) != len(result):
-                sys.exit('Could not parse importance weights')
-            importance_weights = np.array(importance_weights)
-            retvalue.append(importance_weights)
+    with PREBUILT_VW_CACHES_LOCK:
+        lock = locks.setdefault(key, threading.Lock())
 
-    if len(retvalue) == 1:
-        return retvalue[0]
+    # concurrent trials wait for the first one to build it
+    with lock:
+        if key not in PREBUILT_VW_CACHES:
+            PREBUILT_VW_CACHES[key] = (filename, build_vw_cache(filename, cache_args + compressed, version))
+        return PREBUILT_VW_CACHES[key][1]
 
-    return tuple(retvalue)
 
+def build_vw_cache(filename, vw_args, version):
+    import hashlib
+    cache_file = get_temp_filename('vwcache')
 
-class BaseParam(object):
+    if '|' in filename:
+        # pipelines read temp files, such as fold files, which do not outlive this run
+        data_source = '%s %s' % (filename, VW_CMD)
+        persistent_key = None
+    else:
+        data_source = '%s -d %s' % (VW_CMD, quote(filename))
+        persistent_key = hashlib.sha1(json.dumps([file_fingerprint(filename), vw_args, version])).hexdigest()
 
-    PRINTABLE_KEYS = 'opt init min max values format extra omit'.split()
-    _cast = None
+    if CONVERT_CACHE is not None and persistent_key:
+        cached = CONVERT_CACHE.lookup(persistent_key, '.vwcache')
+        if cached:
+            log('Reusing cached vw cache of %s', filename)
+            link_or_copy(cached, cache_file)
+            return cache_file
 
-    @classmethod
-    def cast(cls, value):
-        if value is None:
-            return None
-        if value == '':
-            return None
-        if cls._cast is None:
-            return value
-        return cls._cast(value)
+    start = time.time()
+    command = '%s --cache_file %s -k --noop --quiet %s' % (data_source, cache_file, ' '.join(vw_args))
+    popen = Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, importance=-1)
+    out, _err = popen.communicate()
 
-    def pack(self, value):
-        if self._pack is None:
-            return value
-        return self._pack(value)
+    if popen.wait() or not os.path.exists(cache_file):
+        log_always('Failed to build vw cache of %s, vw will parse it on every run: %s', filename, out.strip())
+        unlink(cache_file)
+        return None
 
-    def unpack(self, value):
-        if self._unpack is None:
-            return value
-        return self._unpack(value)
+    log('Built vw cache of %s in %.1f seconds', filename, time.time() - start)
 
-    def __init__(self, opt, init=None, min=None, max=None, format=None, pack=None, unpack=None, extra=None, omit=None, merge=False):
-        self.opt = opt
-        self.init = self.cast(init)
-        self.min = self.cast(min)
-        self.max = self.cast(max)
-        self.format = format
-        self._pack = pack
-        self._unpack = unpack
-        self.extra = None
-        self.omit = omit
-        self.separator = '' if merge else ' '
+    if CONVERT_CACHE is not None and persistent_key:
+        CONVERT_CACHE.publish(cache_file, persistent_key, '.vwcache')
 
-    def avg(self, a, b):
-        result = self.cast(self.unpack((self.pack(self.min) + self.pack(self.max)) / 2.0))
-        if self.format:
-            result = self.format % result
-            result = self.cast(result)
-        return result
+    return cache_file
 
-    def __repr__(self):
-        klass = type(self).__name__
-        items = []
-        for name in self.PRINTABLE_KEYS:
-            value = getattr(self, name, None)
-            if value is not None:
-                items.append('%s=%r' % (name, value))
-        return klass + '(' + ', '.join(items) + ')'
 
-    def packed_init(self):
-        init = self.init
-        if init is None:
-            init = self.avg(self.min, self.max)
-        init = self.pack(init)
-        return init
+def remove_prebuilt_vw_caches(filenames=None):
+    """Remove cache files built for filenames, for all files if filenames is None"""
+    with PREBUILT_VW_CACHES_LOCK:
+        for key, (filename, cache_file) in PREBUILT_VW_CACHES.items():
+            if filenames is None or filename in filenames:
+                del PREBUILT_VW_CACHES[key]
+                if cache_file:
+                    unlink(cache_file)
 
-    def get_extra_args(self, param):
-        if param is None or param == '':
-            return None
-        param = self.unpack(param)
-        if self.min is not None and param <= self.min:
-            param = self.min
-        elif self.max is not None and param >= self.max:
-            param = self.max
-        param = self.cast(param)
-        format = self.format or '%s'
-        extra_arg = format % param
-        return self.opt + self.separator + extra_arg + ' '.join(self.extra or [])
 
+# (fingerprint of the data, kfold, FOLD_ASSIGN, FOLD_SEED) -> (filename, [(fold filename, number of examples)], [(training set, test set)])
+FOLD_STORES = {}
+# (fingerprint of the data, kfold, FOLD_ASSIGN, FOLD_SEED) -> (filename, fold of each example, file with the fold of each example)
+FOLD_INDEXES = {}
+FOLD_STORES_LOCK = threading.Lock()
 
-class IntegerParam(BaseParam):
-    _cast = int
 
+def get_fold_key(vw_filename, kfold):
+    if isinstance(vw_filename, list):
+        fingerprint = [file_fingerprint(x) for x in vw_filename]
+    else:
+        fingerprint = file_fingerprint(vw_filename)
+    return json.dumps([fingerprint, kfold, FOLD_ASSIGN, FOLD_SEED])
 
-class RandIntParam(BaseParam):
-    _cast = int
 
+def read_vw_labels(vw_filename):
+    """Label (first item of the label section) of each line of vw_filename (or list of shards), '' if there is none"""
+    labels = []
+    for lines in read_vw_lines(vw_filename, None):
+        labels.extend([(line.split('|', 1)[0].split() or [''])[0] for line in lines])
+    return labels
 
-class FloatParam(BaseParam):
-    _cast = float
 
+def assign_folds(count, kfold, seed, labels=None):
+    """
+    Return fold (counting from 0) of each of count examples, shuffled, as int8 array.
 
-class LogParam(BaseParam):
-    _cast = float
+    The folds get the same number of examples, give or take one, and so do they get of each label if labels are given.
 
-    def __init__(self, opt, **kwargs):
-        BaseParam.__init__(self, opt, pack=np.log, unpack=np.exp, **kwargs)
+    >>> map(int, np.bincount(assign_folds(10, 3, 0)))
+    [4, 3, 3]
+    >>> folds = assign_folds(6, 2, 1, labels=['a', 'b', 'a', 'a', 'b', 'a'])
+    >>> map(int, np.bincount(folds[[0, 2, 3, 5]])), map(int, np.bincount(folds[[1, 4]]))
+    ([2, 2], [1, 1])
+    """
+    assert kfold <= np.iinfo(np.int8).max, kfold
+    order = np.random.RandomState(seed).permutation(count)
+    if labels is not None:
+        # examples of each label go one after another, so that dealing them out spreads each label evenly
+        _values, codes = np.unique(labels, return_inverse=True)
+        order = order[np.argsort(codes[order], kind='mergesort')]
+    result = np.empty(count, dtype=np.int8)
+    result[order] = np.arange(count) % kfold
+    return result
 
 
-class ValuesParam(BaseParam):
+def get_fold_index(vw_filename, kfold, locks={}):
+    """
+    Return (fold of each example of vw_filename counting from 0, file with the fold counting from 1 on each line).
 
-    def __init__(self, opt, values, **kwargs):
-        BaseParam.__init__(self, opt, **kwargs)
-        self.values = values
+    Returns (None, None) for --foldassign mod, with which example number N goes into fold (N - 1) % kfold + 1.
+    """
+    if FOLD_ASSIGN == 'mod':
+        return None, None
+
+    key = get_fold_key(vw_filename, kfold)
+
+    with FOLD_STORES_LOCK:
+        lock = locks.setdefault(key, threading.Lock())
+
+    with lock:
+        if key not in FOLD_INDEXES:
+            if FOLD_ASSIGN == 'stratified':
+                labels = read_vw_labels(vw_filename)
+                fold_index = assign_folds(len(labels), kfold, FOLD_SEED, labels=labels)
+            elif FOLD_ASSIGN == 'random':
+                count = sum(len(lines) for lines in read_vw_lines(vw_filename, None))
+                fold_index = assign_folds(count, kfold, FOLD_SEED)
+            else:
+                raise AssertionError('foldassign=%r not understood' % FOLD_ASSIGN)
+            index_filename = get_temp_filename('folds')
+            np.savetxt(index_filename, fold_index + 1, fmt='%d')
+            FOLD_INDEXES[key] = (vw_filename, fold_index, index_filename)
+        return FOLD_INDEXES[key][1:]
 
-    def enumerate_all(self):
-        return [self.get_extra_args(x) for x in self.values]
 
+def iter_fold_lines(vw_filename, kfold, fold_index, is_test):
+    """
+    For each chunk of vw_filename (or list of shards), yield the lines of it that go to the test set (if is_test)
+    or to the training set of each fold, fold_index being as returned by get_fold_index()
+    """
+    # index of the first line of the chunk within the data
+    position = 0
+    for lines in read_vw_lines(vw_filename, None):
+        result = []
+        if fold_index is None:
+            for fold in xrange(kfold):
+                first = (fold - position) % kfold
+                if is_test:
+                    fold_lines = lines[first::kfold]
+                else:
+                    fold_lines = lines[:]
+                    del fold_lines[first::kfold]
+                result.append(fold_lines)
+        else:
+            chunk_folds = fold_index[position:position + len(lines)]
+            if len(chunk_folds) != len(lines):
+                sys.exit('%s changed while being split into folds' % (vw_filename, ))
+            for fold in xrange(kfold):
+                selected = chunk_folds == fold if is_test else chunk_folds != fold
+                result.append([lines[index] for index in np.flatnonzero(selected).tolist()])
+        position += len(lines)
+        yield result
 
-class BinaryParam(BaseParam):
 
-    def __init__(self, opt, **kwargs):
-        BaseParam.__init__(self, opt, **kwargs)
+def get_fold_sets(vw_filename, kfold, locks={}):
+    """
+    Return (training set, test set) of each fold of vw_filename (or list of shards), read from its fold files.
 
-    def enumerate_all(self):
-        return ['', self.opt]
+    The split is done once per data and kfold and the files are read by all the runs that need these folds.
+    """
+    key = get_fold_key(vw_filename, kfold)
 
-    def get_extra_args(self, param):
-        if param:
-            return self.opt
-        else:
-            return ''
+    with FOLD_STORES_LOCK:
+        lock = locks.setdefault(key, threading.Lock())
 
+    # concurrent trials wait for the first one to split it
+    with lock:
+        if key not in FOLD_STORES:
+            fold_index, index_filename = get_fold_index(vw_filename, kfold)
+            folds = split_into_folds(vw_filename, kfold, fold_index)
+            FOLD_STORES[key] = (vw_filename, folds, make_fold_sets(folds, index_filename))
+        return FOLD_STORES[key][2]
 
-def get_format(value):
-    """
-    >>> get_format("1e-5")
-    '%.0e'
 
-    >>> get_format("1e5")
-    '%.0e'
+def split_into_folds(vw_filename, kfold, fold_index):
+    start = time.time()
+    filenames = [get_temp_vw_filename('fold%s.vw' % fold) for fold in xrange(1, kfold + 1)]
+    counts = [0] * kfold
+    files = [open_output(filename) for filename in filenames]
+    try:
+        for fold_lines in iter_fold_lines(vw_filename, kfold, fold_index, is_test=True):
+            for index, (fobj, lines) in enumerate(izip(files, fold_lines)):
+                if lines:
+                    fobj.write('\n'.join(lines) + '\n')
+                    counts[index] += len(lines)
+        for fobj in files:
+            fobj.close()
+    except BaseException:
+        for fobj in files:
+            fobj.close()
+        unlink(*filenames)
+        raise
 
-    >>> get_format("0.")
-    '%.0f'
+    log('Split %s into %s folds of %s examples in %.1f seconds', vw_filename, kfold, ', '.join(str(x) for x in counts), time.time() - start)
+    return zip(filenames, counts)
 
-    >>> get_format("0.5")
-    '%.1f'
 
-    >>> get_format("0.5")
-    '%.1f'
+def make_fold_sets(folds, index_filename=None):
+    # fold files compressed with --tmpcompress are read through their decompressors
+    compressed = any(get_compression(x[0]) for x in folds)
+    result = []
+    for index, (testset, _count) in enumerate(folds):
+        others = folds[:index] + folds[index + 1:]
+        if len(others) == 1:
+            trainset = others[0][0]
+        elif index_filename:
+            # the fold of each example tells which of the fold files has the next example;
+            # the fold files are taken off the arguments, so that awk only reads the fold index
+            sources = [get_data_pipeline(x[0])[:-2] if compressed else x[0] for x in folds]
+            trainset = "awk -v fold=%s 'BEGIN { for (i = 2; i < ARGC; i++) { files[i - 1] = ARGV[i]; delete ARGV[i] } } $1 != fold { %s; print line }' %s |" % (
+                index + 1, 'files[$1] | getline line' if compressed else 'getline line < files[$1]', ' '.join(quote(x) for x in [index_filename] + sources))
+        elif compressed:
+            # like paste below, takes a line from each of the other folds in turn, until one of them runs out
+            trainset = "awk 'BEGIN { for (n = 0; (ARGV[n %% (ARGC - 1) + 1] | getline line) > 0; n++) print line }' %s |" % (
+                ' '.join(quote(get_data_pipeline(x[0])[:-2]) for x in others))
+        else:
+            # interleaving the other folds line by line restores the original order of the examples;
+            # paste pads exhausted files with empty lines, which can only come last, so head drops them
+            trainset = "paste -d '\\n' %s | head -n %s |" % (' '.join(quote(x[0]) for x in others), sum(x[1] for x in others))
+        result.append((trainset, testset))
+    return result
 
-    >>> get_format("0.50")
-    '%.2f'
 
-    >>> get_format('5')
-    """
-    value = value.lower()
+def remove_fold_stores(filenames=None):
+    """Remove fold files and fold assignments of filenames, of all files if filenames is None"""
+    with FOLD_STORES_LOCK:
+        for key, (filename, folds, fold_sets) in FOLD_STORES.items():
+            if filenames is None or filename in filenames:
+                del FOLD_STORES[key]
+                # vw caches are built for fold files as well as for training sets made of them
+                remove_prebuilt_vw_caches([x[0] for x in folds] + [trainset for (trainset, _testset) in fold_sets])
+                unlink(*[x[0] for x in folds])
+        for key, (filename, _fold_index, index_filename) in FOLD_INDEXES.items():
+            if filenames is None or filename in filenames:
+                del FOLD_INDEXES[key]
+                unlink(index_filename)
 
-    if 'e' in value and '.' not in value:
-        return '%.0e'
 
-    x = value
+def get_fold_positions(counts, fold_index, kfold):
+    """
+    Return positions of the examples of all the folds, one fold after another, or None if counts per fold do not match fold_index.
 
-    if '.' in x:
-        x = x.split('.')[-1]
+    >>> map(int, get_fold_positions([3, 2], None, 2))
+    [0, 2, 4, 1, 3]
+    >>> map(int, get_fold_positions([1, 2], np.array([1, 0, 1], dtype=np.int8), 2))
+    [1, 0, 2]
+    >>> get_fold_positions([1, 2], None, 2) is None
+    True
+    """
+    if fold_index is None:
+        fold_index = np.arange(sum(counts)) % kfold
+    if map(int, np.bincount(fold_index, minlength=kfold)) != list(counts):
+        return None
+    return np.argsort(fold_index, kind='mergesort')
+
+
+def load_predictions(filename):
+    """First column of vw's predictions file as an array"""
+    import warnings
+    data = open(filename).read()
+    with warnings.catch_warnings():
+        # numpy warns when it stops at something that is not a number
+        warnings.simplefilter('ignore')
+        values = np.fromstring(data, sep=' ')
+    if len(values) != data.count('\n'):
+        # there is more than a number on each line, such as a tag
+        values = np.array([float(line.split()[0]) for line in data.splitlines()])
+    return values
 
-    if 'e' in x:
-        x = x.split('e')[0]
-        return '%%.%se' % len(x)
 
-    if '.' in value:
-        return '%%.%sf' % len(x)
+def make_fanout_fifos(kfold, to_cleanup):
+    """Create named pipes of the training and test sets of each fold for --foldscript fanout, return (training set, test set) of each fold"""
+    result = []
+    for fold in xrange(1, kfold + 1):
+        fifos = (get_temp_filename('fold%s.train.fifo' % fold), get_temp_filename('fold%s.test.fifo' % fold))
+        for fifo in fifos:
+            os.mkfifo(fifo)
+            to_cleanup.append(fifo)
+        result.append(fifos)
+    return result
 
 
-def parse_tuning_args(args):
+def open_fifo_writer(fifo, stop):
     """
-    >>> parse_tuning_args('--lowercase_features?'.split())
-    [BinaryParam(opt='--lowercase_features')]
+    Open named pipe fifo for writing once its reader has opened it, or return None if stop is set before that.
 
-    >>> parse_tuning_args('--onethread --lowercase_features?'.split())
-    ['--onethread', BinaryParam(opt='--lowercase_features')]
+    The descriptor is not inherited by processes started later, they would keep the pipe open after the writer closes it.
     """
-    assert isinstance(args, list), type(args)
-    args = args[:]
-    index = 0
-    while index < len(args):
-        arg = args[index]
-        if arg.startswith('-'):
-            next_arg = args[index + 1] if index + 1 < len(args) else ''
-            if arg.endswith('?'):
-                args[index] = get_tuning_config(arg)
-            elif next_arg.endswith('?') and not next_arg.startswith('-'):
-                args[index:index + 2] = [get_tuning_config(arg + ' ' + next_arg)]
-        index += 1
-    return args
+    import fcntl
+    while not stop.is_set():
+        with SPAWN_LOCK:
+            try:
+                fd = os.open(fifo, os.O_WRONLY | os.O_NONBLOCK)
+            except OSError, ex:
+                if ex.errno != errno.ENXIO:
+                    raise
+                fd = None
+            else:
+                fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+        if fd is None:
+            # no reader yet
+            stop.wait(0.01)
+            continue
+        fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) & ~os.O_NONBLOCK)
+        return os.fdopen(fd, 'wb')
+    return None
 
 
-def get_tuning_config(config):
+def fan_out_folds(vw_filename, kfold, fold_sets, stop, fold_index=None):
     """
-    >>> get_tuning_config('--hash_seed randint(10000)?')
-    RandIntParam(opt='--hash_seed', min=0, max=10000)
+    Stream vw_filename (or list of shards) into the named pipes of fold_sets, as made by make_fanout_fifos().
 
-    >>> get_tuning_config('--lowercase?')
-    BinaryParam(opt='--lowercase')
+    The data is read once for the training sets of all folds, and once more for the test sets, as those are read
+    by vw only after training. Each pipe gets the same examples in the same order as with --foldscript awk.
+    Writing blocks while a reader is behind, so all the readers go at the pace of the slowest one.
+    """
+    for is_test in (False, True):
+        files = []
+        try:
+            for fold_set in fold_sets:
+                fobj = open_fifo_writer(fold_set[is_test], stop)
+                if fobj is None:
+                    return
+                files.append(fobj)
+
+            for fold_lines in iter_fold_lines(vw_filename, kfold, fold_index, is_test):
+                for index, (fobj, lines) in enumerate(izip(files, fold_lines)):
+                    if fobj is None or not lines:
+                        continue
+                    try:
+                        fobj.write('\n'.join(lines) + '\n')
+                    except IOError, ex:
+                        # the reader exited before reading everything, its exit status tells if that is a problem
+                        if ex.errno != errno.EPIPE:
+                            raise
+                        close_quietly(fobj)
+                        files[index] = None
+        finally:
+            for fobj in files:
+                if fobj is not None:
+                    close_quietly(fobj)
 
-    >>> get_tuning_config('--nn 1..10?')
-    IntegerParam(opt='--nn', min=1, max=10)
 
-    >>> get_tuning_config('--nn 1..10??')
-    IntegerParam(opt='--nn', min=1, max=10, omit=True)
+def close_quietly(fobj):
+    try:
+        fobj.close()
+    except IOError, ex:
+        if ex.errno != errno.EPIPE:
+            raise
 
-    >>> get_tuning_config('--nn 0..10?')
-    IntegerParam(opt='--nn', min=0, max=10)
 
-    >>> get_tuning_config('--ngram 2..5?')
-    IntegerParam(opt='--ngram', min=2, max=5)
+def get_vw_command(
+        to_cleanup,
+        source,
+        vw_args='',
+        initial_regressor=None,
+        final_regressor=None,
+        predictions=None,
+        raw_predictions=None,
+        audit=False,
+        readable_model=None,
+        only_test=False,
+        fix_cache_file=False,
+        name=''):
+    data_filename = ''
+    data_pipeline = ''
 
-    >>> get_tuning_config('-b 10..25?')
-    IntegerParam(opt='-b', min=10, max=25)
+    if source is None:
+        pass
+    elif isinstance(source, basestring):
+        if '|' in source:
+            data_pipeline = source
+            if not data_pipeline.strip().endswith('|'):
+                data_pipeline += ' |'
+        else:
+            assert os.path.exists(source), source
+            data_filename = '-d %s' % source
+    elif isinstance(source, list):
+        assert source and os.path.exists(source[0]), source
+        data_pipeline = get_data_pipeline(source)
+    else:
+        raise TypeError('Expected string or list, not %r' % (source, ))
 
-    >>> get_tuning_config('--learning_rate 0.5?')
-    FloatParam(opt='--learning_rate', init=0.5, format='%.1f')
+    intermediate_model_filename = final_regressor
 
-    >>> get_tuning_config('--learning_rate 0.50?')
-    FloatParam(opt='--learning_rate', init=0.5, format='%.2f')
+    final_options = []
 
-    >>> get_tuning_config('--l1 1e-07?')
-    LogParam(opt='--l1', init=1e-07, format='%.0e')
+    if audit:
+        final_options += ['-a']
 
-    >>> get_tuning_config('--l1 1.0E-07?')
-    LogParam(opt='--l1', init=1e-07, format='%.1e')
+    if readable_model:
+        final_options += ['--readable_model', readable_model]
 
-    >>> get_tuning_config('--l1 ..1.2e-07..?')
-    LogParam(opt='--l1', init=1.2e-07, format='%.1e')
+    vw_args = vw_args.split()
 
-    >>> get_tuning_config('--l1 1e-10..1e-05?')
-    LogParam(opt='--l1', min=1e-10, max=1e-05, format='%.0e')
+    if data_filename and get_compression(source) == 'gz' and '--compressed' not in vw_args:
+        vw_args.append('--compressed')
 
-    >>> get_tuning_config('--loss_function squared/hinge/percentile?')
-    ValuesParam(opt='--loss_function', values=['squared', 'hinge', 'percentile'])
+    if fix_cache_file:
+        if '--cache_file' in vw_args:
+            sys.exit('Dont provide --cache_file, one will be added automatically.')
 
-    >>> get_tuning_config('--loss_function /hinge/percentile?')
-    ValuesParam(opt='--loss_function', values=['', 'hinge', 'percentile'])
+        if '-c' in vw_args or '--cache_file' in vw_args:
+            remove_option(vw_args, '-c', 0)
+            remove_option(vw_args, '--cache_file', 1)
+            # every run gets a new cache or a prebuilt one, which -k would have vw overwrite
+            remove_option(vw_args, '-k', 0)
+            remove_option(vw_args, '--kill_cache', 0)
+            cache_file = None
+            if PREBUILT_VW_CACHE:
+                # named pipes of --foldscript fanout can only be read once
+                if data_filename and os.path.isfile(source):
+                    cache_file = get_prebuilt_vw_cache(source, vw_args)
+                elif data_pipeline and '$fold' not in data_pipeline:
+                    # awk/perl splits are templates completed for each fold, other pipelines (shards, training sets
+                    # of the fold files) always output the same data, which then need not be read at all
+                    cache_file = get_prebuilt_vw_cache(data_pipeline, vw_args)
+                    if cache_file:
+                        data_pipeline = ''
+            if cache_file:
+                # shared by all the runs on this data, vw reads the examples from it without parsing the text
+                vw_args.extend(['--cache_file', cache_file])
+            else:
+                if final_regressor:
+                    cache_file = final_regressor + '.cache'
+                else:
+                    cache_file = get_temp_filename('cache')
+                vw_args.extend(['--cache_file', cache_file])
+                to_cleanup.append(cache_file)
 
-    >>> get_tuning_config('--classweight 1:0.1..1.5?')
-    FloatParam(opt='--classweight 1:', min=0.1, max=1.5, format='%.1f')
+    training_command = [
+        data_pipeline,
+        VW_CMD,
+        data_filename,
+        '-i %s' % initial_regressor if initial_regressor else '',
+        '-f %s' % intermediate_model_filename if intermediate_model_filename else '',
+        '-p %s' % predictions if predictions else '',
+        '-r %s' % raw_predictions if raw_predictions else '',
+        '-t' if only_test else '',
+    ] + vw_args
 
-    >>> get_tuning_config('--classweight 1:0.1..1.5?').get_extra_args(1)
-    '--classweight 1:1.0'
-    """
-    if isinstance(config, basestring):
-        config = config.split()
+    if only_test:
+        return _as_dict(training_command + final_options, name=name)
 
-    assert config[-1].endswith('?'), config
+    return deque([_as_dict(training_command + final_options, name=name)])
 
-    if config[-1].endswith('??'):
-        config[-1] = config[-1][:-1]
-        omit = True
-    else:
-        omit = None
 
-    if len(config) > 2:
-        raise ValueError('Cannot parse: %r' % (config, ))
+def vw_cross_validation(
+        vw_filename,
+        kfold,
+        vw_args,
+        vw_test_args,
+        workers=None,
+        with_predictions=False,
+        with_raw_predictions=False,
+        calc_num_features=False,
+        capture_output=False):
 
-    first = config[0]
+    if hasattr(capture_output, '__contains__') and '' in capture_output:
+        capture_output = True
 
-    assert first.startswith('-'), config
+    workers = _workers(workers)
+    commands = []
+    p_filenames = []
+    r_filenames = []
+    readable_models = []
+    to_cleanup = []
 
-    if first.startswith('--'):
-        prefix = '--'
-        first = first[2:]
-    else:
-        prefix = '-'
-        first = first[1:]
+    vw_args = vw_args.replace('--quiet', '')
 
-    if len(config) == 1:
-        first = first[:-1]
-        if '/' in first:
-            # XXX recursive definition? need a proper parser then '(--ngram 2/3? --skips 0..3?)/--ngram 1?'
-            return ValuesParam(opt='', values=[(prefix + x if x else '') for x in first.split('/')])
-        else:
-            return BinaryParam(prefix + first)
+    # Split into folds is done like this (example for 3 folds)
+    # Example -> fold:
+    # 1 -> 1
+    # 2 -> 2
+    # 3 -> 3
+    # 4 -> 1
+    # and so on
 
-    value = config[-1]
-    value = value[:-1]
+    fold_sets = None
+    fanout = False
+    fold_index = None
 
-    if value.count(':') == 1:
-        value_prefix, value = value.split(':')
-        opt = config[0] + ' ' + value_prefix + ':'
-        merge = True
+    if kfold is None:
+        trainset = vw_filename
+        testset = None
+        kfold = 1
     else:
-        opt = config[0]
-        merge = False
+        assert kfold > 1, kfold
+        fold_index, index_filename = get_fold_index(vw_filename, kfold)
+        if FOLDSCRIPT == 'files':
+            fold_sets = get_fold_sets(vw_filename, kfold)
+            trainset, testset = fold_sets[0]
+        elif FOLDSCRIPT == 'fanout':
+            fold_sets = make_fanout_fifos(kfold, to_cleanup)
+            trainset, testset = fold_sets[0]
+            fanout = True
+        elif FOLDSCRIPT == 'awk':
+            trainset = AWK_TRAINSET if index_filename is None else AWK_INDEXED_TRAINSET
+            testset = AWK_TESTSET if index_filename is None else AWK_INDEXED_TESTSET
+        elif FOLDSCRIPT == 'perl':
+            trainset = PERL_TRAINSET if index_filename is None else PERL_INDEXED_TRAINSET
+            testset = PERL_TESTSET if index_filename is None else PERL_INDEXED_TESTSET
+        else:
+            raise AssertionError('foldscript=%r not understood' % FOLDSCRIPT)
 
-    params = {
-        'opt': opt,
-        'merge': merge,
-        'omit': omit,
-    }
+        if fold_sets is None:
+            if isinstance(vw_filename, list) or get_compression(vw_filename):
+                prefix = get_data_pipeline(vw_filename) + ' '
+                trainset = prefix + trainset.replace(' VW', '')
+                testset = prefix + testset.replace(' VW', '')
 
-    if '/' in value:
-        return ValuesParam(values=value.split('/'), **params)
+            trainset = trainset.replace('KFOLDS', str(kfold))
+            testset = testset.replace('KFOLDS', str(kfold))
 
-    is_log = 'e' in value.lower()
-    type = None
+            if isinstance(vw_filename, basestring):
+                trainset = trainset.replace('VW', vw_filename)
+                testset = testset.replace('VW', vw_filename)
 
-    if value.count('..') == 2:
-        min, init, max = value.split('..')
-        format = sorted([get_format(min), get_format(init), get_format(max)])[-1]
-        is_float = '.' in min or '.' in init or '.' in max
+            if index_filename is not None:
+                trainset = trainset.replace('FOLDINDEX', quote(index_filename))
+                testset = testset.replace('FOLDINDEX', quote(index_filename))
 
-        params.update({
-            'min': min,
-            'init': init,
-            'max': max,
-            'format': format
-        })
+    model_prefix = get_temp_filename('model') + '.$fold'
+    model_filename = model_prefix + '.bin' if testset else None
 
-    elif '..' in value:
-        min, max = value.split('..')
-        is_float = '.' in min or '.' in max
-        format = sorted([get_format(min), get_format(max)])[-1]
+    if with_predictions:
+        p_filename = '%s.predictions' % model_prefix
+    else:
+        p_filename = None
 
-        params.update({
-            'min': min,
-            'max': max,
-            'format': format
-        })
+    if with_raw_predictions:
+        r_filename = '%s.raw' % model_prefix
+    else:
+        r_filename = None
 
-    elif value.startswith('randint('):
-        value = value[8:].rstrip(')')
-        min = 0
-        value = int(value)
-        params.update({
-            'min': 0,
-            'max': value,
-        })
+    if calc_num_features:
+        readable_model = model_prefix + '.readable'
+    else:
+        readable_model = None
 
-        type = RandIntParam
+    if fold_sets is None:
+        # shared by all the folds, with $fold replaced below
+        fold_sets = [(trainset, testset)]
 
-        return RandIntParam(**params)
+    fold_commands = []
 
-    else:
-        is_float = '.' in value
-        format = get_format(value)
+    for trainset, testset in fold_sets:
+        cleanup_tmpl = []
 
-        params.update({
-            'init': value,
-            'format': format
-        })
+        base_training_command = get_vw_command(
+            cleanup_tmpl,
+            trainset,
+            vw_args=vw_args,
+            final_regressor=model_filename,
+            predictions=None if testset else p_filename,
+            raw_predictions=None if testset else r_filename,
+            readable_model=readable_model,
+            fix_cache_file=kfold > 1 or PREBUILT_VW_CACHE,
+            name='train' if testset else 'test')
+
+        for item in base_training_command:
+            if capture_output is True or item['name'] in capture_output:
+                item['stderr'] = subprocess.PIPE
+            else:
+                item['args'] += ' --quiet'
+
+        if testset:
+            testing_command = get_vw_command(
+                cleanup_tmpl,
+                testset,
+                vw_args=vw_test_args,
+                initial_regressor=model_filename,
+                predictions=p_filename,
+                raw_predictions=r_filename,
+                only_test=True,
+                fix_cache_file=kfold > 1,
+                name='test')
+
+            if capture_output is True or 'test' in capture_output:
+                testing_command['stderr'] = subprocess.PIPE
+            else:
+                testing_command['args'] += ' --quiet'
 
-    if type is None:
-        if is_log:
-            type = LogParam
-        elif is_float:
-            type = FloatParam
-        else:
-            type = IntegerParam
+            base_training_command.append(testing_command)
 
-    return type(**params)
+        fold_commands.append((base_training_command, cleanup_tmpl))
 
+    if len(fold_commands) == 1:
+        fold_commands *= kfold
 
-def split_metrics(metrics):
-    show_num_features = 'num_features' in metrics
-    calculated_metrics = [x for x in metrics if not x.startswith('vw') and x != 'num_features']
-    vw_metrics = [x for x in metrics if x.startswith('vw')]
-    return calculated_metrics, vw_metrics, show_num_features
+    for item in fold_commands[0][0]:
+        log("+ %s", item['args'])
 
+    commands = []
 
-def best_result_update(best_result, result, args):
-    if best_result is None:
-        return ''
-    best_marker = ''
-    with log_lock:
-        for marker, (best_value, best_args) in best_result.items():
-            if result >= best_value:
+    for this_fold, (base_training_command, cleanup_tmpl) in enumerate(fold_commands, 1):
+        this_fold = str(this_fold)
+        training_command = deque([x.copy() for x in base_training_command])
+        for cmd in training_command:
+            cmd['args'] = cmd['args'].replace('$fold', this_fold)
+        commands.append(training_command)
+
+        for filename in [model_filename, p_filename, r_filename, readable_model] + cleanup_tmpl:
+            if not filename:
                 continue
-            best_result[marker] = (result, args)
-            if (len(marker), marker) > (len(best_marker), best_marker):
-                best_marker = marker
+            filename = filename.replace('$fold', this_fold)
+            assert not os.path.exists(filename), filename
+            to_cleanup.append(filename)
 
-    return best_marker
+        if p_filename:
+            p_filenames.append(p_filename.replace('$fold', this_fold))
 
+        if r_filename:
+            r_filenames.append(r_filename.replace('$fold', this_fold))
 
-def run_cached(cache, cache_key, func, *args, **kwargs):
-    cache_key = str(cache_key)
-    if cache is not None and cache_key in cache:
-        return cache[cache_key]
-    result = func(*args, **kwargs)
-    cache[cache_key] = result
-    return result
+        if readable_model:
+            readable_models.append(readable_model.replace('$fold', this_fold))
 
+    if fanout:
+        errors = []
+        stop = threading.Event()
 
-table = None
+        def feed():
+            try:
+                fan_out_folds(vw_filename, kfold, fold_sets, stop, fold_index)
+            except BaseException:
+                errors.append(sys.exc_info())
 
+        feeder = threading.Thread(target=feed)
+        feeder.daemon = True
+        feeder.start()
+        # all the training runs read from the same reader at once
+        workers = max(workers, kfold)
 
-def run_single_iteration(vw_filename,
-                         vw_validation_filename,
-                         vw_test_filename,
-                         kfold,
-                         args,
-                         workers,
-                         metrics,
-                         y_true,
-                         sample_weight,
-                         config,
-                         best_result,
-                         with_predictions,
-                         validation_holdout):
-    global table
+    try:
+        try:
+            success, outputs = run_subprocesses(commands, workers=workers, importance=-1, wait_any=fanout)
+        finally:
+            if fanout:
+                # the runs that failed or were never started leave the reader waiting for them to open their pipes
+                stop.set()
+                feeder.join()
 
-    list_args = [x for x in args if x.strip()]
+        if fanout and errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
 
-    assert isinstance(args, list), args
-    args = ' '.join(str(x) for x in args)
-    args = re.sub('\s+', ' ', args).strip()
+        # check outputs first, the might be a valuable error message there
+        outputs = dict((key, [parse_vw_output(out) for out in value]) for (key, value) in outputs.items())
 
-    calculated_metrics, vw_metrics, show_num_features = split_metrics(metrics)
-    metric = metrics[0]
+        if not success:
+            vw_failed()
 
-    log('Trying %s %s...', VW_CMD, args, importance=-1)
-    cleanup = []
-    test_args = extract_test_args(args)
-    model_filename = None
+        for name in to_cleanup:
+            if not os.path.exists(name):
+                vw_failed('missing %r' % (name, ))
 
-    try:
-        if vw_validation_filename is not None:
-            y_pred, raw_pred_text, num_features, outputs, model_filename = vw_validation(
-                cleanup,
-                vw_filename,
-                vw_validation_filename,
-                vw_args=args,
-                vw_test_args=test_args,
-                workers=workers,
-                with_predictions=with_predictions or bool(calculated_metrics),
-                calc_num_features=show_num_features,
-                capture_output=set([_get_stage(m) for m in vw_metrics]))
-        else:
-            if vw_test_filename is not None:
-                sys.exit('--test not implemented for kfold')
-            y_pred, raw_pred_text, num_features, outputs = vw_cross_validation(
-                vw_filename,
-                kfold,
-                vw_args=args,
-                vw_test_args=test_args,
-                workers=workers,
-                with_predictions=with_predictions or bool(calculated_metrics),
-                calc_num_features=show_num_features,
-                capture_output=set([_get_stage(m) for m in vw_metrics]))
-    except KeyboardInterrupt:
-        raise
-    except BaseException, ex:
-        if type(ex) is not SystemExit:
-            traceback.print_exc()
-        log('Result %s %s : error: %s', VW_CMD, args, ex, importance=2)
-        return (None, None)
-    else:
-        if y_true is not None:
-            if calculated_metrics and len(y_true) != len(y_pred):
-                sys.exit('Internal error: expected %r predictions, got %r' % (len(y_true), len(y_pred)))
+        predictions = []
+        if p_filenames:
+            fold_predictions = [load_predictions(x) for x in p_filenames]
+            positions = get_fold_positions([len(x) for x in fold_predictions], fold_index, kfold)
+            if positions is None:
+                vw_failed('number of predictions does not match number of examples in each fold')
+            if len(positions):
+                predictions = np.empty(len(positions))
+                predictions[positions] = np.concatenate(fold_predictions)
+                if np.equal(0, np.max(np.abs(np.mod(predictions[:10000], 1)))):
+                    predictions = predictions.astype(int)
 
-            if raw_pred_text and len(y_true) != len(raw_pred_text):
-                sys.exit('Internal error: expected %r raw predictions, got %r' % (len(y_true), len(raw_pred_text)))
+        raw_predictions = []
+        if r_filenames:
+            fold_raw_predictions = [open(x).readlines() for x in r_filenames]
+            positions = get_fold_positions([len(x) for x in fold_raw_predictions], fold_index, kfold)
+            if positions is None:
+                vw_failed('number of raw predictions does not match number of examples in each fold')
+            raw_predictions = [None] * len(positions)
+            for position, line in izip(positions.tolist(), [line for lines in fold_raw_predictions for line in lines]):
+                raw_predictions[position] = line
 
-        results_h = []
+        num_features = [get_num_features(name) for name in readable_models]
 
-        if validation_holdout and y_pred is not None and y_true is not None:
-            assert 0 < validation_holdout < 1, validation_holdout
-            val_size = int(round(len(y_true) * (1.0 - validation_holdout)))
-            y_true_val = y_true[:val_size]
-            assert len(y_true_val), len(y_true_val)
-            results = [calculate_or_extract_score(m, y_true_val, y_pred[:val_size], config, outputs, sample_weight[:val_size] if sample_weight is not None else None, num_features=num_features) for m in metrics]
-            y_true_h = y_true[val_size:]
-            assert len(y_true_h), len(y_true_h)
-            if len(y_true_h):
-                results_h = [calculate_or_extract_score(m, y_true_h, y_pred[val_size:], config, outputs, sample_weight[val_size:] if sample_weight is not None else None, num_features=num_features) for m in metrics]
-        else:
-            results = [calculate_or_extract_score(m, y_true, y_pred, config, outputs, sample_weight, num_features=num_features) for m in metrics]
+        return predictions, raw_predictions, num_features, outputs
 
-        result = results[0]
+    finally:
+        unlink(*to_cleanup)
 
-        if isinstance(result, basestring):
-            sys.exit('Cannot calculate %r: %s' % (metric, result))
 
-        if isinstance(result, list):
-            try:
-                result, suffix = mean_h(result)
-            except Exception:
-                log_always("Failed to calculate mean from %r", result)
-                raise
+def extract_test_args(vw_args):
+    if isinstance(vw_args, basestring):
+        vw_args = vw_args.split()
 
-        if not isinstance(result, (int, long, float)):
-            sys.exit('Bad metric for tuning: %s (value=%r)' % (metric, result))
+    test_args = []
 
-        if not is_loss(metric):
-            result = -result
+    loss_function = read_argument(vw_args, '--loss_function')
 
-        is_best = best_result_update(best_result, result, args)
+    if loss_function:
+        test_args.append('--loss_function ' + loss_function)
+
+    test_opts = [
+        '--probabilities',
+        '--onethread',
+    ]
+
+    for opt in test_opts:
+        if opt in vw_args:
+            test_args.append(opt)
+
+    return ' '.join(test_args)
+
+
+def vw_validation(
+        to_cleanup,
+        vw_filename,
+        vw_validation_filename,
+        vw_args,
+        vw_test_args,
+        workers=None,
+        with_predictions=False,
+        with_raw_predictions=False,
+        calc_num_features=False,
+        capture_output=False):
+
+    assert isinstance(vw_validation_filename, list) or os.path.exists(vw_validation_filename), vw_validation_filename
+
+    if hasattr(capture_output, '__contains__') and '' in capture_output:
+        capture_output = True
+
+    vw_args = vw_args.replace('--quiet', '')
+    model_prefix = get_temp_filename('model')
+    model_filename = model_prefix + '.bin'
+    to_cleanup.append(model_filename)
+
+    if with_predictions:
+        p_filename = '%s.predictions' % model_prefix
+        to_cleanup.append(p_filename)
+    else:
+        p_filename = None
+
+    if with_raw_predictions:
+        r_filename = '%s.raw' % model_prefix
+        to_cleanup.append(r_filename)
+    else:
+        r_filename = None
+
+    if calc_num_features:
+        readable_model = model_prefix + '.readable'
+        to_cleanup.append(readable_model)
+    else:
+        readable_model = None
+
+    command = get_vw_command(
+        to_cleanup,
+        vw_filename,
+        vw_args=vw_args,
+        final_regressor=model_filename,
+        predictions=None,
+        raw_predictions=None,
+        readable_model=readable_model,
+        fix_cache_file=True,
+        name='train')
+
+    for item in command:
+        if capture_output is True or item['name'] in capture_output:
+            item['stderr'] = subprocess.PIPE
+        else:
+            item['args'] += ' --quiet'
+
+    training_out = system(command, importance=-1, repeat_on_error=1)
+
+    outputs = {}
+    if training_out:
+        outputs['train'] = [parse_vw_output(training_out)]
+
+    testing_command = get_vw_command(
+        to_cleanup,
+        vw_validation_filename,
+        vw_args=vw_test_args,
+        initial_regressor=model_filename,
+        predictions=p_filename,
+        raw_predictions=r_filename,
+        only_test=True,
+        name='test')
+
+    if capture_output is True or 'test' in capture_output:
+        testing_command['stderr'] = subprocess.PIPE
+    else:
+        testing_command['args'] += ' --quiet'
+
+    validation_out = system(testing_command, importance=-1, repeat_on_error=1)
+    if validation_out:
+        outputs['test'] = [parse_vw_output(validation_out)]
+
+    for name in to_cleanup:
+        if not os.path.exists(name):
+            vw_failed('missing %r' % (name, ))
+
+    if p_filename:
+        predictions = []
+        for line in open(p_filename):
+            predictions.append(float(line.split()[0]))
+        predictions = np.array(predictions)
+    else:
+        predictions = []
+
+    if r_filename:
+        raw_predictions = open(r_filename).readlines()
+    else:
+        raw_predictions = []
+
+    if readable_model:
+        num_features = get_num_features(readable_model)
+    else:
+        num_features = None
+
+    return predictions, raw_predictions, num_features, outputs, model_filename
+
+
+def get_num_features(filename):
+    counting = False
+    count = 0
+    for line in open(filename):
+        if counting:
+            count += 1
+        else:
+            if line.strip() == ':0':
+                counting = True
+    return count
+
+
+def parse_vw_output(output):
+    result = {}
+    for line in output.split('\n'):
+        if line.count(' = ') == 1:
+            key, value = line.split(' = ')
+            key = key.replace(' ', '_').replace("'", '').lower()
+            result[key] = value
+        else:
+            if re.search(VOWPAL_WABBIT_ERRORS, line.lower()):
+                sys.exit('vw failed: %s' % line.strip())
+    return result
+
+
+def _load_predictions(file, size=None, with_text=False, named_labels=None, with_weights=False, examples=None):
+    filename = file
+    if isinstance(file, list):
+        filename = file
+    elif hasattr(file, 'read') or hasattr(file, 'next'):
+        pass
+    elif isinstance(file, basestring):
+        if file in STDOUT_NAMES:
+            sys.exit('Will not read %s' % file)
+        file = open_regular_or_compressed(file)
+    else:
+        raise AssertionError(limited_repr(file))
+
+    result = []
+    result_text = []
+    importance_weights = [] if with_weights else None
+
+    for line in file:
+        try:
+            text = line.strip()
+            if with_text:
+                result_text.append(text)
+            items = text.split()
+            label = items[0]
+            if importance_weights is not None:
+                if len(items) >= 2:
+                    w = items[1]
+                    if w.startswith("'") or '|' in w:
+                        w = 1.0
+                    else:
+                        w = float(w)
+                    importance_weights.append(w)
+            if named_labels is not None:
+                if label not in named_labels:
+                    sys.exit('Unexpected label %r from %r' % (label, filename))
+                result.append(label)
+            else:
+                result.append(float(label))
+        except:
+            sys.stderr.write('Error while parsing %r\nin %r\n' % (line, limited_repr(filename)))
+            raise
+
+        if examples is not None and len(result) >= examples:
+            break
+
+    if size is not None:
+        if len(result) < size:
+            sys.exit('Too few items in %s: found %r, expecting %r' % (limited_repr(filename), len(result), size))
+
+        if len(result) > size:
+            mult = int(len(result) / size)
+            if size * mult == len(result):
+                # if --passes N option was used, then the number of predictions will be N times higher
+                result = result[-size:]
+            else:
+                sys.exit('Too many items in %s: found %r, expecting multiply of %r' % (limited_repr(filename), len(result), size))
+
+    retvalue = [np.array(result)]
+
+    if with_text:
+        retvalue.append(result_text)
+
+    if with_weights:
+        if not importance_weights:
+            retvalue.append(None)
+        else:
+            if len(importance_weights) != len(result):
+                sys.exit('Could not parse importance weights')
+            importance_weights = np.array(importance_weights)
+            retvalue.append(importance_weights)
+
+    if len(retvalue) == 1:
+        return retvalue[0]
+
+    return tuple(retvalue)
+
+
+class BaseParam(object):
+
+    PRINTABLE_KEYS = 'opt init min max values format extra omit'.split()
+    _cast = None
+
+    @classmethod
+    def cast(cls, value):
+        if value is None:
+            return None
+        if value == '':
+            return None
+        if cls._cast is None:
+            return value
+        return cls._cast(value)
+
+    def pack(self, value):
+        if self._pack is None:
+            return value
+        return self._pack(value)
+
+    def unpack(self, value):
+        if self._unpack is None:
+            return value
+        return self._unpack(value)
+
+    def __init__(self, opt, init=None, min=None, max=None, format=None, pack=None, unpack=None, extra=None, omit=None, merge=False):
+        self.opt = opt
+        self.init = self.cast(init)
+        self.min = self.cast(min)
+        self.max = self.cast(max)
+        self.format = format
+        self._pack = pack
+        self._unpack = unpack
+        self.extra = None
+        self.omit = omit
+        self.separator = '' if merge else ' '
+
+    def avg(self, a, b):
+        result = self.cast(self.unpack((self.pack(self.min) + self.pack(self.max)) / 2.0))
+        if self.format:
+            result = self.format % result
+            result = self.cast(result)
+        return result
+
+    def __repr__(self):
+        klass = type(self).__name__
+        items = []
+        for name in self.PRINTABLE_KEYS:
+            value = getattr(self, name, None)
+            if value is not None:
+                items.append('%s=%r' % (name, value))
+        return klass + '(' + ', '.join(items) + ')'
+
+    def packed_init(self):
+        init = self.init
+        if init is None:
+            init = self.avg(self.min, self.max)
+        init = self.pack(init)
+        return init
+
+    def get_extra_args(self, param):
+        if param is None or param == '':
+            return None
+        param = self.unpack(param)
+        if self.min is not None and param <= self.min:
+            param = self.min
+        elif self.max is not None and param >= self.max:
+            param = self.max
+        param = self.cast(param)
+        format = self.format or '%s'
+        extra_arg = format % param
+        return self.opt + self.separator + extra_arg + ' '.join(self.extra or [])
+
+
+class IntegerParam(BaseParam):
+    _cast = int
+
+
+class RandIntParam(BaseParam):
+    _cast = int
+
+
+class FloatParam(BaseParam):
+    _cast = float
+
+
+class LogParam(BaseParam):
+    _cast = float
+
+    def __init__(self, opt, **kwargs):
+        BaseParam.__init__(self, opt, pack=np.log, unpack=np.exp, **kwargs)
+
+
+class ValuesParam(BaseParam):
+
+    def __init__(self, opt, values, **kwargs):
+        BaseParam.__init__(self, opt, **kwargs)
+        self.values = values
+
+    def enumerate_all(self):
+        return [self.get_extra_args(x) for x in self.values]
+
+
+class BinaryParam(BaseParam):
+
+    def __init__(self, opt, **kwargs):
+        BaseParam.__init__(self, opt, **kwargs)
+
+    def enumerate_all(self):
+        return ['', self.opt]
+
+    def get_extra_args(self, param):
+        if param:
+            return self.opt
+        else:
+            return ''
+
+
+def get_format(value):
+    """
+    >>> get_format("1e-5")
+    '%.0e'
+
+    >>> get_format("1e5")
+    '%.0e'
+
+    >>> get_format("0.")
+    '%.0f'
+
+    >>> get_format("0.5")
+    '%.1f'
+
+    >>> get_format("0.5")
+    '%.1f'
+
+    >>> get_format("0.50")
+    '%.2f'
+
+    >>> get_format('5')
+    """
+    value = value.lower()
+
+    if 'e' in value and '.' not in value:
+        return '%.0e'
+
+    x = value
+
+    if '.' in x:
+        x = x.split('.')[-1]
+
+    if 'e' in x:
+        x = x.split('e')[0]
+        return '%%.%se' % len(x)
+
+    if '.' in value:
+        return '%%.%sf' % len(x)
+
+
+def parse_tuning_args(args):
+    """
+    >>> parse_tuning_args('--lowercase_features?'.split())
+    [BinaryParam(opt='--lowercase_features')]
+
+    >>> parse_tuning_args('--onethread --lowercase_features?'.split())
+    ['--onethread', BinaryParam(opt='--lowercase_features')]
+    """
+    assert isinstance(args, list), type(args)
+    args = args[:]
+    index = 0
+    while index < len(args):
+        arg = args[index]
+        if arg.startswith('-'):
+            next_arg = args[index + 1] if index + 1 < len(args) else ''
+            if arg.endswith('?'):
+                args[index] = get_tuning_config(arg)
+            elif next_arg.endswith('?') and not next_arg.startswith('-'):
+                args[index:index + 2] = [get_tuning_config(arg + ' ' + next_arg)]
+        index += 1
+    return args
+
+
+def get_tuning_config(config):
+    """
+    >>> get_tuning_config('--hash_seed randint(10000)?')
+    RandIntParam(opt='--hash_seed', min=0, max=10000)
+
+    >>> get_tuning_config('--lowercase?')
+    BinaryParam(opt='--lowercase')
+
+    >>> get_tuning_config('--nn 1..10?')
+    IntegerParam(opt='--nn', min=1, max=10)
+
+    >>> get_tuning_config('--nn 1..10??')
+    IntegerParam(opt='--nn', min=1, max=10, omit=True)
+
+    >>> get_tuning_config('--nn 0..10?')
+    IntegerParam(opt='--nn', min=0, max=10)
+
+    >>> get_tuning_config('--ngram 2..5?')
+    IntegerParam(opt='--ngram', min=2, max=5)
+
+    >>> get_tuning_config('-b 10..25?')
+    IntegerParam(opt='-b', min=10, max=25)
+
+    >>> get_tuning_config('--learning_rate 0.5?')
+    FloatParam(opt='--learning_rate', init=0.5, format='%.1f')
+
+    >>> get_tuning_config('--learning_rate 0.50?')
+    FloatParam(opt='--learning_rate', init=0.5, format='%.2f')
+
+    >>> get_tuning_config('--l1 1e-07?')
+    LogParam(opt='--l1', init=1e-07, format='%.0e')
+
+    >>> get_tuning_config('--l1 1.0E-07?')
+    LogParam(opt='--l1', init=1e-07, format='%.1e')
+
+    >>> get_tuning_config('--l1 ..1.2e-07..?')
+    LogParam(opt='--l1', init=1.2e-07, format='%.1e')
+
+    >>> get_tuning_config('--l1 1e-10..1e-05?')
+    LogParam(opt='--l1', min=1e-10, max=1e-05, format='%.0e')
+
+    >>> get_tuning_config('--loss_function squared/hinge/percentile?')
+    ValuesParam(opt='--loss_function', values=['squared', 'hinge', 'percentile'])
+
+    >>> get_tuning_config('--loss_function /hinge/percentile?')
+    ValuesParam(opt='--loss_function', values=['', 'hinge', 'percentile'])
+
+    >>> get_tuning_config('--classweight 1:0.1..1.5?')
+    FloatParam(opt='--classweight 1:', min=0.1, max=1.5, format='%.1f')
+
+    >>> get_tuning_config('--classweight 1:0.1..1.5?').get_extra_args(1)
+    '--classweight 1:1.0'
+    """
+    if isinstance(config, basestring):
+        config = config.split()
+
+    assert config[-1].endswith('?'), config
+
+    if config[-1].endswith('??'):
+        config[-1] = config[-1][:-1]
+        omit = True
+    else:
+        omit = None
+
+    if len(config) > 2:
+        raise ValueError('Cannot parse: %r' % (config, ))
+
+    first = config[0]
+
+    assert first.startswith('-'), config
+
+    if first.startswith('--'):
+        prefix = '--'
+        first = first[2:]
+    else:
+        prefix = '-'
+        first = first[1:]
+
+    if len(config) == 1:
+        first = first[:-1]
+        if '/' in first:
+            # XXX recursive definition? need a proper parser then '(--ngram 2/3? --skips 0..3?)/--ngram 1?'
+            return ValuesParam(opt='', values=[(prefix + x if x else '') for x in first.split('/')])
+        else:
+            return BinaryParam(prefix + first)
+
+    value = config[-1]
+    value = value[:-1]
+
+    if value.count(':') == 1:
+        value_prefix, value = value.split(':')
+        opt = config[0] + ' ' + value_prefix + ':'
+        merge = True
+    else:
+        opt = config[0]
+        merge = False
+
+    params = {
+        'opt': opt,
+        'merge': merge,
+        'omit': omit,
+    }
+
+    if '/' in value:
+        return ValuesParam(values=value.split('/'), **params)
+
+    is_log = 'e' in value.lower()
+    type = None
+
+    if value.count('..') == 2:
+        min, init, max = value.split('..')
+        format = sorted([get_format(min), get_format(init), get_format(max)])[-1]
+        is_float = '.' in min or '.' in init or '.' in max
+
+        params.update({
+            'min': min,
+            'init': init,
+            'max': max,
+            'format': format
+        })
+
+    elif '..' in value:
+        min, max = value.split('..')
+        is_float = '.' in min or '.' in max
+        format = sorted([get_format(min), get_format(max)])[-1]
+
+        params.update({
+            'min': min,
+            'max': max,
+            'format': format
+        })
+
+    elif value.startswith('randint('):
+        value = value[8:].rstrip(')')
+        min = 0
+        value = int(value)
+        params.update({
+            'min': 0,
+            'max': value,
+        })
+
+        type = RandIntParam
+
+        return RandIntParam(**params)
+
+    else:
+        is_float = '.' in value
+        format = get_format(value)
+
+        params.update({
+            'init': value,
+            'format': format
+        })
+
+    if type is None:
+        if is_log:
+            type = LogParam
+        elif is_float:
+            type = FloatParam
+        else:
+            type = IntegerParam
+
+    return type(**params)
+
+
+def split_metrics(metrics):
+    show_num_features = 'num_features' in metrics
+    calculated_metrics = [x for x in metrics if not x.startswith('vw') and x != 'num_features']
+    vw_metrics = [x for x in metrics if x.startswith('vw')]
+    return calculated_metrics, vw_metrics, show_num_features
+
+
+def best_result_update(best_result, result, args):
+    if best_result is None:
+        return ''
+    best_marker = ''
+    with log_lock:
+        for marker, (best_value, best_args) in best_result.items():
+            if result >= best_value:
+                continue
+            best_result[marker] = (result, args)
+            if (len(marker), marker) > (len(best_marker), best_marker):
+                best_marker = marker
+
+    return best_marker
+
+
+def run_cached(cache, cache_key, func, *args, **kwargs):
+    cache_key = str(cache_key)
+    if cache is not None and cache_key in cache:
+        return cache[cache_key]
+    result = func(*args, **kwargs)
+    cache[cache_key] = result
+    return result
+
+
+table = None
+
+
+def run_single_iteration(vw_filename,
+                         vw_validation_filename,
+                         vw_test_filename,
+                         kfold,
+                         args,
+                         workers,
+                         metrics,
+                         y_true,
+                         sample_weight,
+                         config,
+                         best_result,
+                         with_predictions,
+                         validation_holdout):
+    global table
+
+    list_args = [x for x in args if x.strip()]
+
+    assert isinstance(args, list), args
+    args = ' '.join(str(x) for x in args)
+    args = re.sub('\s+', ' ', args).strip()
+
+    calculated_metrics, vw_metrics, show_num_features = split_metrics(metrics)
+    metric = metrics[0]
+
+    log('Trying %s %s...', VW_CMD, args, importance=-1)
+    cleanup = []
+    test_args = extract_test_args(args)
+    model_filename = None
+
+    try:
+        if vw_validation_filename is not None:
+            y_pred, raw_pred_text, num_features, outputs, model_filename = vw_validation(
+                cleanup,
+                vw_filename,
+                vw_validation_filename,
+                vw_args=args,
+                vw_test_args=test_args,
+                workers=workers,
+                with_predictions=with_predictions or bool(calculated_metrics),
+                calc_num_features=show_num_features,
+                capture_output=set([_get_stage(m) for m in vw_metrics]))
+        else:
+            if vw_test_filename is not None:
+                sys.exit('--test not implemented for kfold')
+            y_pred, raw_pred_text, num_features, outputs = vw_cross_validation(
+                vw_filename,
+                kfold,
+                vw_args=args,
+                vw_test_args=test_args,
+                workers=workers,
+                with_predictions=with_predictions or bool(calculated_metrics),
+                calc_num_features=show_num_features,
+                capture_output=set([_get_stage(m) for m in vw_metrics]))
+    except KeyboardInterrupt:
+        raise
+    except BaseException, ex:
+        if type(ex) is not SystemExit:
+            traceback.print_exc()
+        log('Result %s %s : error: %s', VW_CMD, args, ex, importance=2)
+        return (None, None)
+    else:
+        if y_true is not None:
+            if calculated_metrics and len(y_true) != len(y_pred):
+                sys.exit('Internal error: expected %r predictions, got %r' % (len(y_true), len(y_pred)))
+
+            if raw_pred_text and len(y_true) != len(raw_pred_text):
+                sys.exit('Internal error: expected %r raw predictions, got %r' % (len(y_true), len(raw_pred_text)))
+
+        results_h = []
+
+        if validation_holdout and y_pred is not None and y_true is not None:
+            assert 0 < validation_holdout < 1, validation_holdout
+            val_size = int(round(len(y_true) * (1.0 - validation_holdout)))
+            y_true_val = y_true[:val_size]
+            assert len(y_true_val), len(y_true_val)
+            results = [calculate_or_extract_score(m, y_true_val, y_pred[:val_size], config, outputs, sample_weight[:val_size] if sample_weight is not None else None, num_features=num_features) for m in metrics]
+            y_true_h = y_true[val_size:]
+            assert len(y_true_h), len(y_true_h)
+            if len(y_true_h):
+                results_h = [calculate_or_extract_score(m, y_true_h, y_pred[val_size:], config, outputs, sample_weight[val_size:] if sample_weight is not None else None, num_features=num_features) for m in metrics]
+        else:
+            results = [calculate_or_extract_score(m, y_true, y_pred, config, outputs, sample_weight, num_features=num_features) for m in metrics]
+
+        result = results[0]
+
+        if isinstance(result, basestring):
+            sys.exit('Cannot calculate %r: %s' % (metric, result))
+
+        if isinstance(result, list):
+            try:
+                result, suffix = mean_h(result)
+            except Exception:
+                log_always("Failed to calculate mean from %r", result)
+                raise
+
+        if not isinstance(result, (int, long, float)):
+            sys.exit('Bad metric for tuning: %s (value=%r)' % (metric, result))
+
+        if not is_loss(metric):
+            result = -result
+
+        is_best = best_result_update(best_result, result, args)
 
         values = [_frmt_score(x) for x in results]
         values[1:] = [x.split()[0].rstrip(':') for x in values[1:]]
         values[0] += is_best or ' '
 
-        values = ['%s=%s' % (x, y) for (x, y) in zip(metrics, values)]
+        values = ['%s=%s' % (x, y) for (x, y) in zip(metrics, values)]
+
+        if results_h:
+            values_h = [_frmt_score(x) for x in results_h]
+            values += ['%s(hold)=%s' % (x, y) for (x, y) in zip(metrics, values_h)]
+
+        values = ['Result', VW_CMD] + list_args + [':'] + values
+
+        if table is None or len(table) != len(values):
+            table = [len(x) for x in values]
+        else:
+            table = [max(len(x), t) for (x, t) in zip(values, table)]
+
+        new_values = []
+        for value, size in zip(values, table):
+            value += ' ' * (size - len(value))
+            new_values.append(value)
+
+        new_values = ' '.join(new_values).rstrip()
+
+        log(new_values, importance=2 + int(len(is_best)))
+
+        return result, is_best
+    finally:
+        unlink(*cleanup)
+
+
+class InterruptOptimization(Exception):
+    pass
+
+
+MARKER_LOCALBEST = '+'
+MARKER_BRANCHBEST = '* '
+MARKER_BEST = '** '
+
+
+def vw_optimize(vw_filename, vw_validation_filename, vw_test_filename, y_true, kfold, args, metrics, config, sample_weight, workers, best_result, validation_holdout):
+    gridsearch_params = []
+    tunable_params = []
+    base_args = []
+    assert isinstance(args, list), args
+
+    for param in args:
+        if isinstance(param, (ValuesParam, BinaryParam)):
+            gridsearch_params.append(param)
+        elif isinstance(param, BaseParam):
+            tunable_params.append(param)
+        else:
+            base_args.append(param)
+
+    extra_args = ''
+    if best_result is None:
+        best_result = {}
+    cache = {}
+
+    def run(params):
+        log('Parameters: %r', params, importance=-1)
+        args = [extra_args]
+
+        for param_config, param in zip(tunable_params, params):
+            extra_arg = param_config.get_extra_args(param)
+            if extra_arg:
+                args.append(extra_arg)
+
+        result, is_best = run_cached(
+            cache,
+            args,
+            run_single_iteration,
+            vw_filename,
+            vw_validation_filename,
+            vw_test_filename,
+            kfold,
+            args,
+            workers,
+            metrics,
+            y_true,
+            sample_weight,
+            config,
+            best_result,
+            with_predictions=False,
+            validation_holdout=validation_holdout)
+
+        return result
+
+    already_done = {}
+
+    gridsearch_params = expand(gridsearch_params, withextra=True)
+    log('Grid-search: %r', gridsearch_params)
+    initial_params_init = [x.packed_init() for x in tunable_params]
+    initial_params_db = Simple1NN()
+
+    best_result[MARKER_BRANCHBEST] = (float('inf'), None)
+
+    for _score, params, params_vector in gridsearch_params:
+        if tunable_params:
+            best_result[MARKER_LOCALBEST] = (float('inf'), None)
+
+        params_normalized = vw_normalize_params(base_args + params)
+
+        if params_normalized != params:
+            log('Normalized params %r %r -> %r', base_args, params, params_normalized, importance=-1)
+
+        params_as_str = ' '.join(params_normalized)
+
+        if params_as_str in already_done:
+            log('Skipping %r (same as %r)', ' '.join(params), ' '.join(already_done[params_as_str]), importance=-1)
+            continue
+
+        already_done[params_as_str] = params
+
+        extra_args = params_as_str
+        need_separator = False
+
+        if tunable_params:
+            import scipy.optimize
+
+            options = {'xtol': 0.001, 'ftol': 0.001}
+
+            results = initial_params_db.find_nearest(params_vector)
+            if results:
+                t_params = np.mean(results, axis=0)
+            else:
+                t_params = initial_params_init
+
+            try:
+                optresult = scipy.optimize.minimize(run, t_params, method='Nelder-Mead', options=options)
+            except InterruptOptimization, ex:
+                log(str(ex), importance=1)
+            else:
+                need_separator = True
+                initial_params_db.add_observation(np.array(params_vector), optresult.x)
+        else:
+            try:
+                run([])
+            except InterruptOptimization, ex:
+                log(str(ex), importance=1)
+
+        if need_separator:
+            log('', importance=1)
+
+    return best_result[MARKER_BRANCHBEST]
+
+
+def setup_hyperopt_Trials(domain, workers):
+    from vwoptimizelib.third_party.hyperopt import base
+    from vwoptimizelib.third_party.hyperopt.utils import coarse_utcnow
+    from vwoptimizelib.third_party.hyperopt.fmin import FMinIter
+    import threading
+    from Queue import Queue
+    import traceback
+
+    class MT_Trials(base.Trials):
+        """Multithreading-enabled Trials implementation for hyperopt.
+        """
+
+        async = True
+
+        def __init__(self, domain, poolsize=None):
+            base.Trials.__init__(self)
+            self.domain = domain
+            self.queue = Queue()
+            self.pool = []
+            if poolsize is None:
+                import multiprocessing
+                poolsize = max(1, multiprocessing.cpu_count() - 1)
+                log('setting poolsize = %s', poolsize)
+            self.poolsize = poolsize
+            self.alive = True
+            for _ in xrange(self.poolsize):
+                worker = threading.Thread(target=self._worker_thread, args=tuple())
+                worker.daemon = True
+                worker.start()
+                self.pool.append(worker)
+
+        def shutdown(self):
+            self.alive = False
+            for _ in xrange(len(self.pool)):
+                self.queue.put(None)
+
+        def insert_trial_docs(self, docs):
+            """ trials - something like is returned by self.new_trial_docs()
+            """
+            docs = [self.assert_valid_trial(base.SONify(doc))
+                    for doc in docs]
+            result = base.Trials._insert_trial_docs(self, docs)
+            for doc in docs:
+                self.queue.put(doc)
+            return result
+
+        def _handle_one_trial(self, trial):
+            assert trial['state'] == base.JOB_STATE_NEW
+            trial['state'] = base.JOB_STATE_RUNNING
+            now = coarse_utcnow()
+            trial['book_time'] = now
+            trial['refresh_time'] = now
+            spec = base.spec_from_misc(trial['misc'])
+            ctrl = base.Ctrl(self.trials, current_trial=trial)
+            try:
+                result = self.domain.evaluate(spec, ctrl)
+            except Exception as e:
+                traceback.print_exc()
+                trial['state'] = base.JOB_STATE_ERROR
+                trial['misc']['error'] = (str(type(e)), str(e))
+                trial['refresh_time'] = coarse_utcnow()
+            else:
+                trial['state'] = base.JOB_STATE_DONE
+                trial['result'] = result
+                trial['refresh_time'] = coarse_utcnow()
+
+        def _worker_thread(self):
+            print_exc = traceback.print_exc
+            while self.alive:
+                trial = self.queue.get()
+                if trial is None:
+                    break
+                try:
+                    self._handle_one_trial(trial)
+                except BaseException:
+                    print_exc()
+                    sys.stderr.write('When handling trial: %r\n\n' % (trial, ))
+                    break
+
+    class FMinIter2(FMinIter):
+
+        def __init__(self, algo, domain, trials, rstate, async=None,
+                     max_queue_len=1,
+                     poll_interval_secs=1.0,
+                     max_evals=sys.maxsize,
+                     verbose=0,
+                     ):
+            self.algo = algo
+            self.domain = domain
+            self.trials = trials
+            if async is None:
+                self.async = trials.async
+            else:
+                self.async = async
+            self.poll_interval_secs = poll_interval_secs
+            self.max_queue_len = max_queue_len
+            self.max_evals = max_evals
+            self.rstate = rstate
+
+    if workers == 1:
+        return base.Trials(), FMinIter2
+
+    trials = MT_Trials(domain=domain, poolsize=workers)
+    return trials, FMinIter2
+
+
+def str_int(x):
+    return str(int(x))
+
+
+def vw_optimize_hyperopt(vw_filename, vw_validation_filename, vw_test_filename, y_true, kfold, args, metrics, config, sample_weight, workers, best_result, rounds, validation_holdout):
+    assert isinstance(args, list), args
+    from vwoptimizelib.third_party.hyperopt import hp, base
+
+    space = {}
+    format = {}
+
+    unique_id = [0]
+
+    def convert_to_hyperopt(param):
+
+        name = param.opt + ' uid=%s' % unique_id[0]
+        unique_id[0] += 1
+
+        if isinstance(param, LogParam):
+            assert param.min is not None and param.max is not None, 'For hyperopt, min and max needed for %s' % param.opt
+            distrib = hp.loguniform(name, np.log(param.min), np.log(param.max))
+        elif isinstance(param, RandIntParam):
+            assert param.max is not None
+            distrib = hp.randint(name, param.max)
+        elif isinstance(param, FloatParam):
+            assert param.min is not None and param.max is not None, 'For hyperopt, min and max needed for %s' % param.opt
+            distrib = hp.uniform(name, param.min, param.max)
+        elif isinstance(param, ValuesParam):
+            distrib = hp.choice(name, param.values)
+        elif isinstance(param, BinaryParam):
+            distrib = hp.choice(name, ['', True])
+        elif isinstance(param, IntegerParam):
+            assert param.min is not None and param.max is not None, 'For hyperopt, min and max needed for %s' % param.opt
+            distrib = hp.quniform(name, param.min, param.max, 1)
+            format[param.opt] = str_int
+        else:
+            raise TypeError(param)
+
+        if param.omit:
+            distrib = hp.choice(name + '_outer', ['', distrib])
+
+        return distrib
+
+    gridparams = []
+    base_args = []
+    tunable_params = []
+    hierarch_params = [x.replace('-', '') for x in (options.hyperopt_hierarchy or '').split(',')]
+    tunable_params_dict = {}
+
+    for param in args:
+        if isinstance(param, BaseParam) and param.opt.replace('-', '') in hierarch_params:
+            assert isinstance(param, (ValuesParam, BinaryParam))
+            gridparams.append(param)
+        elif 'all_categorical' in hierarch_params and isinstance(param, (ValuesParam, BinaryParam)):
+            gridparams.append(param)
+        elif isinstance(param, BaseParam):
+            tunable_params.append(param)
+            tunable_params_dict[param.opt] = param
+        else:
+            base_args.append(param)
+
+    choices = []
+
+    already_seen = set()
+
+    for grid_param in expand(gridparams):
+        assert isinstance(grid_param, list), grid_param
+        grid_param = vw_normalize_params(grid_param)
+        grid_param = ' '.join(grid_param)
+
+        if grid_param in already_seen:
+            # filter out things like "--ngram 1 --skips 1"
+            continue
+
+        already_seen.add(grid_param)
+
+        local_space = {}
+        for param in tunable_params:
+            local_space[param.opt] = convert_to_hyperopt(param)
+
+        if local_space:
+            choices.append((grid_param, local_space))
+        else:
+            choices.append(grid_param)
+
+    space = {'grid': hp.choice('grid', choices)}
+
+    if best_result is None:
+        best_result = {}
+
+    best_result[MARKER_BRANCHBEST] = (float('inf'), None)
+
+    def run(params):
+        log('Parameters: %r', params, importance=-1)
+        args = base_args[:]
+
+        assert len(params) == 1, params
+        params = params.pop('grid')
+        assert len(params) == 2, params
+
+        base, rest = params
+
+        args.append(base)
+
+        for key, value in sorted(rest.items()):
+            if value == '' or value == 0 or value is None:
+                args.append('')
+                continue
+            param_config = tunable_params_dict[key]
+            # unpack() is only used by LogParam and hyperopt does exponentiation of its own
+            param_config._unpack = None
+            args.append(param_config.get_extra_args(value))
+
+        result, is_best = run_single_iteration(
+            vw_filename,
+            vw_validation_filename,
+            vw_test_filename,
+            kfold,
+            args,
+            workers,
+            metrics,
+            y_true,
+            sample_weight,
+            config,
+            best_result,
+            with_predictions=False,
+            validation_holdout=validation_holdout)
+
+        if result is None:
+            return float('inf')
+
+        return result
+
+    env_rseed = os.environ.get('HYPEROPT_FMIN_SEED', '')
+    if env_rseed:
+        rstate = np.random.RandomState(int(env_rseed))
+    else:
+        rstate = np.random.RandomState()
+
+    domain = base.Domain(run, space, pass_expr_memo_ctrl=False)
+    trials, FMinIter2 = setup_hyperopt_Trials(domain, workers)
+
+    if '.' not in options.hyperopt_alg:
+        options.hyperopt_alg = 'vwoptimizelib.third_party.hyperopt.%s.suggest' % options.hyperopt_alg
+    alg = _import(options.hyperopt_alg)
+    rval = FMinIter2(algo=alg, domain=domain, trials=trials, rstate=rstate, max_queue_len=workers or 1, poll_interval_secs=0.1)
+
+    assert rounds is not None
+    try:
+        rval.run(rounds)
+    finally:
+        if hasattr(trials, 'shutdown'):
+            trials.shutdown()
+
+    return best_result[MARKER_BRANCHBEST]
+
+
+class Simple1NN(object):
+
+    def __init__(self):
+        self.observations = []
+
+    def add_observation(self, x, y):
+        self.observations.append((x, y))
+
+    def find_nearest(self, query_x):
+        nearest_items = []
+        nearest_distance = float('inf')
+        for x, y in self.observations:
+            dist = np.sum(np.abs(x - query_x))
+            # print 'query=%s x=%s y=%s dist=%s' % (query_x, x, y, dist)
+            if dist < nearest_distance:
+                nearest_distance = dist
+                nearest_items = [y]
+            elif dist == nearest_distance:
+                nearest_items.append(y)
+        return nearest_items
+
+
+def vw_normalize_params(params):
+    """
+    >>> vw_normalize_params(['--ngram', '1'])
+    []
+    >>> vw_normalize_params(['--ngram', '1', '--skips', '1'])
+    []
+    >>> vw_normalize_params(['--skips', '1'])
+    []
+    >>> vw_normalize_params(['--ngram', '2', '--skips', '1'])
+    ['--ngram', '2', '--skips', '1']
+    """
+    params = ' '.join(params)
+    params = params.replace('--ngram 1', '')
+    params = params.replace('--skips 0', '')
+    if '--ngram' not in params:
+        params = re.sub('--skips \d+', '', params)
+    params = re.sub('\s+', ' ', params)
+    return params.split()
+
+
+def expand(gridsearch_params, only=None, withextra=False):
+    result = list(_expand(gridsearch_params, only=only))
+    result.sort()
+    if withextra:
+        return result
+    return [x[1] for x in result]
+
+
+def _expand(gridsearch_params, only=None, score_mult=1):
+    if not gridsearch_params:
+        yield (0, [], [])
+        return
+
+    first_arg = gridsearch_params[0]
+
+    if isinstance(first_arg, basestring):
+        skip = True
+    elif only is not None and getattr(first_arg, 'opt', '') not in only:
+        skip = True
+    else:
+        skip = False
+
+    if skip:
+        for inner_score, inner_cmd, inner_vector in _expand(gridsearch_params[1:], only=only, score_mult=score_mult):
+            yield (inner_score, _filter([first_arg] + inner_cmd), inner_vector)
+        return
+
+    for index, first_arg_variant in enumerate(first_arg.enumerate_all()):
+        for inner_score, inner, inner_vector in _expand(gridsearch_params[1:], only=only, score_mult=score_mult * 1.01):
+            new_inner_vector = [index] + inner_vector
+            yield (index * score_mult + inner_score, _filter([first_arg_variant] + inner), new_inner_vector)
+
+
+def _filter(lst):
+    return [x for x in lst if x]
+
+
+def get_language(doc):
+    import pycld2
+    if isinstance(doc, unicode):
+        doc = doc.encode('utf-8')
+    try:
+        return pycld2.detect(doc, bestEffort=True)[2][0][0].lower()
+    except Exception, ex:
+        sys.stderr.write('Cannot detect language of %r\n%s\n' % (doc, ex))
+
+
+def get_stemmer(language, stemmers={}):
+    if language in stemmers:
+        return stemmers[language]
+    from nltk.stem import SnowballStemmer
+    try:
+        stemmers[language] = SnowballStemmer(language)
+    except Exception:
+        stemmers[language] = 0
+
+    return stemmers[language]
+
+
+class LRUCache(object):
+    """Mapping that keeps about the size most recently used items.
+
+    Approximated with two generations of plain dicts: a lookup in the older one moves the item into the current one,
+    and when the current one is full the older one is dropped.
+
+    >>> cache = LRUCache(4)
+    >>> for x in 'abc':
+    ...     cache[x] = x.upper()
+    >>> cache.get('a'), cache.get('b')
+    ('A', 'B')
+    >>> for x in 'def':
+    ...     cache[x] = x.upper()
+    >>> cache.get('a'), cache.get('c'), cache.get('f')
+    (None, None, 'F')
+    """
+
+    def __init__(self, size):
+        self.half_size = max(1, size // 2)
+        self.current = {}
+        self.previous = {}
+
+    def get(self, key, default=None):
+        result = self.current.get(key, self)
+        if result is not self:
+            return result
+        result = self.previous.get(key, self)
+        if result is self:
+            return default
+        self[key] = result
+        return result
+
+    def __setitem__(self, key, value):
+        if len(self.current) >= self.half_size:
+            self.previous = self.current
+            self.current = {}
+        self.current[key] = value
+
+
+STEM_CACHE_SIZE = 100000
+
+
+class ColumnMemo(object):
+    """Processed values of a text column, for files where the same values repeat.
+
+    Turns itself off if after the first probe_size values less than min_hit_rate of them were found in the cache.
+
+    >>> memo = ColumnMemo(probe_size=4)
+    >>> memo.process(['a', 'b', 'a', 'a'], lambda values: [x.upper() for x in values])
+    ['A', 'B', 'A', 'A']
+    >>> memo.hits, memo.lookups, memo.enabled
+    (2, 4, True)
+    """
+
+    def __init__(self, size=100000, probe_size=10000, min_hit_rate=0.2):
+        self.cache = LRUCache(size)
+        self.probe_size = probe_size
+        self.min_hit_rate = min_hit_rate
+        self.hits = 0
+        self.lookups = 0
+        self.enabled = True
+
+    def process(self, values, process_values):
+        cache = self.cache
+        result = [cache.get(value) for value in values]
+        missing = list(set([value for (value, processed) in izip(values, result) if processed is None]))
+
+        self.lookups += len(values)
+        self.hits += len(values) - len(missing)
+
+        if missing:
+            new = dict(izip(missing, process_values(missing)))
+            for value, processed in new.iteritems():
+                cache[value] = processed
+            result = [new[value] if processed is None else processed for (value, processed) in izip(values, result)]
+
+        if self.lookups >= self.probe_size and self.hits < self.min_hit_rate * self.lookups:
+            self.enabled = False
+            self.cache = None
+
+        return result
+
+    def __str__(self):
+        return '%.1f%% hits out of %s%s' % (100.0 * self.hits / max(1, self.lookups), self.lookups, '' if self.enabled else ', disabled')
+
+
+def stem_word(language, stemmer, word, cache=LRUCache(STEM_CACHE_SIZE)):
+    key = (language, word)
+    result = cache.get(key)
+    if result is None:
+        result = cache[key] = stemmer.stem(word)
+    return result
+
+
+def stem_words(words):
+    """Stem the words with the stemmer of the language of the whole document"""
+    if not any(len(word) > 2 for word in words):
+        return words
+
+    language = None
+    try:
+        language = get_language(' '.join(words))
+        stemmer = get_stemmer(language)
+    except Exception, ex:
+        sys.stderr.write('Cannot detect language of %r: %s\n' % (words, ex))
+        return words
+
+    if not stemmer:
+        return words
+
+    result = []
+    for word in words:
+        if len(word) > 2:
+            try:
+                word = stem_word(language, stemmer, word)
+            except Exception, ex:
+                sys.stderr.write('Cannot stem %r %r: %s\n' % (language, word, ex))
+        result.append(word)
+    return result
+
+
+def stem_words_per_word(words):
+    """Detect the language of each word separately, falling back to the language of the document. Much slower."""
+    base_stemmer = False
+    result = []
+    for word in words:
+        if len(word) > 2:
+            language = None
+            try:
+                language = get_language(word)
+                stemmer = get_stemmer(language)
+                if stemmer:
+                    word = stem_word(language, stemmer, word)
+                else:
+                    if base_stemmer is False:
+                        base_language = get_language(' '.join(words))
+                        base_stemmer = get_stemmer(base_language)
+                    if base_stemmer:
+                        language = base_language
+                        word = stem_word(language, base_stemmer, word)
+            except Exception, ex:
+                sys.stderr.write('Cannot stem %r %r: %s\n' % (language, word, ex))
+        result.append(word)
+    return result
+
+
+def chinese_simplify(unistr, cache={}):
+    u"""
+    This function does the same as hanziconv's module toSimplified() but order of magnitude faster
+
+    >>> print chinese_simplify(u'繁簡轉換器')
+    繁简转换器
+
+    >>> from hanziconv import HanziConv
+    >>> from hanziconv.charmap import traditional_charmap
+    >>> HanziConv.toSimplified(traditional_charmap) == chinese_simplify(traditional_charmap)
+    True
+
+    >>> import timeit
+    >>> timeit.timeit(lambda : chinese_simplify(traditional_charmap), number=1000) # doctest:+SKIP
+    0.1961040496826172
+
+    >>> toSimplified = HanziConv.toSimplified
+    >>> timeit.timeit(lambda : toSimplified(traditional_charmap), number=1000) # doctest:+SKIP
+    4.9171209335327150
+    """
+    table = cache.get('table')
+    if table is None:
+        from hanziconv.charmap import traditional_charmap, simplified_charmap
+        table = dict((ord(char1), char2) for char1, char2 in izip(reversed(traditional_charmap), reversed(simplified_charmap)))
+        cache['table'] = table
+    return unistr.translate(table)
+
+
+WORD_REGEX = r"(?u)\b\w\w+\b"
+# joins the values processed together, cannot appear in CSV cells in practice
+TEXT_SEPARATOR = '\x00'
+
+
+def join_texts(texts):
+    """Join texts with TEXT_SEPARATOR or return None if some of them contain it"""
+    joined = TEXT_SEPARATOR.join(texts)
+    if joined.count(TEXT_SEPARATOR) != len(texts) - 1:
+        return None
+    return joined
+
+
+def remove_duplicates(words):
+    seen = set()
+    result = []
+    for word in words:
+        if word not in seen:
+            result.append(word)
+            seen.add(word)
+    return result
+
+
+class CharacterMap(dict):
+    """Table for unicode.translate() that computes the replacement of each character the first time it is seen
+
+    >>> u'Hello'.translate(CharacterMap(lambda char: char.upper() * 2))
+    u'HHEELLLLOO'
+    """
+
+    def __init__(self, function):
+        dict.__init__(self)
+        self.function = function
+
+    def __missing__(self, code):
+        result = self[code] = self.function(unichr(code))
+        return result
+
+
+def get_regex(range_name, cache={}):
+    result = cache.get(range_name)
+    if result is not None:
+        return result
+    result = re.compile(_generate_regex(range_name, RANGES[range_name]))
+    cache[range_name] = result
+    return result
+
+
+def _generate_regex(name, range):
+    result = []
+    ignored = 0
+    included = 0
+    for item in range:
+        try:
+            count = 0
+            if len(item) == 1:
+                count = 1
+                result.append(unichr(item[0]))
+            else:
+                count = item[1] - item[0] + 1
+                result.append(unichr(item[0]) + '-' + unichr(item[1]))
+        except ValueError, ex:
+            if 'unichr() arg not in range' in str(ex):
+                ignored += count
+            else:
+                raise
+        else:
+            included += count
+
+    if ignored:
+        log_always("%s: Ignored %s characters (left with %s)", name, ignored, included)
+
+    if not included:
+        sys.exit('%s: empty range' % name)
+
+    return u'[' + u''.join(result) + u']'
+
+
+# ideograph total chars=75640
+# hangul total chars=11735
+# hiragana total chars=97
+# katakana total chars=223
+# combined total chars=87688
+RANGES = {
+    'combined': [[4352, 4607], [12272, 12283], [12288, 12290], [12293, 12295], [12330, 12335], [12343], [12347], [12350, 12351], [12353, 12438], [12441, 12543], [12593, 12686], [12688, 12703], [12784, 12828], [12832, 12871], [12896, 12923], [12926], [12928, 12976], [12992, 13003], [13008, 13054], [13144, 13168], [13280, 13310], [13312, 19893], [19968, 40907], [43360, 43388], [44032, 55203], [55216, 55238], [55243, 55291], [63744, 64045], [64048, 64109], [64112, 64217], [65041, 65042], [65105], [65377], [65380, 65470], [65474, 65479], [65482, 65487], [65490, 65495], [65498, 65500], [127488], [127504, 127537], [127552, 127560], [131072, 173782], [173824, 177972], [194560, 195101]],
+    'hangul': [[4352, 4607], [12334, 12335], [12593, 12686], [12800, 12828], [12896, 12923], [12926], [43360, 43388], [44032, 55203], [55216, 55238], [55243, 55291], [65440, 65470], [65474, 65479], [65482, 65487], [65490, 65495], [65498, 65500]],
+    'hiragana': [[12353, 12438], [12441, 12448], [12540], [65392], [127488]],
+    'ideographs': [[12272, 12283], [12288, 12290], [12293, 12295], [12330, 12333], [12343], [12347], [12350, 12351], [12688, 12703], [12832, 12871], [12928, 12976], [12992, 13003], [13144, 13168], [13280, 13310], [13312, 19893], [19968, 40907], [63744, 64045], [64048, 64109], [64112, 64217], [65041, 65042], [65105], [65377], [65380], [127504, 127506], [127508, 127537], [127552, 127560], [131072, 173782], [173824, 177972], [194560, 195101]],
+    'katakana': [[12441, 12444], [12448, 12543], [12784, 12799], [13008, 13054], [65381, 65439], [127507]]
+}
+
+
+class Preprocessor(object):
+    ur"""
+    >>> Preprocessor(split_ideographs=True, chinese_simplify=True).process_text(u'hello 繁簡轉換器'.encode('utf8'))
+    'hello \xe7\xb9\x81 \xe7\xae\x80 \xe8\xbd\xac \xe6\x8d\xa2 \xe5\x99\xa8'
+
+    >>> Preprocessor(max_length=2, max_length_offset=1).process_text(u'繁簡轉換器'.encode('utf8')).decode('utf8') == u'簡轉'
+    True
+    """
+
+    ALL_OPTIONS_BINARY = '''
+        htmlunescape
+        lowercase
+        strip_punct
+        stem
+        stem_per_word
+        split_chars
+        split_ideographs
+        split_hangul
+        split_hiragana
+        split_katakana
+        split_combined
+        chinese_simplify
+        NFKC
+        remove_duplicate_words
+    '''.strip().split()
+
+    ALL_OPTIONS_INT = '''
+        max_words
+        max_length
+        max_length_offset
+        max_word_size
+        min_token_count
+    '''.strip().split()
+
+    ALL_OPTIONS = ALL_OPTIONS_BINARY + ALL_OPTIONS_INT
 
-        if results_h:
-            values_h = [_frmt_score(x) for x in results_h]
-            values += ['%s(hold)=%s' % (x, y) for (x, y) in zip(metrics, values_h)]
+    ALL_OPTIONS_DASHDASH = ['--%s' % x for x in ALL_OPTIONS]
 
-        values = ['Result', VW_CMD] + list_args + [':'] + values
+    @classmethod
+    def init_option_parser(cls, parser):
+        for opt in cls.ALL_OPTIONS_BINARY:
+            parser.add_option('--%s' % opt, action='store_true')
+        for opt in cls.ALL_OPTIONS_INT:
+            parser.add_option('--%s' % opt, type=int)
 
-        if table is None or len(table) != len(values):
-            table = [len(x) for x in values]
+    @classmethod
+    def parse_options(cls, string):
+        parser = PassThroughOptionParser()
+        cls.init_option_parser(parser)
+        options, args = parser.parse_args(string.split())
+        return options.__dict__
+
+    @classmethod
+    def from_options(cls, options):
+        if not options:
+            return None
+
+        if isinstance(options, list):
+            options = ' '.join(x for x in options if isinstance(x, basestring))
+
+        if isinstance(options, basestring):
+            options = cls.parse_options(options)
+
+        for opt in cls.ALL_OPTIONS:
+            if options[opt] is not None:
+                break
         else:
-            table = [max(len(x), t) for (x, t) in zip(values, table)]
+            return None
 
-        new_values = []
-        for value, size in zip(values, table):
-            value += ' ' * (size - len(value))
-            new_values.append(value)
+        return cls(**options)
 
-        new_values = ' '.join(new_values).rstrip()
+    def to_options(self):
+        result = ['--%s' % opt for opt in self.ALL_OPTIONS_BINARY if getattr(self, opt, None)]
+        result += ['--%s %s' % (opt, getattr(self, opt)) for opt in self.ALL_OPTIONS_INT if getattr(self, opt, None)]
+        return result
 
-        log(new_values, importance=2 + int(len(is_best)))
+    def __init__(self, **kwargs):
+        for option in self.ALL_OPTIONS_BINARY:
+            setattr(self, option, kwargs.get(option, False))
 
-        return result, is_best
-    finally:
-        unlink(*cleanup)
+        for option in self.ALL_OPTIONS_INT:
+            value = kwargs.get(option)
+            if value is not None:
+                value = int(value)
+            setattr(self, option, value)
 
+        if self.stem_per_word:
+            self.stem = True
 
-class InterruptOptimization(Exception):
-    pass
+        if self.stem:
+            stem_words(["testing"])
+            self.lowercase = True
+            self.strip_punct = True
+
+        if self.split_chars or self.split_combined:
+            self.split_ideographs = False
+            self.split_hangul = False
+            self.split_hiragana = False
+            self.split_katakana = False
 
+        if self.split_chars:
+            self.split_combined = False
 
-MARKER_LOCALBEST = '+'
-MARKER_BRANCHBEST = '* '
-MARKER_BEST = '** '
+        for range in RANGES:
+            if getattr(self, 'split_%s' % range):
+                setattr(self, 'split_%s' % range, get_regex(range))
 
+        self.char_stages, self.word_stages, self.output_stages, self.collapse_spaces = self.compile_stages()
+        # identify the results of decoding and of each char stage, see process_texts()
+        self.decode_key = ('decode', self.max_length, self.max_length_offset)
+        self.char_stage_keys = [name for (name, _stage) in self.char_stages]
+        self.char_stages = [stage for (_name, stage) in self.char_stages]
+        self.stages = self.char_stages + self.word_stages + self.output_stages
+        # only tokenizing and joining, can be done on all the texts at once
+        self.batch_words = len(self.word_stages) == 2 and not self.split_chars
 
-def vw_optimize(vw_filename, vw_validation_filename, vw_test_filename, y_true, kfold, args, metrics, config, sample_weight, workers, best_result, validation_holdout):
-    gridsearch_params = []
-    tunable_params = []
-    base_args = []
-    assert isinstance(args, list), args
+    def __str__(self):
+        return ' '.join(self.to_options())
 
-    for param in args:
-        if isinstance(param, (ValuesParam, BinaryParam)):
-            gridsearch_params.append(param)
-        elif isinstance(param, BaseParam):
-            tunable_params.append(param)
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__, ', '.join('%s=%r' % (name, getattr(self, name, None)) for name in self.ALL_OPTIONS))
+
+    def compile_stages(self):
+        """Resolve the options into the lists of functions that process_text() applies in order:
+
+        - char_stages work on the decoded text character by character, so they can run on many texts joined together;
+          they are returned as (name, function) pairs, the name tells which options the function depends on;
+        - word_stages turn the text of a single value into words and back;
+        - output_stages are character-level again.
+
+        The text is decoded before and encoded after, with the spaces collapsed if collapse_spaces is set.
+        """
+        char_stages = []
+        word_stages = []
+        output_stages = []
+
+        if self.htmlunescape:
+            char_stages.append(('htmlunescape', htmlparser_unescape))
+
+        if self.NFKC:
+            # not done per character: NFKC composes sequences of characters
+            char_stages.append(('NFKC', lambda text: unicodedata.normalize('NFKC', text)))
+
+        if self.chinese_simplify:
+            if self.lowercase:
+                char_table = CharacterMap(lambda char: chinese_simplify(char.lower()))
+                char_stages.append(('chinese_simplify lowercase', lambda text: text.translate(char_table)))
+            else:
+                char_table = CharacterMap(chinese_simplify)
+                char_stages.append(('chinese_simplify', lambda text: text.translate(char_table)))
+        elif self.lowercase:
+            char_stages.append(('lowercase', unicode.lower))
+
+        if self.strip_punct:
+            word_stages.append(re.compile(WORD_REGEX).findall)
         else:
-            base_args.append(param)
+            word_stages.append(unicode.split)
 
-    extra_args = ''
-    if best_result is None:
-        best_result = {}
-    cache = {}
+        if self.max_words is not None:
+            word_stages.append(lambda words: words[:self.max_words])
 
-    def run(params):
-        log('Parameters: %r', params, importance=-1)
-        args = [extra_args]
+        if self.max_word_size is not None:
+            word_stages.append(lambda words: [x[:self.max_word_size] for x in words])
 
-        for param_config, param in zip(tunable_params, params):
-            extra_arg = param_config.get_extra_args(param)
-            if extra_arg:
-                args.append(extra_arg)
+        if self.stem_per_word:
+            word_stages.append(stem_words_per_word)
+        elif self.stem:
+            word_stages.append(stem_words)
 
-        result, is_best = run_cached(
-            cache,
-            args,
-            run_single_iteration,
-            vw_filename,
-            vw_validation_filename,
-            vw_test_filename,
-            kfold,
-            args,
-            workers,
-            metrics,
-            y_true,
-            sample_weight,
-            config,
-            best_result,
-            with_predictions=False,
-            validation_holdout=validation_holdout)
+        if self.remove_duplicate_words:
+            word_stages.append(remove_duplicates)
+
+        collapse_spaces = False
+
+        if self.split_chars:
+            word_stages.append(lambda words: u' __ '.join([' '.join(w) for w in words]))
+        else:
+            word_stages.append(u' '.join)
+
+            split_regexes = [self.split_combined] if self.split_combined else \
+                [x for x in (self.split_ideographs, self.split_hiragana, self.split_katakana, self.split_hangul) if x]
+
+            if split_regexes:
+                # surround the characters of all the scripts with spaces in a single pass
+                if len(split_regexes) == 1:
+                    split_regex = split_regexes[0]
+                else:
+                    split_regex = re.compile(u'[' + u''.join(regex.pattern[1:-1] for regex in split_regexes) + u']')
+                output_stages.append(lambda text: split_regex.sub(ur" \g<0> ", text))
+
+            # words are non-empty and have no spaces unless some stage above produced them
+            collapse_spaces = not self.split_combined and bool(split_regexes or self.stem or self.max_word_size is not None)
+
+        return char_stages, word_stages, output_stages, collapse_spaces
+
+    def decode(self, text):
+        start = self.max_length_offset
+        end = self.max_length
+
+        if end is not None and end >= 0 and (start is None or start >= 0):
+            if start is not None:
+                end += start
+            # each character takes at most 4 bytes, no need to decode the rest
+            if len(text) > 4 * end:
+                result = text[:4 * end].decode('utf-8', errors='ignore')
+                # unless some bytes were invalid and dropped
+                if len(result) < end:
+                    result = text.decode('utf-8', errors='ignore')
+            else:
+                result = text.decode('utf-8', errors='ignore')
+        else:
+            result = text.decode('utf-8', errors='ignore')
+
+        if self.max_length_offset is not None:
+            result = result[self.max_length_offset:]
+
+        if self.max_length is not None:
+            result = result[:self.max_length]
 
         return result
 
-    already_done = {}
+    def process_text(self, text):
+        orig = text
+        try:
+            text = self.decode(text)
+            for stage in self.stages:
+                text = stage(text)
+            if self.collapse_spaces:
+                text = re.sub(r'\s+', ' ', text.strip())
+            return text.encode('utf-8')
+        except Exception:
+            sys.stderr.write('Failed to process\norig=%r\ntext=%r\n' % (orig, text))
+            traceback.print_exc()
+            raise
 
-    gridsearch_params = expand(gridsearch_params, withextra=True)
-    log('Grid-search: %r', gridsearch_params)
-    initial_params_init = [x.packed_init() for x in tunable_params]
-    initial_params_db = Simple1NN()
+    def process_texts(self, texts, shared=None):
+        """Same as [self.process_text(text) for text in texts] but most of the work is done once on all the texts joined together.
+
+        If shared is a dict, the decoded texts and the results of the char stages are kept there, so that other
+        preprocessors given the same texts and shared skip the leading stages they have in common with this one.
+
+        >>> Preprocessor(lowercase=True, strip_punct=True).process_texts(['Hello, World!', '', 'A Bc dE'])
+        ['hello world', '', 'bc de']
+        >>> shared = {}
+        >>> Preprocessor(NFKC=True, lowercase=True).process_texts(['A \xef\xbc\xa1'], shared)
+        ['a a']
+        >>> Preprocessor(NFKC=True).process_texts(['A \xef\xbc\xa1'], shared)
+        ['A A']
+        >>> len(shared)
+        3
+        """
+        joined = join_texts(texts)
+        if joined is None:
+            return [self.process_text(text) for text in texts]
 
-    best_result[MARKER_BRANCHBEST] = (float('inf'), None)
+        try:
+            text = self._process_chars(joined, texts, shared)
 
-    for _score, params, params_vector in gridsearch_params:
-        if tunable_params:
-            best_result[MARKER_LOCALBEST] = (float('inf'), None)
+            if text.count(TEXT_SEPARATOR) != len(texts) - 1:
+                # a stage produced the separator
+                return [self.process_text(x) for x in texts]
 
-        params_normalized = vw_normalize_params(base_args + params)
+            if self.batch_words:
+                # the words never contain the separator, so it becomes a word of its own
+                if self.strip_punct:
+                    words = re.findall(WORD_REGEX + '|' + TEXT_SEPARATOR, text)
+                else:
+                    words = text.replace(TEXT_SEPARATOR, ' %s ' % TEXT_SEPARATOR).split()
+                cells = [x.strip() for x in u' '.join(words).split(TEXT_SEPARATOR)]
+            else:
+                cells = []
+                for cell in text.split(TEXT_SEPARATOR):
+                    for stage in self.word_stages:
+                        cell = stage(cell)
+                    cells.append(cell)
 
-        if params_normalized != params:
-            log('Normalized params %r %r -> %r', base_args, params, params_normalized, importance=-1)
+            text = TEXT_SEPARATOR.join(cells)
 
-        params_as_str = ' '.join(params_normalized)
+            for stage in self.output_stages:
+                text = stage(text)
 
-        if params_as_str in already_done:
-            log('Skipping %r (same as %r)', ' '.join(params), ' '.join(already_done[params_as_str]), importance=-1)
-            continue
+            if self.collapse_spaces:
+                text = TEXT_SEPARATOR.join([x.strip() for x in re.sub(r'\s+', ' ', text).split(TEXT_SEPARATOR)])
 
-        already_done[params_as_str] = params
+            return text.encode('utf-8').split(TEXT_SEPARATOR)
+        except Exception:
+            # let process_text() report the text that failed
+            return [self.process_text(x) for x in texts]
 
-        extra_args = params_as_str
-        need_separator = False
+    def _process_chars(self, joined, texts, shared):
+        key = (joined, self.decode_key)
+        text = shared.get(key) if shared is not None else None
+
+        if text is None:
+            if self.max_length is None and self.max_length_offset is None:
+                text = self.decode(joined)
+            else:
+                text = TEXT_SEPARATOR.join([self.decode(x) for x in texts])
+            if shared is not None:
+                shared[key] = text
+
+        for stage, stage_key in izip(self.char_stages, self.char_stage_keys):
+            key += (stage_key, )
+            result = shared.get(key) if shared is not None else None
+            if result is None:
+                result = stage(text)
+                if shared is not None:
+                    shared[key] = result
+            text = result
+
+        return text
+
+    def process_row(self, row):
+        assert isinstance(row, list), row
+        return [self.process_text(item) for item in row]
+
+    def process_rows(self, rows):
+        return [self.process_row(row) for row in rows]
+
+
+def read_y_true(filename, format, columnspec, ignoreheader, named_labels, remap_label, examples=None):
+    # None is stdin and a file object is a pipe fed from it (see tee_stdin)
+    if isinstance(filename, list):
+        name = '%s and %s more shards' % (filename[0], len(filename) - 1)
+    else:
+        name = filename if isinstance(filename, basestring) else 'stdin'
+    log('Reading labels from %s', name)
+    if format == 'vw':
+        if isinstance(filename, list):
+            filename = open_anything(filename, format, ignoreheader=False)
+        return _load_predictions(filename, named_labels=named_labels, with_weights=True, examples=examples)
+
+    label_index = columnspec.index('y')
+
+    weight_index = None
+    try:
+        weight_index = columnspec.index('weight_metric')
+    except ValueError:
+        try:
+            weight_index = columnspec.index('weight')
+        except ValueError:
+            pass
+
+    store = get_column_store(filename, format, ignoreheader)
+
+    if store is not None:
+        count = store.rows if examples is None else min(examples, store.rows)
+        labels = store.get_cells(label_index, 0, count)
+        weights = store.get_cells(weight_index, 0, count) if weight_index is not None else []
+    else:
+        labels = []
+        weights = []
+        for row in islice(open_rows(filename, format, ignoreheader), examples):
+            labels.append(row[label_index])
+            if weight_index is not None:
+                weights.append(row[weight_index])
+
+    if remap_label is not None:
+        labels = [remap_label.get(label, label) for label in labels]
+
+    if named_labels is None:
+        labels = map(float, labels)
+    else:
+        for label in labels:
+            if label not in named_labels:
+                sys.exit('Unexpected label in %s: %r (allowed: %s)' % (name, label, named_labels))
+
+    y_true = np.array(labels)
+    if weights:
+        weights = np.array([float(w.strip() or '1') for w in weights])
+
+    return y_true, (weights if weight_index is not None else None)
+
+
+def _make_proper_list(s, type=None):
+    if isinstance(s, basestring):
+        result = s.split(',')
+        if type is not None:
+            result = [type(x) for x in result]
+        return result
+
+    if not s:
+        return s
+
+    result = []
+    if isinstance(s, list):
+        for x in s:
+            result.extend(_make_proper_list(x, type))
+    else:
+        raise TypeError('Expected list of string: %r' % (s, ))
+    return result
+
+
+def proper_label(s):
+    if '|' in s or ' ' in s or ':' in s:
+        sys.exit('Not a proper label: %r' % s)
+    return s
+
+
+class ParseError(ValueError):
+    pass
+
+
+def parse_mapping(config):
+    """
+    >>> parse_mapping('1:-1,2:1')
+    {'1': '-1', '2': '1'}
+
+    >>> parse_mapping('1:-1,2:1'.split(','))
+    {'1': '-1', '2': '1'}
+    """
+    if not config:
+        return None
 
-        if tunable_params:
-            import scipy.optimize
+    config = _make_proper_list(config)
 
-            options = {'xtol': 0.001, 'ftol': 0.001}
+    if not config:
+        return None
 
-            results = initial_params_db.find_nearest(params_vector)
-            if results:
-                t_params = np.mean(results, axis=0)
-            else:
-                t_params = initial_params_init
+    result = {}
 
-            try:
-                optresult = scipy.optimize.minimize(run, t_params, method='Nelder-Mead', options=options)
-            except InterruptOptimization, ex:
-                log(str(ex), importance=1)
-            else:
-                need_separator = True
-                initial_params_db.add_observation(np.array(params_vector), optresult.x)
-        else:
-            try:
-                run([])
-            except InterruptOptimization, ex:
-                log(str(ex), importance=1)
+    for item in config:
+        if ':' not in item:
+            raise ParseError(item)
+        key, value = item.rsplit(':', 1)
 
-        if need_separator:
-            log('', importance=1)
+        if key in result:
+            log_always('Label %r specified more than once', key)
 
-    return best_result[MARKER_BRANCHBEST]
+        result[key] = value
 
+    return result
 
-def setup_hyperopt_Trials(domain, workers):
-    from vwoptimizelib.third_party.hyperopt import base
-    from vwoptimizelib.third_party.hyperopt.utils import coarse_utcnow
-    from vwoptimizelib.third_party.hyperopt.fmin import FMinIter
-    import threading
-    from Queue import Queue
-    import traceback
 
-    class MT_Trials(base.Trials):
-        """Multithreading-enabled Trials implementation for hyperopt.
-        """
+def parse_weight(config, named_labels=None):
+    """
+    >>> parse_weight('A:B:2', ['A:B', 'another_label'])
+    {'A:B': '2'}
 
-        async = True
+    >>> parse_weight('A:B:2')
+    Traceback (most recent call last):
+     ...
+    SystemExit: Weight must be specified as CLASS(float):WEIGHT, 'A:B' not recognized
+    """
+    if named_labels is not None and not isinstance(named_labels, list):
+        raise TypeError('must be list, not %r' % type(named_labels))
 
-        def __init__(self, domain, poolsize=None):
-            base.Trials.__init__(self)
-            self.domain = domain
-            self.queue = Queue()
-            self.pool = []
-            if poolsize is None:
-                import multiprocessing
-                poolsize = max(1, multiprocessing.cpu_count() - 1)
-                log('setting poolsize = %s', poolsize)
-            self.poolsize = poolsize
-            self.alive = True
-            for _ in xrange(self.poolsize):
-                worker = threading.Thread(target=self._worker_thread, args=tuple())
-                worker.daemon = True
-                worker.start()
-                self.pool.append(worker)
+    try:
+        config = parse_mapping(config)
+    except ParseError, item:
+        sys.exit('Weight must be specified as CLASS:WEIGHT, cannot parse %s' % item)
 
-        def shutdown(self):
-            self.alive = False
-            for _ in xrange(len(self.pool)):
-                self.queue.put(None)
+    if not config:
+        return config
 
-        def insert_trial_docs(self, docs):
-            """ trials - something like is returned by self.new_trial_docs()
-            """
-            docs = [self.assert_valid_trial(base.SONify(doc))
-                    for doc in docs]
-            result = base.Trials._insert_trial_docs(self, docs)
-            for doc in docs:
-                self.queue.put(doc)
-            return result
+    result = {}
 
-        def _handle_one_trial(self, trial):
-            assert trial['state'] == base.JOB_STATE_NEW
-            trial['state'] = base.JOB_STATE_RUNNING
-            now = coarse_utcnow()
-            trial['book_time'] = now
-            trial['refresh_time'] = now
-            spec = base.spec_from_misc(trial['misc'])
-            ctrl = base.Ctrl(self.trials, current_trial=trial)
+    for label, weight in config.items():
+        if named_labels is None:
             try:
-                result = self.domain.evaluate(spec, ctrl)
-            except Exception as e:
-                traceback.print_exc()
-                trial['state'] = base.JOB_STATE_ERROR
-                trial['misc']['error'] = (str(type(e)), str(e))
-                trial['refresh_time'] = coarse_utcnow()
-            else:
-                trial['state'] = base.JOB_STATE_DONE
-                trial['result'] = result
-                trial['refresh_time'] = coarse_utcnow()
-
-        def _worker_thread(self):
-            print_exc = traceback.print_exc
-            while self.alive:
-                trial = self.queue.get()
-                if trial is None:
-                    break
-                try:
-                    self._handle_one_trial(trial)
-                except BaseException:
-                    print_exc()
-                    sys.stderr.write('When handling trial: %r\n\n' % (trial, ))
-                    break
+                float(label)
+            except Exception:
+                sys.exit('Weight must be specified as CLASS(float):WEIGHT, %r not recognized' % (label, ))
+        else:
+            if label not in named_labels:
+                sys.exit('Label %r is not recognized. Expected: %r' % (label, named_labels))
 
-    class FMinIter2(FMinIter):
+        try:
+            float(weight)
+        except Exception:
+            weight = None
 
-        def __init__(self, algo, domain, trials, rstate, async=None,
-                     max_queue_len=1,
-                     poll_interval_secs=1.0,
-                     max_evals=sys.maxsize,
-                     verbose=0,
-                     ):
-            self.algo = algo
-            self.domain = domain
-            self.trials = trials
-            if async is None:
-                self.async = trials.async
-            else:
-                self.async = async
-            self.poll_interval_secs = poll_interval_secs
-            self.max_queue_len = max_queue_len
-            self.max_evals = max_evals
-            self.rstate = rstate
+        if weight is None or weight < 0:
+            sys.exit('Weight must be specified as CLASS:WEIGHT(float), %r is not recognized' % (item, ))
 
-    if workers == 1:
-        return base.Trials(), FMinIter2
+        result[label] = weight
 
-    trials = MT_Trials(domain=domain, poolsize=workers)
-    return trials, FMinIter2
+    return result
 
 
-def str_int(x):
-    return str(int(x))
+def get_sample_weight(y_true, config):
+    if config is None:
+        return None
+    N = len(y_true)
+    result = np.zeros(N)
+    updated = np.zeros(N)
 
+    for klass, weight in config.items():
+        klass = float(klass)
+        weight = float(weight)
+        result += np.multiply(np.ones(N) * weight, y_true == klass)
+        updated += y_true == klass
 
-def vw_optimize_hyperopt(vw_filename, vw_validation_filename, vw_test_filename, y_true, kfold, args, metrics, config, sample_weight, workers, best_result, rounds, validation_holdout):
-    assert isinstance(args, list), args
-    from vwoptimizelib.third_party.hyperopt import hp, base
+    result += (updated == 0)
 
-    space = {}
-    format = {}
+    return result
 
-    unique_id = [0]
 
-    def convert_to_hyperopt(param):
+def process_text(preprocessor, text):
+    if preprocessor is not None:
+        text = preprocessor.process_text(text)
+    else:
+        text = re.sub('\s+', ' ', text)
+    text = text.replace(':', ' ').replace('|', ' ')
+    text = text.strip()
+    return text
 
-        name = param.opt + ' uid=%s' % unique_id[0]
-        unique_id[0] += 1
 
-        if isinstance(param, LogParam):
-            assert param.min is not None and param.max is not None, 'For hyperopt, min and max needed for %s' % param.opt
-            distrib = hp.loguniform(name, np.log(param.min), np.log(param.max))
-        elif isinstance(param, RandIntParam):
-            assert param.max is not None
-            distrib = hp.randint(name, param.max)
-        elif isinstance(param, FloatParam):
-            assert param.min is not None and param.max is not None, 'For hyperopt, min and max needed for %s' % param.opt
-            distrib = hp.uniform(name, param.min, param.max)
-        elif isinstance(param, ValuesParam):
-            distrib = hp.choice(name, param.values)
-        elif isinstance(param, BinaryParam):
-            distrib = hp.choice(name, ['', True])
-        elif isinstance(param, IntegerParam):
-            assert param.min is not None and param.max is not None, 'For hyperopt, min and max needed for %s' % param.opt
-            distrib = hp.quniform(name, param.min, param.max, 1)
-            format[param.opt] = str_int
+def process_texts(preprocessor, texts, shared=None):
+    """Same as [process_text(preprocessor, text) for text in texts], done on all the texts joined together"""
+    joined = join_texts(texts)
+    if joined is not None:
+        if preprocessor is not None:
+            joined = TEXT_SEPARATOR.join(preprocessor.process_texts(texts, shared))
         else:
-            raise TypeError(param)
+            joined = re.sub(r'\s+', ' ', joined)
+        result = [x.strip() for x in joined.replace(':', ' ').replace('|', ' ').split(TEXT_SEPARATOR)]
+        if len(result) == len(texts):
+            return result
+    return [process_text(preprocessor, text) for text in texts]
 
-        if param.omit:
-            distrib = hp.choice(name + '_outer', ['', distrib])
 
-        return distrib
+# characters that cannot be part of a vw feature name
+CATEGORY_TABLE = ''.join('_' if chr(x) in ' \t\r\n:|' else chr(x) for x in xrange(256))
 
-    gridparams = []
-    base_args = []
-    tunable_params = []
-    hierarch_params = [x.replace('-', '') for x in (options.hyperopt_hierarchy or '').split(',')]
-    tunable_params_dict = {}
 
-    for param in args:
-        if isinstance(param, BaseParam) and param.opt.replace('-', '') in hierarch_params:
-            assert isinstance(param, (ValuesParam, BinaryParam))
-            gridparams.append(param)
-        elif 'all_categorical' in hierarch_params and isinstance(param, (ValuesParam, BinaryParam)):
-            gridparams.append(param)
-        elif isinstance(param, BaseParam):
-            tunable_params.append(param)
-            tunable_params_dict[param.opt] = param
-        else:
-            base_args.append(param)
+def format_typed_columns(kind, indices, values, names=None):
+    """Format the values of num or cat columns: values[row][column] is the cell of indices[column].
 
-    choices = []
+    Each column becomes one feature named names[index] (by default its 1-based number): 'name:value' for num columns,
+    skipping zeros and values that are not finite, and 'name=value' for cat columns, skipping empty values.
+    Returns the space separated features of each row.
 
-    already_seen = set()
+    >>> format_typed_columns('num', [2, 3], [['1.5', '0'], ['', ' -2'], ['inf', 'nan']])
+    ['3:1.5', '4:-2', '']
+    >>> format_typed_columns('cat', [0, 1], [['red', 'dark blue'], ['', 'a|b:c']])
+    ['1=red 2=dark_blue', '2=a_b_c']
+    >>> format_typed_columns('num', [1], [['2']], names=['id', 'price'])
+    ['price:2']
+    """
+    if not values:
+        return []
 
-    for grid_param in expand(gridparams):
-        assert isinstance(grid_param, list), grid_param
-        grid_param = vw_normalize_params(grid_param)
-        grid_param = ' '.join(grid_param)
+    values = np.array(values, dtype=str)
 
-        if grid_param in already_seen:
-            # filter out things like "--ngram 1 --skips 1"
-            continue
+    if kind == 'num':
+        # only parse what is not obviously zero
+        keep = (values != '') & (values != '0')
+        try:
+            numbers = np.char.strip(values[keep]).astype(np.float64)
+        except ValueError, ex:
+            sys.exit('Cannot parse the value of a num column: %s' % ex)
+        keep[keep] = (numbers != 0) & np.isfinite(numbers)
+        selected = [x.strip() for x in values[keep].tolist()]
+        separator = ':'
+    else:
+        keep = values != ''
+        selected = [x.strip().translate(CATEGORY_TABLE) for x in values[keep].tolist()]
+        separator = '='
 
-        already_seen.add(grid_param)
+    prefixes = np.array(['%s%s' % (names[index] if names else index + 1, separator) for index in indices])[np.nonzero(keep)[1]].tolist()
+    if kind == 'num':
+        features = map(operator.add, prefixes, selected)
+    else:
+        # values made of spaces are skipped too
+        features = [prefix + value if value else '' for (prefix, value) in izip(prefixes, selected)]
 
-        local_space = {}
-        for param in tunable_params:
-            local_space[param.opt] = convert_to_hyperopt(param)
+    ends = np.cumsum(keep.sum(axis=1)).tolist()
+    return [' '.join(filter(None, features[start:end])) for start, end in izip([0] + ends[:-1], ends)]
+
+
+# the first token with '|', where the features of a vw line start
+VW_FEATURES_START = re.compile(r'[^\s]*\|')
 
-        if local_space:
-            choices.append((grid_param, local_space))
-        else:
-            choices.append(grid_param)
 
-    space = {'grid': hp.choice('grid', choices)}
+def rewrite_vw_label(label, row, weights, named_labels, remap_label):
+    """Apply remap_label and class weights to the label section of vw line row"""
+    if remap_label is not None:
+        new_label = remap_label.get(label.strip())
+        if new_label is not None:
+            label = new_label + ' '
 
-    if best_result is None:
-        best_result = {}
+    if weights:
+        label_items = label.split(' ', 2)
+        y = label_items[0]
 
-    best_result[MARKER_BRANCHBEST] = (float('inf'), None)
+        if named_labels is not None and y not in named_labels:
+            sys.exit('Label not recognized: %r' % (row, ))
 
-    def run(params):
-        log('Parameters: %r', params, importance=-1)
-        args = base_args[:]
+        class_weight = weights.get(y, 1)
+        if class_weight is None or float(class_weight) == 1.0:
+            # don't need to update label/weight part
+            pass
+        else:
+            weight_token = label_items[1] if len(label_items) >= 2 else None
 
-        assert len(params) == 1, params
-        params = params.pop('grid')
-        assert len(params) == 2, params
+            if not weight_token or not weight_token.strip() or weight_token.startswith("'") or weight_token.startswith("|"):
+                example_weight = 1
+                rest_label = ' '.join(label_items[1:])
+            else:
+                example_weight = float(weight_token)
+                rest_label = ' '.join(label_items[2:])
 
-        base, rest = params
+            final_weight = example_weight * float(class_weight)
 
-        args.append(base)
+            if final_weight == 1:
+                label = y + ' ' + rest_label
+            else:
+                label = y + ' ' + str(final_weight) + ' ' + rest_label
 
-        for key, value in sorted(rest.items()):
-            if value == '' or value == 0 or value is None:
-                args.append('')
-                continue
-            param_config = tunable_params_dict[key]
-            # unpack() is only used by LogParam and hyperopt does exponentiation of its own
-            param_config._unpack = None
-            args.append(param_config.get_extra_args(value))
+    return label
 
-        result, is_best = run_single_iteration(
-            vw_filename,
-            vw_validation_filename,
-            vw_test_filename,
-            kfold,
-            args,
-            workers,
-            metrics,
-            y_true,
-            sample_weight,
-            config,
-            best_result,
-            with_predictions=False,
-            validation_holdout=validation_holdout)
 
-        if result is None:
-            return float('inf')
+def get_vw_rewriter(weights, named_labels, remap_label):
+    """Return a function that rewrites the labels in a buffer of complete vw lines, copying the features as they are.
 
+    Same as convert_row_to_vw() on each line without a preprocessor.
+
+    >>> get_vw_rewriter({'1': 2}, None, {'a': '1'})("1 |f x\\n\\n2 'tag|f y  \\na |z")
+    "1 2.0 |f x\\n\\n2 'tag|f y\\n1 2.0 |z\\n"
+    """
+    if not weights and not remap_label:
+        return lambda buffer: buffer
+
+    search = VW_FEATURES_START.search
+
+    def rewrite_line(line):
+        match = search(line)
+        if match is None:
+            if not line.strip():
+                return line
+            raise AssertionError(line)
+        start = match.start()
+        label = line[:start]
+        new_label = rewrite_vw_label(label, line, weights, named_labels, remap_label)
+        if new_label is label:
+            return line.rstrip()
+        return new_label + line[start:].rstrip()
+
+    def rewrite(buffer):
+        lines = buffer.split('\n')
+        last = lines.pop()
+        result = '\n'.join([rewrite_line(line) for line in lines])
+        if lines:
+            result += '\n'
+        if last.strip():
+            # no newline at the end of file
+            result += rewrite_line(last) + '\n'
+        else:
+            result += last
         return result
 
-    env_rseed = os.environ.get('HYPEROPT_FMIN_SEED', '')
-    if env_rseed:
-        rstate = np.random.RandomState(int(env_rseed))
-    else:
-        rstate = np.random.RandomState()
+    return rewrite
 
-    domain = base.Domain(run, space, pass_expr_memo_ctrl=False)
-    trials, FMinIter2 = setup_hyperopt_Trials(domain, workers)
 
-    if '.' not in options.hyperopt_alg:
-        options.hyperopt_alg = 'vwoptimizelib.third_party.hyperopt.%s.suggest' % options.hyperopt_alg
-    alg = _import(options.hyperopt_alg)
-    rval = FMinIter2(algo=alg, domain=domain, trials=trials, rstate=rstate, max_queue_len=workers or 1, poll_interval_secs=0.1)
+def convert_row_to_vw(row, columnspec, preprocessor, weights, named_labels, remap_label):
+    if isinstance(row, basestring):
+        if not row.strip():
+            return row
+        assert '|' in row, row
+        assert columnspec is None, '--columnspec not supported with .vw format'
+        if preprocessor is None and not weights and not remap_label:
+            return row
 
-    assert rounds is not None
-    try:
-        rval.run(rounds)
-    finally:
-        if hasattr(trials, 'shutdown'):
-            trials.shutdown()
+        if preprocessor is None:
+            start = VW_FEATURES_START.search(row).start()
+            label = row[:start]
+            rest = row[start:]
+        else:
+            items = re.split(r'([^\s]*\|[^\s]*)', row)
+            label = items[0]
+            if len(items) <= 2:
+                sys.exit('Cannot parse: %r' % (row, ))
+            processed = []
+            for item in items[1:]:
+                if '|' in item:
+                    processed.append(item)
+                else:
+                    processed.append(' ' + preprocessor.process_text(item) + ' ')
+            rest = ''.join(processed)
 
-    return best_result[MARKER_BRANCHBEST]
+        label = rewrite_vw_label(label, row, weights, named_labels, remap_label)
+        return label + rest.rstrip() + '\n'
 
+    return get_row_converter(columnspec[:], preprocessor, weights, named_labels, remap_label)(row)
+
+
+def get_row_converter(columnspec, preprocessor, weights, named_labels, remap_label, batch=False, memos=None, shared=None, column_names=None):
+    """Return a function that converts a row to vw line, with columnspec interpreted once rather than for every row.
+
+    A trailing '*' repeats the last spec for the remaining columns of the first row.
+    If column_names (the header) is given, num and cat columns are named after it rather than numbered.
+
+    With batch=True, the function converts a list of rows into a list of lines and processes their texts together.
+    If memos is a dict, processed values of each text column are cached in memos[column index] (see ColumnMemo).
+    If shared is a dict, it is passed to Preprocessor.process_texts(), so that converters of several preprocessors
+    run over the same rows compute their common stages once. The caller clears it between batches.
+
+    >>> convert = get_row_converter(['y', 'text', 'vw_n', 'info'], None, None, None, None)
+    >>> convert(['1', 'Hello, World:', 'a:2 b', 'id1'])
+    "1 'id1  | Hello, World |n a:2 b\\n"
+    >>> convert = get_row_converter(['weight', 'y', 'text_a', '*'], None, {'1': 2}, None, {'one': '1'})
+    >>> convert(['0.5', 'one', 'x', 'y', 'z'])
+    '1 1.0 |a x y z\\n'
+    >>> convert(['1', 'two', 'x', 'y', 'z'])
+    'two 1 |a x y z\\n'
+    >>> get_row_converter(['y', 'text'], None, None, None, None, batch=True)([['1', 'a:b'], ['2', 'c  d']])
+    ['1 | a b\\n', '2 | c d\\n']
+    >>> get_row_converter(['y', 'num_n', 'num_n', 'cat_c', 'text'], None, None, None, None, batch=True)([['1', '0.5', '0', 'FR', 'x'], ['0', '0', '0', '', 'y']])
+    ['1 |n 2:0.5 |c 4=FR | x\\n', '0 | y\\n']
+    >>> get_row_converter(['y', 'num_n', 'cat_c'], None, None, None, None, column_names=['y', 'unit price', ''])(['1', '2', 'FR'])
+    '1 |n unit_price:2 |c 3=FR\\n'
+    """
+    if columnspec is None:
+        if batch:
+            return lambda rows: [convert_row_to_vw(row, None, preprocessor, weights, named_labels, remap_label) for row in rows]
+        return lambda row: convert_row_to_vw(row, None, preprocessor, weights, named_labels, remap_label)
 
-class Simple1NN(object):
+    assert isinstance(columnspec, list), columnspec
 
-    def __init__(self):
-        self.observations = []
+    if columnspec[-1] == '*':
+        compiled = []
+
+        def convert_first_row(row):
+            if batch and not row:
+                return []
+            if not compiled:
+                first_row = row[0] if batch else row
+                expanded = columnspec[:-1]
+                while len(expanded) < len(first_row):
+                    expanded.append(expanded[-1])
+                compiled.append(get_row_converter(expanded, preprocessor, weights, named_labels, remap_label, batch=batch, memos=memos, shared=shared, column_names=column_names))
+            return compiled[0](row)
+
+        return convert_first_row
+
+    ncolumns = len(columnspec)
+    label_index = None
+    weight_index = None
+    weight_train_index = None
+    info_indices = []
+    # (column indices, kind, namespace, namespace header); consecutive num/cat columns of the same namespace are grouped
+    features = []
 
-    def add_observation(self, x, y):
-        self.observations.append((x, y))
+    for index, spec in enumerate(columnspec):
+        if spec == 'y':
+            label_index = index
+        elif spec == 'text' or spec.startswith('text_'):
+            features.append(([index], 'text', spec[5:], '|' + spec[5:]))
+        elif spec == 'vw' or spec.startswith('vw_'):
+            features.append(([index], 'vw', spec[3:], '|' + spec[3:]))
+        elif spec in ('num', 'cat') or spec.startswith('num_') or spec.startswith('cat_'):
+            column_kind, namespace = spec[:3], spec[4:]
+            if features and features[-1][1:3] == (column_kind, namespace) and features[-1][0][-1] == index - 1:
+                features[-1][0].append(index)
+            else:
+                features.append(([index], column_kind, namespace, '|' + namespace))
+        elif spec == 'info':
+            info_indices.append(index)
+        elif spec == 'drop' or not spec:
+            continue
+        elif spec == 'weight':
+            weight_index = index
+        elif spec == 'weight_train':
+            weight_train_index = index
+        elif spec == 'weight_metric':
+            pass  # used by read_y_true
+        else:
+            sys.exit('Spec item %r not understood' % spec)
 
-    def find_nearest(self, query_x):
-        nearest_items = []
-        nearest_distance = float('inf')
-        for x, y in self.observations:
-            dist = np.sum(np.abs(x - query_x))
-            # print 'query=%s x=%s y=%s dist=%s' % (query_x, x, y, dist)
-            if dist < nearest_distance:
-                nearest_distance = dist
-                nearest_items = [y]
-            elif dist == nearest_distance:
-                nearest_items.append(y)
-        return nearest_items
+    has_weight = bool(weights) or weight_index is not None or weight_train_index is not None
+    if column_names is not None:
+        # unnamed columns keep their numbers
+        column_names = [name.strip().translate(CATEGORY_TABLE) or str(index + 1) for (index, name) in enumerate(column_names)]
+    # features whose values are computed from the cells rather than copied
+    computed = [(indices, kind) for (indices, kind, _namespace, _header) in features if kind != 'vw']
+
+    if memos is not None:
+        for indices, kind in computed:
+            if kind == 'text':
+                memos[indices[0]] = ColumnMemo()
+
+    def check_length(row):
+        if len(row) != ncolumns:
+            sys.exit('Expected %r columns (%r), got %r (%r)' % (ncolumns, columnspec, len(row), row))
+
+    def convert_row(row):
+        check_length(row)
+        values = []
+        for indices, kind in computed:
+            if kind == 'text':
+                values.append(process_text(preprocessor, row[indices[0]]))
+            else:
+                values.append(format_typed_columns(kind, indices, [[row[index] for index in indices]], column_names)[0])
+        return build_line(row, values)
+
+    def convert_rows(rows):
+        for row in rows:
+            if len(row) != ncolumns:
+                check_length(row)
+
+        if not computed:
+            return [build_line(row, ()) for row in rows]
+
+        columns = []
+        for indices, kind in computed:
+            if kind != 'text':
+                if len(indices) == 1:
+                    cells = [[row[indices[0]]] for row in rows]
+                else:
+                    cells = map(operator.itemgetter(*indices), rows)
+                columns.append(format_typed_columns(kind, indices, cells, column_names))
+                continue
+            values = [row[indices[0]] for row in rows]
+            memo = memos.get(indices[0]) if memos is not None else None
+            if memo is not None and memo.enabled:
+                columns.append(memo.process(values, lambda values: process_texts(preprocessor, values, shared)))
+            else:
+                columns.append(process_texts(preprocessor, values, shared))
+
+        return [build_line(row, row_values) for row, row_values in izip(rows, izip(*columns))]
+
+    def build_line(row, values):
+        y = row[label_index] if label_index is not None else ''
+        x = []
+        last_namespace = None
+        values = iter(values)
+
+        for indices, kind, namespace, header in features:
+            if kind == 'vw':
+                item = row[indices[0]]
+                if not item.startswith('|') and (not x or namespace != last_namespace):
+                    x.append(header)
+                x.append(item)
+                if '|' in item:
+                    last_namespace = None
+                else:
+                    last_namespace = namespace
+            elif kind == 'text':
+                if not x or namespace != last_namespace:
+                    x.append(header)
+                x.append(values.next())
+                if '|' in row[indices[0]]:
+                    last_namespace = None
+                else:
+                    last_namespace = namespace
+            else:
+                item = values.next()
+                if item:
+                    if not x or namespace != last_namespace:
+                        x.append(header)
+                    x.append(item)
+                    last_namespace = namespace
+
+        if info_indices:
+            info = " '%s" % ';'.join([row[index] for index in info_indices]) + ' '
+        else:
+            info = ''
 
+        if named_labels is not None and y not in named_labels:
+            sys.exit('Label not recognized: %r' % (row, ))
 
-def vw_normalize_params(params):
-    """
-    >>> vw_normalize_params(['--ngram', '1'])
-    []
-    >>> vw_normalize_params(['--ngram', '1', '--skips', '1'])
-    []
-    >>> vw_normalize_params(['--skips', '1'])
-    []
-    >>> vw_normalize_params(['--ngram', '2', '--skips', '1'])
-    ['--ngram', '2', '--skips', '1']
-    """
-    params = ' '.join(params)
-    params = params.replace('--ngram 1', '')
-    params = params.replace('--skips 0', '')
-    if '--ngram' not in params:
-        params = re.sub('--skips \d+', '', params)
-    params = re.sub('\s+', ' ', params)
-    return params.split()
+        if remap_label is not None:
+            y = remap_label.get(y, y)
 
+        if not has_weight:
+            return y + info + ' ' + ' '.join(x) + '\n'
 
-def expand(gridsearch_params, only=None, withextra=False):
-    result = list(_expand(gridsearch_params, only=only))
-    result.sort()
-    if withextra:
-        return result
-    return [x[1] for x in result]
+        example_weight = row[weight_index] if weight_index is not None else None
+        if weight_train_index is not None:
+            example_weight = row[weight_train_index] or example_weight
 
+        class_weight = weights.get(y) if weights is not None else None
 
-def _expand(gridsearch_params, only=None, score_mult=1):
-    if not gridsearch_params:
-        yield (0, [], [])
-        return
+        if example_weight is not None and class_weight is not None:
+            weight = float(example_weight) * float(class_weight)
+        elif example_weight is None:
+            weight = class_weight
+        else:
+            weight = example_weight
 
-    first_arg = gridsearch_params[0]
+        if weight is None:
+            weight = ''
+        else:
+            weight = ' ' + str(weight).strip()
 
-    if isinstance(first_arg, basestring):
-        skip = True
-    elif only is not None and getattr(first_arg, 'opt', '') not in only:
-        skip = True
-    else:
-        skip = False
+        return y + weight + info + ' ' + ' '.join(x) + '\n'
 
-    if skip:
-        for inner_score, inner_cmd, inner_vector in _expand(gridsearch_params[1:], only=only, score_mult=score_mult):
-            yield (inner_score, _filter([first_arg] + inner_cmd), inner_vector)
-        return
+    if batch:
+        return convert_rows
+    return convert_row
 
-    for index, first_arg_variant in enumerate(first_arg.enumerate_all()):
-        for inner_score, inner, inner_vector in _expand(gridsearch_params[1:], only=only, score_mult=score_mult * 1.01):
-            new_inner_vector = [index] + inner_vector
-            yield (index * score_mult + inner_score, _filter([first_arg_variant] + inner), new_inner_vector)
 
+def _convert_any_to_vw(source, format, output, weights, preprocessor, columnspec, named_labels, remap_label, ignoreheader, byte_range=None, row_range=None, column_names=None):
+    """Convert source to vw format. With row_range, source is a ColumnStore directory and only rows [start, end) are converted."""
+    if format == 'vw' and preprocessor is None:
+        # only the labels change, work on large buffers
+        if named_labels is not None:
+            assert not isinstance(named_labels, basestring)
+            named_labels = set(named_labels)
+        if byte_range is not None:
+            chunks = read_byte_range_chunks(source, *byte_range)
+        else:
+            chunks = read_chunks(open_regular_or_compressed(source))
+        rewrite = get_vw_rewriter(weights, named_labels, remap_label)
+        output = open_output(output)
+        for chunk in chunks:
+            output.write(rewrite(chunk))
+        flush_and_close(output)
+        return
 
-def _filter(lst):
-    return [x for x in lst if x]
+    _convert_variants_to_vw(source, format, [output], weights, [preprocessor], columnspec, named_labels, remap_label, ignoreheader, byte_range=byte_range, row_range=row_range, column_names=column_names)
 
 
-def get_language(doc):
-    import pycld2
-    if isinstance(doc, unicode):
-        doc = doc.encode('utf-8')
-    try:
-        return pycld2.detect(doc, bestEffort=True)[2][0][0].lower()
-    except Exception, ex:
-        sys.stderr.write('Cannot detect language of %r\n%s\n' % (doc, ex))
+def _convert_variants_to_vw(source, format, outputs, weights, preprocessors, columnspec, named_labels, remap_label, ignoreheader, byte_range=None, row_range=None, column_names=None):
+    """
+    Convert source to vw format once per preprocessor, outputs[i] being the result of preprocessors[i].
 
+    column_names is the header of the data when the part of it being converted does not start with it.
 
-def get_stemmer(language, stemmers={}):
-    if language in stemmers:
-        return stemmers[language]
-    from nltk.stem import SnowballStemmer
-    try:
-        stemmers[language] = SnowballStemmer(language)
-    except Exception:
-        stemmers[language] = 0
+    The rows are read once. Every batch of rows is given to all the preprocessors in turn, which share the results of
+    their common leading stages (see Preprocessor.process_texts), so e.g. decoding and NFKC are done once per row
+    for variants that only differ by --lowercase.
+    """
+    if named_labels is not None:
+        assert not isinstance(named_labels, basestring)
+        named_labels = set(named_labels)
 
-    return stemmers[language]
+    if row_range is not None:
+        rows_source = ColumnStore(source).iter_rows(row_range[0], row_range[1], columns=get_used_columns(columnspec))
+    elif byte_range is None and get_column_store_path(source, format, ignoreheader) is not None:
+        # the whole file is read here, its column store is built on the way for the next runs
+        rows_source = open_rows(source, format, ignoreheader)
+        if ignoreheader and column_names is None:
+            column_names = read_column_names(source, format)
+    elif ignoreheader and byte_range is None and format != 'vw' and not isinstance(source, list):
+        # the header is read here rather than skipped, source may be a stream
+        rows_source = open_anything(source, format, ignoreheader=False)
+        column_names = next(rows_source, None)
+    else:
+        rows_source = open_anything(source, format, ignoreheader=ignoreheader, byte_range=byte_range)
+        if ignoreheader and column_names is None and byte_range is None:
+            column_names = read_column_names(source, format)
+
+    shared = {}
+    converters = []
+    all_memos = []
+
+    for preprocessor in preprocessors:
+        memos = {}
+        if format == 'vw' and preprocessor is None:
+            rewrite = get_vw_rewriter(weights, named_labels, remap_label)
+            converters.append(lambda rows, rewrite=rewrite: [rewrite(''.join(rows))])
+        else:
+            converters.append(get_row_converter(columnspec, preprocessor=preprocessor, weights=weights, named_labels=named_labels, remap_label=remap_label, batch=True, memos=memos, shared=shared, column_names=column_names))
+        all_memos.append(memos)
 
+    outputs = [open_output(output) for output in outputs]
 
-def stem_words(words):
-    base_stemmer = False
-    result = []
-    for word in words:
-        if len(word) > 2:
-            language = None
+    while True:
+        rows = list(islice(rows_source, CONVERSION_WRITE_BATCH))
+        if not rows:
+            break
+        for convert_rows, output in izip(converters, outputs):
             try:
-                language = get_language(word)
-                stemmer = get_stemmer(language)
-                if stemmer:
-                    word = stemmer.stem(word)
-                else:
-                    if base_stemmer is False:
-                        base_language = get_language(' '.join(words))
-                        base_stemmer = get_stemmer(base_language)
-                    if base_stemmer:
-                        language = base_language
-                        word = base_stemmer.stem(word)
-            except Exception, ex:
-                sys.stderr.write('Cannot stem %r %r: %s\n' % (language, word, ex))
-        result.append(word)
-    return result
+                lines = convert_rows(rows)
+            except Exception:
+                # find the row that failed
+                for row in rows:
+                    try:
+                        convert_rows([row])
+                    except Exception:
+                        log_always('Failed to parse: %r', row)
+                        raise
+                raise
+            output.writelines(lines)
+        shared.clear()
 
+    for output in outputs:
+        flush_and_close(output)
 
-def chinese_simplify(unistr, cache={}):
-    u"""
-    This function does the same as hanziconv's module toSimplified() but order of magnitude faster
+    for preprocessor, memos in izip(preprocessors, all_memos):
+        for index, memo in sorted(memos.items()):
+            if len(preprocessors) > 1:
+                log('Cached values of column %s with %s: %s', index + 1, preprocessor or 'no preprocessing', memo, importance=0)
+            else:
+                log('Cached values of column %s: %s', index + 1, memo, importance=0)
 
-    >>> print chinese_simplify(u'繁簡轉換器')
-    繁简转换器
 
-    >>> from hanziconv import HanziConv
-    >>> from hanziconv.charmap import traditional_charmap
-    >>> HanziConv.toSimplified(traditional_charmap) == chinese_simplify(traditional_charmap)
-    True
+def get_preprocessor(preprocessor_opts, cache={}):
+    if preprocessor_opts not in cache:
+        cache[preprocessor_opts] = Preprocessor.from_options(preprocessor_opts)
+    return cache[preprocessor_opts]
 
-    >>> import timeit
-    >>> timeit.timeit(lambda : chinese_simplify(traditional_charmap), number=1000) # doctest:+SKIP
-    0.1961040496826172
 
-    >>> toSimplified = HanziConv.toSimplified
-    >>> timeit.timeit(lambda : toSimplified(traditional_charmap), number=1000) # doctest:+SKIP
-    4.9171209335327150
-    """
-    table = cache.get('table')
-    if table is None:
-        from hanziconv.charmap import traditional_charmap, simplified_charmap
-        table = dict((ord(char1), char2) for char1, char2 in izip(reversed(traditional_charmap), reversed(simplified_charmap)))
-        cache['table'] = table
-    return unistr.translate(table)
+def _convert_batch(task):
+    """Run by the conversion pool. Returns None on success and exit status otherwise."""
+    source, format, outputs, weights, preprocessor_opts, columnspec, named_labels, remap_label, ignoreheader, column_names, byte_range, row_range = task
+    try:
+        if len(outputs) == 1:
+            convert = _convert_any_to_vw
+            outputs = outputs[0]
+            preprocessors = get_preprocessor(preprocessor_opts[0])
+        else:
+            convert = _convert_variants_to_vw
+            preprocessors = [get_preprocessor(opts) for opts in preprocessor_opts]
+        convert(
+            source,
+            format,
+            outputs,
+            weights,
+            preprocessors,
+            columnspec,
+            named_labels,
+            remap_label,
+            ignoreheader=ignoreheader,
+            byte_range=byte_range,
+            row_range=row_range,
+            column_names=column_names)
+    except SystemExit, ex:
+        return ex.code if ex.code is not None else 1
+    except Exception:
+        traceback.print_exc()
+        return 1
 
 
-def get_regex(range_name, cache={}):
-    result = cache.get(range_name)
-    if result is not None:
-        return result
-    result = re.compile(_generate_regex(range_name, RANGES[range_name]))
-    cache[range_name] = result
-    return result
+CONVERSION_POOL = None
 
 
-def _generate_regex(name, range):
-    result = []
-    ignored = 0
-    included = 0
-    for item in range:
-        try:
-            count = 0
-            if len(item) == 1:
-                count = 1
-                result.append(unichr(item[0]))
-            else:
-                count = item[1] - item[0] + 1
-                result.append(unichr(item[0]) + '-' + unichr(item[1]))
-        except ValueError, ex:
-            if 'unichr() arg not in range' in str(ex):
-                ignored += count
-            else:
-                raise
-        else:
-            included += count
+def get_conversion_pool(workers):
+    """Pool of processes that run _convert_batch. Created once and reused by all conversions of the run."""
+    global CONVERSION_POOL
+    if CONVERSION_POOL is None:
+        import multiprocessing
+        CONVERSION_POOL = multiprocessing.Pool(workers, initializer=die_if_parent_dies)
+    return CONVERSION_POOL
 
-    if ignored:
-        log_always("%s: Ignored %s characters (left with %s)", name, ignored, included)
 
-    if not included:
-        sys.exit('%s: empty range' % name)
+def shutdown_conversion_pool():
+    global CONVERSION_POOL
+    if CONVERSION_POOL is not None:
+        CONVERSION_POOL.terminate()
+        CONVERSION_POOL.join()
+        CONVERSION_POOL = None
 
-    return u'[' + u''.join(result) + u']'
 
+def iter_conversion_tasks(tasks, workers, function=_convert_batch):
+    """Run tasks with function in the conversion pool, yielding them in order as they complete"""
+    if len(tasks) <= 1:
+        # not worth a round trip to another process
+        results = [function(task) for task in tasks]
+    else:
+        pending = get_conversion_pool(workers).imap(function, tasks, chunksize=1)
+        # a timeout makes the wait interruptible with Ctrl-C
+        results = (pending.next(2 ** 31) for _task in tasks)
 
-# ideograph total chars=75640
-# hangul total chars=11735
-# hiragana total chars=97
-# katakana total chars=223
-# combined total chars=87688
-RANGES = {
-    'combined': [[4352, 4607], [12272, 12283], [12288, 12290], [12293, 12295], [12330, 12335], [12343], [12347], [12350, 12351], [12353, 12438], [12441, 12543], [12593, 12686], [12688, 12703], [12784, 12828], [12832, 12871], [12896, 12923], [12926], [12928, 12976], [12992, 13003], [13008, 13054], [13144, 13168], [13280, 13310], [13312, 19893], [19968, 40907], [43360, 43388], [44032, 55203], [55216, 55238], [55243, 55291], [63744, 64045], [64048, 64109], [64112, 64217], [65041, 65042], [65105], [65377], [65380, 65470], [65474, 65479], [65482, 65487], [65490, 65495], [65498, 65500], [127488], [127504, 127537], [127552, 127560], [131072, 173782], [173824, 177972], [194560, 195101]],
-    'hangul': [[4352, 4607], [12334, 12335], [12593, 12686], [12800, 12828], [12896, 12923], [12926], [43360, 43388], [44032, 55203], [55216, 55238], [55243, 55291], [65440, 65470], [65474, 65479], [65482, 65487], [65490, 65495], [65498, 65500]],
-    'hiragana': [[12353, 12438], [12441, 12448], [12540], [65392], [127488]],
-    'ideographs': [[12272, 12283], [12288, 12290], [12293, 12295], [12330, 12333], [12343], [12347], [12350, 12351], [12688, 12703], [12832, 12871], [12928, 12976], [12992, 13003], [13144, 13168], [13280, 13310], [13312, 19893], [19968, 40907], [63744, 64045], [64048, 64109], [64112, 64217], [65041, 65042], [65105], [65377], [65380], [127504, 127506], [127508, 127537], [127552, 127560], [131072, 173782], [173824, 177972], [194560, 195101]],
-    'katakana': [[12441, 12444], [12448, 12543], [12784, 12799], [13008, 13054], [65381, 65439], [127507]]
-}
+    for task, result in izip(tasks, results):
+        if result is not None:
+            sys.exit(result)
+        yield task
 
 
-class Preprocessor(object):
-    ur"""
-    >>> Preprocessor(split_ideographs=True, chinese_simplify=True).process_text(u'hello 繁簡轉換器'.encode('utf8'))
-    'hello \xe7\xb9\x81 \xe7\xae\x80 \xe8\xbd\xac \xe6\x8d\xa2 \xe5\x99\xa8'
+def split_min_token_count(preprocessor_opts):
     """
+    Return min_token_count of preprocessor_opts (None if not set) and the rest of the options
 
-    ALL_OPTIONS_BINARY = '''
-        htmlunescape
-        lowercase
-        strip_punct
-        stem
-        split_chars
-        split_ideographs
-        split_hangul
-        split_hiragana
-        split_katakana
-        split_combined
-        chinese_simplify
-        NFKC
-        remove_duplicate_words
-    '''.strip().split()
+    >>> split_min_token_count('--lowercase --min_token_count 2')
+    (2, '--lowercase')
+    >>> split_min_token_count('--lowercase')
+    (None, '--lowercase')
+    """
+    preprocessor = get_preprocessor(preprocessor_opts)
+    if preprocessor is None or not preprocessor.min_token_count:
+        return None, preprocessor_opts
+    options = [x for x in preprocessor.to_options() if x.split()[0] != '--min_token_count']
+    return preprocessor.min_token_count, ' '.join(options)
 
-    ALL_OPTIONS_INT = '''
-        max_words
-        max_length
-        max_length_offset
-        max_word_size
-    '''.strip().split()
 
-    ALL_OPTIONS = ALL_OPTIONS_BINARY + ALL_OPTIONS_INT
+def parse_vw_namespaces(line):
+    """
+    Split vw line into the part before the first '|' and the list of (namespace, header, features) after it
 
-    ALL_OPTIONS_DASHDASH = ['--%s' % x for x in ALL_OPTIONS]
+    >>> parse_vw_namespaces("1 'id | a b:2 |n:0.5 c\\n")
+    ("1 'id ", [('', '', ['a', 'b:2']), ('n', 'n:0.5', ['c'])])
+    """
+    parts = line.split('|')
+    namespaces = []
+    for part in parts[1:]:
+        if not part or part[0].isspace():
+            namespaces.append(('', '', part.split()))
+        else:
+            items = part.split()
+            namespaces.append((items[0].split(':', 1)[0], items[0], items[1:]))
+    return parts[0], namespaces
 
-    @classmethod
-    def init_option_parser(cls, parser):
-        for opt in cls.ALL_OPTIONS_BINARY:
-            parser.add_option('--%s' % opt, action='store_true')
-        for opt in cls.ALL_OPTIONS_INT:
-            parser.add_option('--%s' % opt, type=int)
 
-    @classmethod
-    def parse_options(cls, string):
-        parser = PassThroughOptionParser()
-        cls.init_option_parser(parser)
-        options, args = parser.parse_args(string.split())
-        return options.__dict__
+def get_feature_keys(parsed_lines):
+    """Keys counted by TokenSketch for the features of lines parsed by parse_vw_namespaces: namespace and feature name"""
+    return [namespace + ' ' + feature.split(':', 1)[0]
+            for (_prefix, namespaces) in parsed_lines
+            for (namespace, _header, features) in namespaces
+            for feature in features]
+
+
+class TokenSketch(object):
+    """
+    Count-min sketch of the number of occurrences of features, in a fixed amount of memory however many there are.
+
+    The estimates are never less than the true counts. They are more only if a feature collides with frequent ones
+    in all the rows of the table.
+
+    >>> sketch = TokenSketch(width=1024)
+    >>> sketch.add(['a x', 'a y', 'a x', 'b x'])
+    >>> map(int, sketch.estimate(['a x', 'a y', 'b x', 'b y']))
+    [2, 1, 1, 0]
+    """
+
+    # odd 64-bit constants of multiply-shift hashing, one per row
+    MULTIPLIERS = [0x9E3779B97F4A7C15, 0xC2B2AE3D27D4EB4F, 0x165667B19E3779F9, 0xD6E8FEB86659FD93]
+
+    def __init__(self, width=TOKEN_SKETCH_WIDTH, table=None):
+        if table is None:
+            assert width & (width - 1) == 0, width
+            table = np.zeros((len(self.MULTIPLIERS), width), dtype=np.uint32)
+        self.table = table
+        self.shift = np.uint64(64 - int(math.log(table.shape[1], 2)))
 
     @classmethod
-    def from_options(cls, options):
-        if not options:
-            return None
+    def load(cls, filename):
+        return cls(table=np.load(filename))
 
-        if isinstance(options, list):
-            options = ' '.join(x for x in options if isinstance(x, basestring))
+    def save(self, filename):
+        np.save(filename, self.table)
 
-        if isinstance(options, basestring):
-            options = cls.parse_options(options)
+    def update(self, other):
+        self.table += other.table
 
-        for opt in cls.ALL_OPTIONS:
-            if options[opt] is not None:
-                break
-        else:
-            return None
+    def _indices(self, keys):
+        hashes = np.fromiter((hash(key) for key in keys), dtype=np.int64, count=len(keys)).view(np.uint64)
+        return [(hashes * np.uint64(multiplier)) >> self.shift for multiplier in self.MULTIPLIERS]
 
-        return cls(**options)
+    def add(self, keys):
+        for row, indices in izip(self.table, self._indices(keys)):
+            indices, counts = np.unique(indices, return_counts=True)
+            row[indices] += counts.astype(np.uint32)
 
-    def to_options(self):
-        result = ['--%s' % opt for opt in self.ALL_OPTIONS_BINARY if getattr(self, opt, None)]
-        result += ['--%s %s' % (opt, getattr(self, opt)) for opt in self.ALL_OPTIONS_INT if getattr(self, opt, None)]
+    def estimate(self, keys):
+        result = None
+        for row, indices in izip(self.table, self._indices(keys)):
+            counts = row[indices]
+            result = counts if result is None else np.minimum(result, counts)
+        if result is None:
+            return np.zeros(0, dtype=np.uint32)
         return result
 
-    def __init__(self, **kwargs):
-        for option in self.ALL_OPTIONS_BINARY:
-            setattr(self, option, kwargs.get(option, False))
 
-        for option in self.ALL_OPTIONS_INT:
-            value = kwargs.get(option)
-            if value is not None:
-                value = int(value)
-            setattr(self, option, value)
+def mix_hashes(hashes):
+    """64-bit finalizer of MurmurHash3 on an array of Python hash() values, so that all their bits are well mixed"""
+    hashes = hashes.astype(np.uint64)
+    hashes ^= hashes >> np.uint64(33)
+    hashes *= np.uint64(0xFF51AFD7ED558CCD)
+    hashes ^= hashes >> np.uint64(33)
+    hashes *= np.uint64(0xC4CEB9FE1A85EC53)
+    hashes ^= hashes >> np.uint64(33)
+    return hashes
 
-        if self.stem:
-            stem_words(["testing"])
-            self.lowercase = True
-            self.strip_punct = True
 
-        if self.split_chars or self.split_combined:
-            self.split_ideographs = False
-            self.split_hangul = False
-            self.split_hiragana = False
-            self.split_katakana = False
+def bit_length(values):
+    """
+    Vectorized int.bit_length() for an array of uint64
 
-        if self.split_chars:
-            self.split_combined = False
+    >>> bit_length(np.array([0, 1, 5, 2 ** 32 - 1, 2 ** 32, 2 ** 64 - 1], dtype=np.uint64)).tolist()
+    [0, 1, 3, 32, 33, 64]
+    """
+    high = (values >> np.uint64(32)).astype(np.float64)
+    low = (values & np.uint64(0xFFFFFFFF)).astype(np.float64)
+    # exact for integers below 2 ** 32
+    high_length = 33 + np.floor(np.log2(np.maximum(high, 1)))
+    low_length = np.where(low > 0, 1 + np.floor(np.log2(np.maximum(low, 1))), 0)
+    return np.where(high > 0, high_length, low_length).astype(np.int64)
 
-        for range in RANGES:
-            if getattr(self, 'split_%s' % range):
-                setattr(self, 'split_%s' % range, get_regex(range))
 
-    def __str__(self):
-        return ' '.join(self.to_options())
+class HyperLogLog(object):
+    """
+    Estimate of the number of distinct keys, in 2 ** precision bytes whatever their number.
 
-    def __repr__(self):
-        return '%s(%s)' % (type(self).__name__, ', '.join('%s=%r' % (name, getattr(self, name, None)) for name in self.ALL_OPTIONS))
+    >>> hll = HyperLogLog()
+    >>> hll.add(['feature%s' % x for x in xrange(100000)] * 2)
+    >>> abs(hll.count() / 100000.0 - 1) < 0.05
+    True
+    >>> HyperLogLog().count()
+    0.0
+    """
 
-    def process_text(self, text):
-        orig = text
-        try:
-            text = text.decode('utf-8', errors='ignore')
+    def __init__(self, precision=HLL_PRECISION, registers=None):
+        if registers is None:
+            registers = np.zeros(1 << precision, dtype=np.uint8)
+        self.registers = registers
+        self.precision = int(math.log(len(registers), 2))
+
+    def add(self, keys):
+        if not keys:
+            return
+        hashes = mix_hashes(np.fromiter((hash(key) for key in keys), dtype=np.int64, count=len(keys)).view(np.uint64))
+        width = 64 - self.precision
+        indices = (hashes >> np.uint64(width)).astype(np.int64)
+        ranks = width + 1 - bit_length(hashes & np.uint64((1 << width) - 1))
+        # maximum rank per register
+        order = np.lexsort((ranks, indices))
+        indices = indices[order]
+        ranks = ranks[order]
+        last = np.append(indices[1:] != indices[:-1], True)
+        indices = indices[last]
+        self.registers[indices] = np.maximum(self.registers[indices], ranks[last])
+
+    def update(self, other):
+        np.maximum(self.registers, other.registers, out=self.registers)
+
+    def count(self):
+        size = float(len(self.registers))
+        alpha = 0.7213 / (1 + 1.079 / size)
+        estimate = alpha * size * size / np.sum(np.power(2.0, -self.registers.astype(np.float64)))
+        zeros = np.count_nonzero(self.registers == 0)
+        if estimate <= 2.5 * size and zeros:
+            # linear counting is more accurate for small cardinalities
+            estimate = size * math.log(size / zeros)
+        return float(estimate)
+
+
+def read_vw_lines(source, byte_range):
+    """Yield lists of complete lines of vw file source (or list of shards), or of its byte range if not None"""
+    if byte_range is not None:
+        chunks = read_byte_range_chunks(source, *byte_range)
+    elif isinstance(source, list):
+        chunks = (chunk for shard in source for chunk in read_chunks(open_regular_or_compressed(shard)))
+    else:
+        chunks = read_chunks(open_regular_or_compressed(source))
+    for chunk in chunks:
+        lines = chunk.split('\n')
+        if not lines[-1]:
+            lines.pop()
+        yield lines
 
-            if self.max_length_offset is not None:
-                text = text[self.max_length_offset:]
 
-            if self.max_length is not None:
-                text = text[:self.max_length]
+def prune_lines(lines, parsed_lines, keep):
+    """
+    Remove features of lines for which keep is false, keep being aligned with get_feature_keys(parsed_lines)
 
-            # quite costly
-            # if self.normalize_space:
-            #     text = u''.join(u' ' if unicodedata.category(x)[:1] in 'CZ' else x for x in text)
+    >>> lines = ['1 | a b |n c', '0 | d']
+    >>> prune_lines(lines, [parse_vw_namespaces(x) for x in lines], [True, False, False, True])
+    ['1 | a |n', '0 | d']
+    """
+    result = []
+    position = 0
+    for line, (prefix, namespaces) in izip(lines, parsed_lines):
+        count = sum(len(features) for (_namespace, _header, features) in namespaces)
+        line_keep = keep[position:position + count]
+        position += count
+        if all(line_keep):
+            result.append(line)
+            continue
+        line_keep = iter(line_keep)
+        pieces = []
+        for _namespace, header, features in namespaces:
+            kept = [feature for feature in features if line_keep.next()]
+            pieces.append(' '.join([header] + kept) if kept else header)
+        result.append(prefix + '|' + ' |'.join(pieces))
+    return result
 
-            if self.htmlunescape:
-                text = htmlparser_unescape(text)
 
-            if self.NFKC:
-                text = unicodedata.normalize('NFKC', text)
+def _count_tokens(task):
+    """Run by the conversion pool: count features of a part of a vw file into a sketch. Returns None on success and exit status otherwise."""
+    source, byte_range, sketch_filename = task
+    try:
+        sketch = TokenSketch()
+        for lines in read_vw_lines(source, byte_range):
+            sketch.add(get_feature_keys([parse_vw_namespaces(line) for line in lines]))
+        sketch.save(sketch_filename)
+    except SystemExit, ex:
+        return ex.code if ex.code is not None else 1
+    except Exception:
+        traceback.print_exc()
+        return 1
 
-            if self.lowercase:
-                text = text.lower()
 
-            if self.chinese_simplify:
-                text = chinese_simplify(text)
+def _prune_tokens(task):
+    """Run by the conversion pool: write a part of a vw file once per min count, without the rarer features. Returns None on success and exit status otherwise."""
+    source, byte_range, parts, sketch_filename, min_counts = task
+    try:
+        sketch = TokenSketch.load(sketch_filename)
+        outputs = [open_output(part) for part in parts]
+        for lines in read_vw_lines(source, byte_range):
+            parsed_lines = [parse_vw_namespaces(line) for line in lines]
+            counts = sketch.estimate(get_feature_keys(parsed_lines))
+            for min_count, output in izip(min_counts, outputs):
+                keep = (counts >= min_count).tolist()
+                output.writelines(line + '\n' for line in prune_lines(lines, parsed_lines, keep))
+        for output in outputs:
+            flush_and_close(output)
+    except SystemExit, ex:
+        return ex.code if ex.code is not None else 1
+    except Exception:
+        traceback.print_exc()
+        return 1
 
-            if self.strip_punct:
-                words = re.findall(r"(?u)\b\w\w+\b", text)
-            else:
-                words = text.split()
 
-            if self.max_words is not None:
-                words = words[:self.max_words]
+def prune_rare_tokens(source, outputs, workers):
+    """
+    Write vw file source to each (min_token_count, output_filename) of outputs without the features that occur less
+    than min_token_count times in their namespace.
 
-            if self.max_word_size is not None:
-                words = [x[:self.max_word_size] for x in words]
+    The conversion workers first count the features of their own byte ranges of source into count-min sketches. Those are
+    summed, then the workers prune their byte ranges for all the outputs at once using the same sketch.
+    """
+    start = time.time()
+    workers = _workers(workers)
+    to_cleanup = []
 
-            if self.stem:
-                words = stem_words(words)
+    try:
+        ranges = None
+        if can_split_by_offsets(source):
+            ranges = get_record_boundaries(source, get_conversion_chunks(source, workers), 'vw')
+        ranges = ranges or [None]
+
+        tasks = []
+        for byte_range in ranges:
+            tasks.append((source, byte_range, get_temp_filename('sketch.npy')))
+            to_cleanup.append(tasks[-1][-1])
+
+        sketch = None
+        for task in iter_conversion_tasks(tasks, workers, _count_tokens):
+            if sketch is None:
+                sketch = TokenSketch.load(task[2])
+            else:
+                sketch.update(TokenSketch.load(task[2]))
+            unlink(task[2])
+
+        sketch_filename = get_temp_filename('sketch.npy')
+        to_cleanup.append(sketch_filename)
+        sketch.save(sketch_filename)
+        log('Counted features of %s in %.1f seconds', source, time.time() - start)
+
+        min_counts = [min_count for (min_count, _output_filename) in outputs]
+        output_filenames = [output_filename for (_min_count, output_filename) in outputs]
+        parts_out = get_part_filenames(len(ranges), output_filenames)
+        if len(ranges) > 1:
+            for parts in parts_out:
+                to_cleanup.extend(parts)
+
+        tasks = [(source, byte_range, parts, sketch_filename, min_counts) for (byte_range, parts) in zip(ranges, parts_out)]
+        run_part_tasks(tasks, output_filenames, workers, _prune_tokens)
+    finally:
+        unlink(*to_cleanup)
 
-            if self.remove_duplicate_words:
-                seen = set()
-                new_words = []
-                for word in words:
-                    if word not in seen:
-                        new_words.append(word)
-                        seen.add(word)
-                words = new_words
+    log('Pruned %s with min counts %s in %.1f seconds', source, ', '.join(str(x) for x in min_counts), time.time() - start)
 
-            if self.split_chars:
-                words = [' '.join(w) for w in words]
-                text = u' __ '.join(words)
-            else:
-                text = u' '.join(words)
-                if self.split_combined:
-                    text = self.split_combined.sub(ur" \g<0> ", text)
-                else:
-                    if self.split_ideographs:
-                        text = self.split_ideographs.sub(ur" \g<0> ", text)
 
-                    if self.split_hiragana:
-                        text = self.split_hiragana.sub(ur" \g<0> ", text)
+def get_dedup_key(line):
+    """
+    Return (key, label, importance weight, rest of the label section) of vw line, key being None if it cannot be merged.
 
-                    if self.split_katakana:
-                        text = self.split_katakana.sub(ur" \g<0> ", text)
+    Only lines with a label section of the form "label [weight] ['tag]" can be merged; the key is made of the label and the features.
 
-                    if self.split_hangul:
-                        text = self.split_hangul.sub(ur" \g<0> ", text)
+    >>> get_dedup_key("1 0.5 'id| a b")
+    ('1| a b', '1', 0.5, "'id")
+    >>> get_dedup_key("1:2 2:1 | a")[0] is None
+    True
+    """
+    bar = line.find('|')
+    if bar < 0:
+        return None, None, None, None
+    label_items = line[:bar].split(' ', 2)
+    y = label_items[0]
+    if not y or y.startswith("'"):
+        return None, None, None, None
+    weight_token = label_items[1] if len(label_items) >= 2 else None
+    if not weight_token or weight_token.startswith("'"):
+        weight = 1.0
+        rest_label = ' '.join(label_items[1:]).strip()
+    else:
+        try:
+            weight = float(weight_token)
+        except ValueError:
+            return None, None, None, None
+        rest_label = ' '.join(label_items[2:]).strip()
+    if rest_label and (' ' in rest_label or not rest_label.startswith("'")):
+        return None, None, None, None
+    return y + line[bar:], y, weight, rest_label
 
-                    text = re.sub(r'\s+', ' ', text.strip())
 
-            return text.encode('utf-8')
-        except Exception:
-            sys.stderr.write('Failed to process\norig=%r\ntext=%r\n' % (orig, text))
-            traceback.print_exc()
-            raise
+def merge_duplicate_examples(items):
+    """
+    Merge (position, vw line) items with the same label and features into the first of them, with the sum of their
+    importance weights, like rewrite_vw_label() combines example and class weights.
 
-    def process_row(self, row):
-        assert isinstance(row, list), row
-        return [self.process_text(item) for item in row]
+    Returns the (position, line, count) items left, in the original order, count being the number of input lines
+    merged into that one. Lines that occur once are kept as they are.
 
-    def process_rows(self, rows):
-        return [self.process_row(row) for row in rows]
+    >>> merge_duplicate_examples([(0, '1 | a b'), (1, '0 | a b'), (2, "1 2.5 'x| a b"), (3, "1 'y|n c")])
+    [(0, '1 3.5 | a b', 2), (1, '0 | a b', 1), (3, "1 'y|n c", 1)]
+    """
+    examples = {}
+    result = []
+    for position, line in items:
+        if not line.strip():
+            sys.exit('--dedup does not support multiline examples, found an empty line')
+        key, y, weight, rest_label = get_dedup_key(line)
+        example = examples.get(key) if key is not None else None
+        if example is None:
+            example = [position, line, y, weight, rest_label, 1]
+            if key is not None:
+                examples[key] = example
+            result.append(example)
+        else:
+            example[3] += weight
+            example[5] += 1
 
+    for index, (position, line, y, weight, rest_label, count) in enumerate(result):
+        if count > 1:
+            line = y + ' ' + str(weight) + ' ' + (rest_label + ' ' if rest_label else '') + line[line.index('|'):]
+        result[index] = (position, line, count)
 
-def read_y_true(filename, format, columnspec, ignoreheader, named_labels, remap_label, examples=None):
-    log('Reading labels from %s', filename or 'stdin')
-    if format == 'vw':
-        return _load_predictions(filename, named_labels=named_labels, with_weights=True, examples=examples)
+    return result
 
-    rows_source = open_anything(filename, format, ignoreheader=ignoreheader)
 
-    label_index = columnspec.index('y')
+def iter_positioned_lines(source, byte_range):
+    """Yield (byte offset, line) for the lines of vw file source, or of its byte range if not None"""
+    position = byte_range[0] if byte_range is not None else 0
+    for lines in read_vw_lines(source, byte_range):
+        for line in lines:
+            yield position, line
+            position += len(line) + 1
 
-    weight_index = None
-    try:
-        weight_index = columnspec.index('weight_metric')
-    except ValueError:
-        try:
-            weight_index = columnspec.index('weight')
-        except ValueError:
-            pass
 
-    y_true = []
-    weights = []
+def read_positioned_lines(filename):
+    """Yield (position, line) from a file of "position<TAB>line" lines"""
+    for line in open(filename):
+        position, line = line.rstrip('\n').split('\t', 1)
+        yield int(position), line
 
-    for row in rows_source:
-        label = row[label_index]
-        if remap_label is not None:
-            label = remap_label.get(label, label)
-        if named_labels is None:
-            label = float(label)
-        elif label not in named_labels:
-            sys.exit('Unexpected label in %s: %r (allowed: %s)' % (filename, label, named_labels))
-        y_true.append(label)
 
-        if weight_index is not None:
-            w = float(row[weight_index].strip() or '1')
-            weights.append(w)
+def read_merged_lines(filename):
+    """Yield (position, line, count) from a file of "position<TAB>count<TAB>line" lines written by _merge_bucket()"""
+    for line in open(filename):
+        position, count, line = line.rstrip('\n').split('\t', 2)
+        yield int(position), line, int(count)
 
-        if examples is not None and len(y_true) >= examples:
-            break
 
-    y_true = np.array(y_true)
-    if weights:
-        weights = np.array(weights)
+def _partition_examples(task):
+    """Run by the conversion pool: spread the lines of a part of a vw file across bucket files by hash of their dedup key"""
+    source, byte_range, buckets = task
+    try:
+        outputs = [open(bucket, 'wb') for bucket in buckets]
+        for position, line in iter_positioned_lines(source, byte_range):
+            key = get_dedup_key(line)[0]
+            outputs[hash(key if key is not None else line) % len(outputs)].write('%s\t%s\n' % (position, line))
+        for output in outputs:
+            output.close()
+    except SystemExit, ex:
+        return ex.code if ex.code is not None else 1
+    except Exception:
+        traceback.print_exc()
+        return 1
 
-    return y_true, (weights if weight_index is not None else None)
+
+def _merge_bucket(task):
+    """Run by the conversion pool: merge the duplicates of a bucket, made of one file per part of the source"""
+    parts, output = task
+    try:
+        items = (item for part in parts for item in read_positioned_lines(part))
+        with open(output, 'wb') as fobj:
+            for position, line, count in merge_duplicate_examples(items):
+                fobj.write('%s\t%s\t%s\n' % (position, count, line))
+    except SystemExit, ex:
+        return ex.code if ex.code is not None else 1
+    except Exception:
+        traceback.print_exc()
+        return 1
 
 
-def _make_proper_list(s, type=None):
-    if isinstance(s, basestring):
-        result = s.split(',')
-        if type is not None:
-            result = [type(x) for x in result]
-        return result
+def dedup_vw_file(source, output_filename, workers):
+    """
+    Write vw file source to output_filename with its duplicate examples merged, see merge_duplicate_examples().
 
-    if not s:
-        return s
+    Files over DEDUP_BUCKET_SIZE (or big enough to keep several workers busy) are processed in bounded memory: the
+    workers first spread the lines of their byte ranges across buckets by hash of the example, so that all the
+    copies of an example end up in the same bucket. The buckets are then merged independently, each one in memory,
+    and their results are interleaved back in the original order of the lines.
+    """
+    import heapq
+    start = time.time()
+    workers = _workers(workers)
+    to_cleanup = []
 
-    result = []
-    if isinstance(s, list):
-        for x in s:
-            result.extend(_make_proper_list(x, type))
-    else:
-        raise TypeError('Expected list of string: %r' % (s, ))
-    return result
+    ranges = None
+    if can_split_by_offsets(source):
+        ranges = get_record_boundaries(source, get_conversion_chunks(source, workers), 'vw')
+    ranges = ranges or [None]
 
+    size = os.path.getsize(source)
+    nbuckets = max(len(ranges), int(math.ceil(size / float(DEDUP_BUCKET_SIZE))))
+    lines_in = 0
+    lines_out = 0
 
-def proper_label(s):
-    if '|' in s or ' ' in s or ':' in s:
-        sys.exit('Not a proper label: %r' % s)
-    return s
+    try:
+        output = open_output(output_filename)
 
+        if nbuckets == 1:
+            merged = merge_duplicate_examples(iter_positioned_lines(source, None))
+        else:
+            buckets = [[get_temp_filename('bucket%s.part%s' % (bucket, index)) for bucket in xrange(nbuckets)] for index in xrange(len(ranges))]
+            for parts in buckets:
+                to_cleanup.extend(parts)
+            merged_files = [get_temp_filename('bucket%s.merged' % bucket) for bucket in xrange(nbuckets)]
+            to_cleanup.extend(merged_files)
+
+            tasks = [(source, byte_range, parts) for (byte_range, parts) in zip(ranges, buckets)]
+            for _task in iter_conversion_tasks(tasks, workers, _partition_examples):
+                pass
 
-class ParseError(ValueError):
-    pass
+            tasks = [([parts[bucket] for parts in buckets], merged_files[bucket]) for bucket in xrange(nbuckets)]
+            for task in iter_conversion_tasks(tasks, workers, _merge_bucket):
+                unlink(*task[0])
 
+            merged = heapq.merge(*[read_merged_lines(x) for x in merged_files])
 
-def parse_mapping(config):
-    """
-    >>> parse_mapping('1:-1,2:1')
-    {'1': '-1', '2': '1'}
+        for _position, line, count in merged:
+            output.write(line + '\n')
+            lines_in += count
+            lines_out += 1
 
-    >>> parse_mapping('1:-1,2:1'.split(','))
-    {'1': '-1', '2': '1'}
-    """
-    if not config:
-        return None
+        flush_and_close(output)
+    finally:
+        unlink(*to_cleanup)
 
-    config = _make_proper_list(config)
+    log('Merged duplicate examples of %s in %.1f seconds: %s lines -> %s (%.1f%%)',
+        output_filename, time.time() - start, lines_in, lines_out, 100.0 * lines_out / max(1, lines_in), importance=1)
 
-    if not config:
-        return None
 
-    result = {}
+def get_ngram_options(vw_args):
+    """
+    Return the --ngram and --skips settings of vw_args as dicts: first letter of namespace ('' for all of them) -> N.
+    Tuned settings are taken at their largest value, the one with the most features.
 
-    for item in config:
-        if ':' not in item:
-            raise ParseError(item)
-        key, value = item.rsplit(':', 1)
+    >>> get_ngram_options(['--ngram', '2', '--skips', 'a1', IntegerParam('--ngram', min=2, max=4), '-b', '18'])
+    ({'': 4}, {'a': 1})
+    """
+    result = {'--ngram': {}, '--skips': {}}
+    items = list(vw_args)
+    for index, item in enumerate(items):
+        if isinstance(item, basestring):
+            if item not in result or index + 1 >= len(items) or not isinstance(items[index + 1], basestring):
+                continue
+            values = [items[index + 1]]
+            option = item
+        elif getattr(item, 'opt', None) in result:
+            option = item.opt
+            if isinstance(item, ValuesParam):
+                values = [x for x in item.values if x]
+            else:
+                values = [str(item.max)]
+        else:
+            continue
+        for value in values:
+            namespace = '' if value[:1].isdigit() else value[:1]
+            result[option][namespace] = max(result[option].get(namespace, 0), int(value.lstrip(namespace)))
+    return result['--ngram'], result['--skips']
 
-        if key in result:
-            log_always('Label %r specified more than once', key)
 
-        result[key] = value
+def iter_ngrams(names, ngram, skips):
+    """
+    Yield the n-grams of names that vw generates with --ngram ngram --skips skips, as strings
 
-    return result
+    >>> list(iter_ngrams(['a', 'b', 'c'], 2, 1))
+    ['a^b', 'b^c', 'a^c']
+    """
+    for size in xrange(2, ngram + 1):
+        for gaps in product(xrange(skips + 1), repeat=size - 1):
+            span = size + sum(gaps)
+            for start in xrange(len(names) - span + 1):
+                indices = [start]
+                for gap in gaps:
+                    indices.append(indices[-1] + gap + 1)
+                yield '^'.join([names[index] for index in indices])
 
 
-def parse_weight(config, named_labels=None):
+def get_namespace_features(namespaces, ngrams, skips):
     """
-    >>> parse_weight('A:B:2', ['A:B', 'another_label'])
-    {'A:B': '2'}
+    Return dict namespace -> names of the features of a line parsed by parse_vw_namespaces, including their n-grams
 
-    >>> parse_weight('A:B:2')
-    Traceback (most recent call last):
-     ...
-    SystemExit: Weight must be specified as CLASS(float):WEIGHT, 'A:B' not recognized
+    >>> get_namespace_features([('', '', ['a', 'b:2']), ('n', 'n', ['c', 'd'])], {'n': 2}, {})
+    {'': ['a', 'b'], 'n': ['c', 'd', 'c^d']}
     """
-    if named_labels is not None and not isinstance(named_labels, list):
-        raise TypeError('must be list, not %r' % type(named_labels))
+    result = {}
+    for namespace, _header, features in namespaces:
+        names = [feature.split(':', 1)[0] for feature in features]
+        letter = namespace[:1] or ' '
+        ngram = ngrams.get(letter, ngrams.get('', 1))
+        if ngram > 1:
+            names.extend(iter_ngrams(names, ngram, skips.get(letter, skips.get('', 0))))
+        result.setdefault(namespace, []).extend(names)
+    return result
 
-    try:
-        config = parse_mapping(config)
-    except ParseError, item:
-        sys.exit('Weight must be specified as CLASS:WEIGHT, cannot parse %s' % item)
 
-    if not config:
-        return config
+def _count_distinct_features(task):
+    """Run by the conversion pool: count distinct features of each namespace of a part of a vw file into HyperLogLog sketches"""
+    source, byte_range, ngrams, skips, output = task
+    try:
+        sketches = {}
+        for lines in read_vw_lines(source, byte_range):
+            features = {}
+            for line in lines:
+                for namespace, names in get_namespace_features(parse_vw_namespaces(line)[1], ngrams, skips).iteritems():
+                    features.setdefault(namespace, []).extend(names)
+            for namespace, names in features.iteritems():
+                if namespace not in sketches:
+                    sketches[namespace] = HyperLogLog()
+                sketches[namespace].add([namespace + ' ' + name for name in names])
+        namespaces = sorted(sketches)
+        registers = [sketches[namespace].registers for namespace in namespaces]
+        np.savez(output, namespaces=np.array(namespaces, dtype=object), registers=np.array(registers, dtype=np.uint8))
+    except SystemExit, ex:
+        return ex.code if ex.code is not None else 1
+    except Exception:
+        traceback.print_exc()
+        return 1
 
-    result = {}
 
-    for label, weight in config.items():
-        if named_labels is None:
-            try:
-                float(label)
-            except Exception:
-                sys.exit('Weight must be specified as CLASS(float):WEIGHT, %r not recognized' % (label, ))
-        else:
-            if label not in named_labels:
-                sys.exit('Label %r is not recognized. Expected: %r' % (label, named_labels))
+def count_distinct_features(source, vw_args, workers):
+    """Return dict namespace -> estimated number of distinct features vw sees in vw file source when run with vw_args"""
+    start = time.time()
+    workers = _workers(workers)
+    ngrams, skips = get_ngram_options(vw_args)
 
-        try:
-            float(weight)
-        except Exception:
-            weight = None
+    ranges = None
+    if can_split_by_offsets(source):
+        ranges = get_record_boundaries(source, get_conversion_chunks(source, workers), 'vw')
+    ranges = ranges or [None]
 
-        if weight is None or weight < 0:
-            sys.exit('Weight must be specified as CLASS:WEIGHT(float), %r is not recognized' % (item, ))
+    tasks = [(source, byte_range, ngrams, skips, get_temp_filename('hll.npz')) for byte_range in ranges]
+    sketches = {}
 
-        result[label] = weight
+    try:
+        for task in iter_conversion_tasks(tasks, workers, _count_distinct_features):
+            data = np.load(task[-1], allow_pickle=True)
+            for namespace, registers in izip(data['namespaces'], data['registers']):
+                sketch = HyperLogLog(registers=registers)
+                if namespace in sketches:
+                    sketches[namespace].update(sketch)
+                else:
+                    sketches[namespace] = sketch
+            unlink(task[-1])
+    finally:
+        unlink(*[task[-1] for task in tasks])
 
+    result = dict((namespace, sketch.count()) for (namespace, sketch) in sketches.iteritems())
+    log('Counted distinct features of %s in %.1f seconds: %s', source, time.time() - start,
+        ', '.join('%s=%d' % (namespace or "' '", count) for (namespace, count) in sorted(result.items())), importance=0)
     return result
 
 
-def get_sample_weight(y_true, config):
-    if config is None:
-        return None
-    N = len(y_true)
-    result = np.zeros(N)
-    updated = np.zeros(N)
-
-    for klass, weight in config.items():
-        klass = float(klass)
-        weight = float(weight)
-        result += np.multiply(np.ones(N) * weight, y_true == klass)
-        updated += y_true == klass
+def get_collision_rate(features, bits):
+    """
+    Expected fraction of features that share their weight with another one when hashed into 2 ** bits weights
 
-    result += (updated == 0)
+    >>> round(get_collision_rate(1000000, 18), 4), round(get_collision_rate(1000000, 24), 4)
+    (0.978, 0.0579)
+    """
+    if features <= 1:
+        return 0.0
+    return float(-np.expm1((features - 1) * np.log1p(-1.0 / (1 << bits))))
 
-    return result
 
+def limit_hash_bits(vw_filename, vw_args, max_collision_rate, workers):
+    """
+    If -b is tuned in vw_args, return vw_args with -b set to the smallest of its candidates for which the expected
+    collision rate of the features of vw_filename is within max_collision_rate, so that the bigger ones are not run at all.
+    """
+    for index, param in enumerate(vw_args):
+        if getattr(param, 'opt', None) in ('-b', '--bit_precision'):
+            break
+    else:
+        return vw_args
 
-def process_text(preprocessor, text):
-    if preprocessor is not None:
-        text = preprocessor.process_text(text)
+    if isinstance(param, ValuesParam):
+        candidates = sorted(int(value) if value else DEFAULT_VW_BITS for value in param.values)
+    elif param.min is not None and param.max is not None:
+        candidates = range(param.min, param.max + 1)
     else:
-        text = re.sub('\s+', ' ', text)
-    text = text.replace(':', ' ').replace('|', ' ')
-    text = text.strip()
-    return text
+        return vw_args
 
+    features = sum(count_distinct_features(vw_filename, vw_args, workers).values())
 
-def convert_row_to_vw(row, columnspec, preprocessor, weights, named_labels, remap_label):
-    if isinstance(row, basestring):
-        if not row.strip():
-            return row
-        assert '|' in row, row
-        assert columnspec is None, '--columnspec not supported with .vw format'
-        if preprocessor is None and not weights and not remap_label:
-            return row
+    chosen = None
+    for bits in candidates:
+        rate = get_collision_rate(features, bits)
+        log('%s %s: expected collision rate %.4f for %d features', param.opt, bits, rate, features, importance=1)
+        if chosen is None and rate <= max_collision_rate:
+            chosen = bits
 
-        items = re.split(r'([^\s]*\|[^\s]*)', row)
-        label = items[0]
+    if chosen is None:
+        chosen = candidates[-1]
+        log_always('No %s candidate has collision rate within %s, using %s', param.opt, max_collision_rate, chosen)
+    else:
+        log_always('Using %s %s: the smallest candidate with collision rate within %s', param.opt, chosen, max_collision_rate)
 
-        if preprocessor is None:
-            rest = ''.join(items[1:])
-        else:
-            if len(items) <= 2:
-                sys.exit('Cannot parse: %r' % (row, ))
-            processed = []
-            for item in items[1:]:
-                if '|' in item:
-                    processed.append(item)
-                else:
-                    processed.append(' ' + preprocessor.process_text(item) + ' ')
-            rest = ''.join(processed)
+    return vw_args[:index] + ['%s %s' % (param.opt, chosen)] + vw_args[index + 1:]
 
-        if remap_label is not None:
-            new_label = remap_label.get(label.strip())
-            if new_label is not None:
-                label = new_label + ' '
 
-        if weights:
-            label_items = label.split(' ', 2)
-            y = label_items[0]
+def get_chunk_converter(format, preprocessor_opts, columnspec, weights, named_labels, remap_label, column_names=None, cache={}):
+    """Return function converting a chunk of complete records into vw lines. Reused across chunks, so are the column memos."""
+    key = repr((format, preprocessor_opts, columnspec, sorted((weights or {}).items()), named_labels, sorted((remap_label or {}).items()), column_names))
+    if key in cache:
+        return cache[key]
 
-            if named_labels is not None and y not in named_labels:
-                sys.exit('Label not recognized: %r' % (row, ))
+    from cStringIO import StringIO
 
-            class_weight = weights.get(y, 1)
-            if class_weight is None or float(class_weight) == 1.0:
-                # don't need to update label/weight part
-                pass
-            else:
-                weight_token = label_items[1] if len(label_items) >= 2 else None
+    if named_labels is not None:
+        named_labels = set(named_labels)
 
-                if not weight_token or not weight_token.strip() or weight_token.startswith("'") or weight_token.startswith("|"):
-                    example_weight = 1
-                    rest_label = ' '.join(label_items[1:])
-                else:
-                    example_weight = float(weight_token)
-                    rest_label = ' '.join(label_items[2:])
+    preprocessor = get_preprocessor(preprocessor_opts)
 
-                final_weight = example_weight * float(class_weight)
+    if preprocessor is not None and preprocessor.min_token_count:
+        sys.exit('--min_token_count needs all the data before writing any of it and cannot be used on a stream, pass the data with -d')
 
-                if final_weight == 1:
-                    label = y + ' ' + rest_label
-                else:
-                    label = y + ' ' + str(final_weight) + ' ' + rest_label
+    if format == 'vw' and preprocessor is None:
+        convert = get_vw_rewriter(weights, named_labels, remap_label)
+    else:
+        convert_rows = get_row_converter(columnspec, preprocessor=preprocessor, weights=weights, named_labels=named_labels, remap_label=remap_label, batch=True, memos={}, column_names=column_names)
 
-        return label + rest.rstrip() + '\n'
+        def convert(data):
+            return ''.join(convert_rows(list(open_anything(StringIO(data), format, ignoreheader=False))))
 
-    assert isinstance(columnspec, list), columnspec
+    cache[key] = convert
+    return convert
 
-    if columnspec[-1] == '*':
-        del columnspec[-1]
-        while len(columnspec) < len(row):
-            columnspec.append(columnspec[-1])
 
-    if len(row) != len(columnspec):
-        sys.exit('Expected %r columns (%r), got %r (%r)' % (len(columnspec), columnspec, len(row), row))
+def _convert_chunk(task):
+    """Run by the conversion pool. Returns (True, converted chunk) on success and (False, exit status) otherwise."""
+    data, format, preprocessor_opts, columnspec, weights, named_labels, remap_label, column_names = task
+    try:
+        return True, get_chunk_converter(format, preprocessor_opts, columnspec, weights, named_labels, remap_label, column_names)(data)
+    except SystemExit, ex:
+        return False, ex.code if ex.code is not None else 1
+    except Exception:
+        traceback.print_exc()
+        return False, 1
 
-    y = ''
-    x = []
-    info = []
-    last_namespace = None
-    example_weight = None
-    example_weight1 = None
 
-    for item, spec in zip(row, columnspec):
-        if spec == 'y':
-            y = item
-        elif spec == 'text' or spec.startswith('text_'):
-            namespace = spec[5:]
-            if not x or namespace != last_namespace:
-                x.append('|' + namespace)
-            x.append(process_text(preprocessor, item))
-            if '|' in item:
-                last_namespace = None
-            else:
-                last_namespace = namespace
-        elif spec == 'vw' or spec.startswith('vw_'):
-            namespace = spec[3:]
-            if not item.startswith('|') and (not x or namespace != last_namespace):
-                x.append('|' + namespace)
-            x.append(item)
-            if '|' in item:
-                last_namespace = None
-            else:
-                last_namespace = namespace
-        elif spec == 'info':
-            info.append(item)
-        elif spec == 'drop' or not spec:
-            continue
-        elif spec == 'weight':
-            example_weight = item
-        elif spec == 'weight_train':
-            example_weight1 = item
-        elif spec == 'weight_metric':
-            pass  # used by read_y_true
-        else:
-            sys.exit('Spec item %r not understood' % spec)
+def convert_stream(chunks, output, workers, format, preprocessor, columnspec, weights, named_labels, remap_label, header=None):
+    """
+    Convert chunks of records (see read_records) into vw format, writing them to output in the original order.
 
-    example_weight = example_weight1 or example_weight
+    header is the list that read_records() puts the skipped header into, if any, which names the num and cat columns.
 
-    if info:
-        info = " '%s" % ';'.join(info) + ' '
-    else:
-        info = ''
+    With several workers the chunks are converted by the conversion pool, while a thread writes the results out as
+    they become ready. At most 2 * workers chunks are in flight, so memory stays flat however long the stream is.
+    """
+    from itertools import chain
+    from cStringIO import StringIO
+    preprocessor_opts = str(preprocessor) if preprocessor else ''
+    column_names = None
+    if header is not None:
+        # the header is read together with the first chunk
+        chunks = iter(chunks)
+        first = next(chunks, None)
+        chunks = chain([first] if first is not None else [], chunks)
+        if header and format != 'vw':
+            column_names = next(open_anything(StringIO(header[0]), format, ignoreheader=False), None)
+    args = (format, preprocessor_opts, columnspec, weights, named_labels, remap_label, column_names)
+
+    if workers <= 1:
+        for data in chunks:
+            success, result = _convert_chunk((data, ) + args)
+            if not success:
+                sys.exit(result)
+            output.write(result)
+        return
 
-    if named_labels is not None and y not in named_labels:
-        sys.exit('Label not recognized: %r' % (row, ))
+    import threading
+    import Queue
 
-    if remap_label is not None:
-        y = remap_label.get(y, y)
+    pool = get_conversion_pool(workers)
+    in_flight = Queue.Queue(2 * workers)
+    errors = []
+
+    def write_results():
+        while True:
+            pending = in_flight.get()
+            if pending is None:
+                break
+            # no timeout there: waiting with one polls, which adds latency in --linemode
+            success, result = pending.get()
+            if errors:
+                continue
+            if not success:
+                errors.append(result)
+                continue
+            try:
+                output.write(result)
+            except Exception, ex:
+                errors.append(ex)
 
-    class_weight = weights.get(y) if weights is not None else None
+    writer = threading.Thread(target=write_results)
+    writer.daemon = True
+    writer.start()
 
-    if example_weight is not None and class_weight is not None:
-        weight = float(example_weight) * float(class_weight)
-    elif example_weight is None:
-        weight = class_weight
-    else:
-        weight = example_weight
+    try:
+        for data in chunks:
+            if errors:
+                break
+            # a timeout makes the wait interruptible with Ctrl-C
+            in_flight.put(pool.apply_async(_convert_chunk, ((data, ) + args, )), timeout=2 ** 31)
+    finally:
+        in_flight.put(None, timeout=2 ** 31)
 
-    if weight is None:
-        weight = ''
-    else:
-        weight = ' ' + str(weight).strip()
+    while writer.is_alive():
+        writer.join(1)
 
-    text = y + weight + info + ' ' + ' '.join(x) + '\n'
-    return text
+    if errors:
+        if isinstance(errors[0], Exception):
+            raise errors[0]
+        sys.exit(errors[0])
 
 
-def _convert_any_to_vw(source, format, output, weights, preprocessor, columnspec, named_labels, remap_label, ignoreheader):
-    if named_labels is not None:
-        assert not isinstance(named_labels, basestring)
-        named_labels = set(named_labels)
+def convert_any_to_vw(source, format, output_filename, columnspec, named_labels, remap_label, weights, preprocessor, ignoreheader, workers, dedup=False):
+    convert_variants_to_vw(source, format, [(preprocessor, output_filename)], columnspec, named_labels, remap_label, weights, ignoreheader, workers, dedup=dedup)
 
-    rows_source = open_anything(source, format, ignoreheader=ignoreheader)
-    output = open(output, 'wb')
 
-    for row in rows_source:
-        try:
-            vw_line = convert_row_to_vw(row, columnspec, preprocessor=preprocessor, weights=weights, named_labels=named_labels, remap_label=remap_label)
-        except Exception:
-            log_always('Failed to parse: %r', row)
-            raise
-        output.write(vw_line)
+def convert_variants_to_vw(source, format, variants, columnspec, named_labels, remap_label, weights, ignoreheader, workers, dedup=False):
+    """
+    Convert source to vw format for every (preprocessor options, output filename) in variants, in a single pass over source.
 
-    flush_and_close(output)
+    With dedup, the duplicate examples of every output are merged (see merge_duplicate_examples).
+    """
+    variants = [(preprocessor or '', output_filename) for (preprocessor, output_filename) in variants]
 
+    for preprocessor, _output_filename in variants:
+        assert isinstance(preprocessor, basestring), preprocessor
+        log('preprocessor = %s', preprocessor or '', importance=1 if preprocessor else 0)
 
-def convert_any_to_vw(source, format, output_filename, columnspec, named_labels, remap_label, weights, preprocessor, ignoreheader, workers):
-    preprocessor = preprocessor or ''
+    start = time.time()
 
-    assert isinstance(preprocessor, basestring), preprocessor
+    # (preprocessor, output_filename, cache_key) of the variants not found in the cache
+    pending = []
+
+    for preprocessor, output_filename in variants:
+        cache_key = None
+        if CONVERT_CACHE is not None and (isinstance(source, list) or (isinstance(source, basestring) and os.path.isfile(source))):
+            cache_key = get_conversion_cache_key(source, format, columnspec, named_labels, remap_label, weights, preprocessor, ignoreheader, dedup)
+            cached = CONVERT_CACHE.lookup(cache_key, '.vw')
+            if cached:
+                log('Reusing cached conversion of %s', source)
+                link_or_copy(cached, output_filename)
+                continue
+        pending.append((preprocessor, output_filename, cache_key))
 
-    log('preprocessor = %s', preprocessor or '', importance=1 if preprocessor else 0)
+    if not pending:
+        return
 
-    start = time.time()
+    workers = _workers(workers)
+    to_cleanup = []
 
     if source is None:
-        from cStringIO import StringIO
-        source = StringIO(sys.stdin.read())
+        # the workers then read their own byte ranges of the copy
+        source = get_temp_filename(format)
+        to_cleanup.append(source)
+        spill_stdin(source)
+
+    # output_filename -> file that conversion writes, from which the duplicates are merged into output_filename with dedup
+    converted = {}
+
+    for _preprocessor, output_filename, _cache_key in pending:
+        if dedup:
+            converted[output_filename] = get_temp_filename('undeduped.vw')
+            to_cleanup.append(converted[output_filename])
+        else:
+            converted[output_filename] = output_filename
 
-    workers = _workers(workers)
-    # XXX do os.stat on the source and decide on number of workers based on file size (e.g. less than 50k per worker does not make much sense)
-    batches, total_lines = split_file(source, nfolds=workers, ignoreheader=ignoreheader, importance=-1)
+    # variants with --min_token_count are made by pruning the output of the same conversion without it
+    to_convert = []
+    to_prune = {}
+
+    for preprocessor, output_filename, _cache_key in pending:
+        min_token_count, unpruned = split_min_token_count(preprocessor)
+        if min_token_count is None:
+            to_convert.append((preprocessor, converted[output_filename]))
+        else:
+            to_prune.setdefault(unpruned, []).append((min_token_count, converted[output_filename]))
+
+    unpruned_filenames = {}
+
+    for unpruned in sorted(to_prune):
+        for preprocessor, output_filename in variants:
+            if dedup and output_filename not in converted:
+                # the cached output has no duplicates left to count
+                continue
+            output_filename = converted.get(output_filename, output_filename)
+            if preprocessor == unpruned and output_filename not in STDOUT_NAMES and not is_pipe(output_filename):
+                unpruned_filenames[unpruned] = output_filename
+                break
+        else:
+            unpruned_filenames[unpruned] = get_temp_filename('unpruned.vw')
+            to_cleanup.append(unpruned_filenames[unpruned])
+            to_convert.append((unpruned, unpruned_filenames[unpruned]))
+
+    streaming = any(is_pipe(output_filename) for (_preprocessor, output_filename, _cache_key) in pending)
 
-    batches_out = [x + '.out' for x in batches]
+    if weights:
+        weights = dict((x, weights[x]) for x in weights if weights[x] != 1)
 
     try:
-        commands = []
+        if to_convert:
+            _convert_variants(source, format, to_convert, columnspec, named_labels, remap_label, weights, ignoreheader, workers, streaming, to_cleanup)
 
-        common_cmd = [quote(sys.executable), quote(__file__), '--format', format]
+        for unpruned in sorted(to_prune):
+            prune_rare_tokens(unpruned_filenames[unpruned], to_prune[unpruned], workers)
 
-        if TMP_PREFIX:
-            common_cmd += ['--tmp', TMP_PREFIX]
+        if dedup:
+            for _preprocessor, output_filename, _cache_key in pending:
+                dedup_vw_file(converted[output_filename], output_filename, workers)
 
-        if named_labels:
-            common_cmd += ['--named_labels', ','.join(named_labels)]
+        for _preprocessor, output_filename, cache_key in pending:
+            if cache_key is not None and os.path.isfile(output_filename):
+                CONVERT_CACHE.publish(output_filename, cache_key, '.vw')
 
-        if remap_label:
-            common_cmd += ['--remap_label', ','.join('%s:%s' % item for item in remap_label.items())]
+    finally:
+        unlink(*to_cleanup)
 
-        if weights:
-            weights = ['%s:%s' % (x, weights[x]) for x in weights if weights[x] != 1]
-            weights = ','.join(weights)
-            common_cmd += ['--weight', quote(weights)]
+    took = time.time() - start
+    for _preprocessor, output_filename, _cache_key in pending:
+        log('Generated %s in %.1f seconds', output_filename, took)
+        if not output_filename.startswith('/dev/') and not streaming:
+            log('\n'.join(open(output_filename).read(200).split('\n')) + '...')
+
+
+def _convert_variants(source, format, variants, columnspec, named_labels, remap_label, weights, ignoreheader, workers, streaming, to_cleanup):
+    """Convert source with every (preprocessor options, output filename) of variants, in parallel by parts of source"""
+    shards = source if isinstance(source, list) else [source]
+    batches = []
+    ranges = []
+    row_ranges = []
+    headers = []
+    # header of the shard of each batch, for batches that do not start with it
+    column_names = []
+
+    shard_workers = int(math.ceil(float(workers) / len(shards)))
+    if streaming:
+        # smaller chunks so that the reader gets the first one sooner
+        shard_workers *= 4
+
+    for shard in shards:
+        shard_column_names = read_column_names(shard, format) if ignoreheader else None
+        store = get_column_store(shard, format, ignoreheader)
+        if store is not None:
+            # no csv parsing at all: workers read their own rows of the already parsed columns
+            nchunks = max(1, min(shard_workers, store.rows // COLUMN_STORE_BATCH))
+            bounds = [store.rows * index // nchunks for index in xrange(nchunks + 1)]
+            shard_row_ranges = [(first, last) for (first, last) in zip(bounds, bounds[1:]) if last > first]
+            batches.extend([store.path] * len(shard_row_ranges))
+            row_ranges.extend(shard_row_ranges)
+            ranges.extend([None] * len(shard_row_ranges))
+            headers.extend([False] * len(shard_row_ranges))
+            column_names.extend([shard_column_names] * len(shard_row_ranges))
+            continue
 
-        if columnspec:
-            common_cmd += ['--columnspec', quote(','.join(str(x) for x in columnspec))]
+        if can_split_by_offsets(shard):
+            # workers read their own byte ranges of the source, no need to copy it into batches first
+            shard_ranges = get_record_boundaries(shard, get_conversion_chunks(shard, shard_workers), format, ignoreheader=ignoreheader)
+            if len(shard_ranges) == 1 and get_column_store_path(shard, format, ignoreheader) is not None:
+                # converted by a single worker anyway, which can then fill the column store
+                batches.append(shard)
+                ranges.append(None)
+                headers.append(ignoreheader)
+            else:
+                batches.extend([shard] * len(shard_ranges))
+                ranges.extend(shard_ranges)
+                # the header, if any, is excluded from the byte ranges
+                headers.extend([False] * len(shard_ranges))
+        elif len(shards) > 1:
+            # e.g. compressed shard: converted as a whole, in parallel with the other shards
+            batches.append(shard)
+            ranges.append(None)
+            headers.append(ignoreheader)
+        else:
+            shard_batches, total_lines = split_file(shard, nfolds=workers, ignoreheader=ignoreheader, importance=-1)
+            batches.extend(shard_batches)
+            ranges.extend([None] * len(shard_batches))
+            # the header, if any, is removed by split_file()
+            headers.extend([False] * len(shard_batches))
+            to_cleanup.extend(shard_batches)
 
-        common_cmd.append(preprocessor)
+        # only the shards read from their column stores have row ranges
+        row_ranges.extend([None] * (len(batches) - len(row_ranges)))
+        column_names.extend([shard_column_names] * (len(batches) - len(column_names)))
 
-        for batch in batches:
-            cmd = common_cmd + ['--tovw_simple', batch + '.out', '-d', batch]
-            commands.append({'args': ' '.join(cmd)})
+    preprocessors = [preprocessor for (preprocessor, _output_filename) in variants]
+    output_filenames = [output_filename for (_preprocessor, output_filename) in variants]
+    batches_out = get_part_filenames(len(batches), output_filenames)
+    if len(batches) > 1:
+        for parts in batches_out:
+            to_cleanup.extend(parts)
 
-        success, outputs = run_subprocesses(commands, workers=workers, importance=-1)
-        if not success:
-            sys.exit(1)
+    tasks = [(batch, format, batch_out, weights, preprocessors, columnspec, named_labels, remap_label, header, names, byte_range, row_range)
+             for (batch, byte_range, row_range, header, names, batch_out) in zip(batches, ranges, row_ranges, headers, column_names, batches_out)]
 
-        unlink(*batches)
+    run_part_tasks(tasks, output_filenames, workers, _convert_batch)
 
-        cmd = 'cat ' + ' '.join(batches_out)
-        if output_filename:
-            cmd += ' > %s' % output_filename
 
-        system(cmd, importance=-1)
+def get_part_filenames(nparts, output_filenames):
+    """
+    Return, for each of nparts parts, the list of files its task writes, one per output.
 
-    finally:
-        unlink(*batches)
-        unlink(*batches_out)
+    A single part is written to the outputs directly. Otherwise every part of a compressed output is compressed
+    on its own by the worker that writes it.
+    """
+    if nparts == 1:
+        return [output_filenames]
+    suffixes = []
+    for output_filename in output_filenames:
+        compression = get_compression(output_filename)
+        suffixes.append('.' + compression if compression else '')
+    return [[get_temp_filename('part%s.vw%s' % (index, suffix)) for suffix in suffixes] for index in xrange(nparts)]
+
+
+def run_part_tasks(tasks, output_filenames, workers, function):
+    """Run tasks with function in the conversion pool and concatenate their parts (task[2], see get_part_filenames) into output_filenames"""
+    if [task[2] for task in tasks] == [output_filenames]:
+        for _task in iter_conversion_tasks(tasks, workers, function):
+            pass
+        return
 
-    took = time.time() - start
-    log('Generated %s in %.1f seconds', output_filename, took)
-    if not output_filename.startswith('/dev/'):
-        log('\n'.join(open(output_filename).read(200).split('\n')) + '...')
+    # parts are appended in order as soon as they are ready, overlapping with conversion of the rest
+    out_fds = []
+    try:
+        for output_filename in output_filenames:
+            out_fds.append(open_output_fd(output_filename))
+        for task in iter_conversion_tasks(tasks, workers, function):
+            for out_fd, part in izip(out_fds, task[2]):
+                append_file(out_fd, part)
+                unlink(part)
+    finally:
+        for out_fd in out_fds:
+            os.close(out_fd)
 
 
 def _import(path):
@@ -3019,7 +6226,7 @@ def _id(x):
     return x
 
 
-def main_tune(metric, config, filename, validation, test, validation_holdout, format, y_true, sample_weight, args, preprocessor_base, kfold, ignoreheader, workers, hyperopt_rounds):
+def main_tune(metric, config, filename, validation, test, validation_holdout, format, y_true, sample_weight, args, preprocessor_base, kfold, ignoreheader, workers, hyperopt_rounds, dedup=False, max_collision_rate=None):
     if preprocessor_base is None:
         preprocessor_base = []
     else:
@@ -3048,6 +6255,8 @@ def main_tune(metric, config, filename, validation, test, validation_holdout, fo
     else:
         do_abs = _id
 
+    variants = []
+
     for my_args in preprocessor_variants:
         preprocessor = Preprocessor.from_options(preprocessor_base + my_args)
         preprocessor_opts = ' '.join(preprocessor.to_options() if preprocessor else [])
@@ -3059,48 +6268,55 @@ def main_tune(metric, config, filename, validation, test, validation_holdout, fo
             continue
 
         already_done[str(preprocessor)] = preprocessor_opts
+        variants.append((my_args, preprocessor, preprocessor_opts))
 
-        to_cleanup = []
+    weight_train = config.get('weight_train')
+    # preprocessor_opts -> (train, validation, test) files in vw format
+    variant_files = {}
+    to_cleanup = []
 
-        try:
-            weight_train = config.get('weight_train')
+    try:
+        to_convert = []
 
-            if format == 'vw' and not weight_train and not preprocessor:
-                vw_filename = filename
-                vw_validation_filename = validation
-                vw_test_filename = test
+        for my_args, preprocessor, preprocessor_opts in variants:
+            if format == 'vw' and not weight_train and not preprocessor and not dedup:
+                variant_files[preprocessor_opts] = (filename, validation, test)
             else:
-                vw_filename = get_temp_filename('vw_filename')
-                to_cleanup.append(vw_filename)
-
-                convert_args = dict(
-                    format=format,
-                    columnspec=config.get('columnspec'),
-                    named_labels=config.get('named_labels'),
-                    remap_label=config.get('remap_label'),
-                    weights=weight_train,
-                    preprocessor=preprocessor_opts,
-                    ignoreheader=ignoreheader,
-                    workers=workers)
+                files = (get_temp_vw_filename('vw_filename'),
+                         get_temp_vw_filename('vw_validation') if validation else None,
+                         get_temp_vw_filename('vw_test') if test else None)
+                to_cleanup.extend(x for x in files if x)
+                variant_files[preprocessor_opts] = files
+                to_convert.append(preprocessor_opts)
+
+        convert_args = dict(
+            format=format,
+            columnspec=config.get('columnspec'),
+            named_labels=config.get('named_labels'),
+            remap_label=config.get('remap_label'),
+            weights=weight_train,
+            ignoreheader=ignoreheader,
+            workers=workers)
 
-                convert_any_to_vw(source=filename, output_filename=vw_filename, **convert_args)
+        # each input is read once for all the variants, which share their common preprocessing stages
+        for index, source in enumerate((filename, validation, test)):
+            if source and to_convert:
+                # only the training examples are merged, the metrics are calculated on the validation set as it is
+                convert_variants_to_vw(source, variants=[(opts, variant_files[opts][index]) for opts in to_convert], dedup=dedup and index == 0, **convert_args)
 
-                if validation:
-                    vw_validation_filename = get_temp_filename('vw_validation')
-                    to_cleanup.append(vw_validation_filename)
-                    convert_any_to_vw(source=validation, output_filename=vw_validation_filename, **convert_args)
-                else:
-                    vw_validation_filename = None
+        for my_args, preprocessor, preprocessor_opts in variants:
+            vw_filename, vw_validation_filename, vw_test_filename = variant_files[preprocessor_opts]
 
-                if test:
-                    vw_test_filename = get_temp_filename('vw_test')
-                    to_cleanup.append(vw_test_filename)
-                    convert_any_to_vw(source=test, output_filename=vw_test_filename, **convert_args)
-                else:
-                    vw_test_filename = None
+            variant_y_true, variant_sample_weight = y_true, sample_weight
+            if dedup and not validation:
+                # each variant has its own duplicates
+                variant_y_true, variant_sample_weight = read_y_true(vw_filename, 'vw', None, False, config.get('named_labels'), None)
 
             vw_args = [x for x in my_args if getattr(x, 'opt', None) or str(x).split()[0] not in Preprocessor.ALL_OPTIONS_DASHDASH]
 
+            if max_collision_rate is not None:
+                vw_args = limit_hash_bits(vw_filename, vw_args, max_collision_rate, workers)
+
             if hyperopt_rounds:
                 opt = vw_optimize_hyperopt
                 extra = {
@@ -3114,31 +6330,37 @@ def main_tune(metric, config, filename, validation, test, validation_holdout, fo
                 vw_filename,
                 vw_validation_filename,
                 vw_test_filename,
-                y_true,
+                variant_y_true,
                 kfold,
                 vw_args,
                 metric,
                 config,
-                sample_weight=sample_weight,
+                sample_weight=variant_sample_weight,
                 workers=workers,
                 best_result=best_result,
                 validation_holdout=validation_holdout,
                 **extra)
-        finally:
-            unlink(*to_cleanup)
 
-        is_best = ''
-        if this_best_result is not None and (best_result_so_far is None or best_result_so_far > this_best_result):
-            best_result_so_far = this_best_result
-            best_vw_options = this_best_options
-            best_preprocessor_opts = preprocessor_opts
-            is_best = '*'
+            # free the disk space early, the files of the remaining variants are still there
+            unlink(*[x for x in variant_files[preprocessor_opts] if x in to_cleanup])
+            remove_prebuilt_vw_caches(variant_files[preprocessor_opts])
+            remove_fold_stores(variant_files[preprocessor_opts])
+
+            is_best = ''
+            if this_best_result is not None and (best_result_so_far is None or best_result_so_far > this_best_result):
+                best_result_so_far = this_best_result
+                best_vw_options = this_best_options
+                best_preprocessor_opts = preprocessor_opts
+                is_best = '*'
 
-        if len(preprocessor_variants) > 1:
-            if preprocessor_opts:
-                log_always('Best options with %s = %s', preprocessor_opts or 'no preprocessing', this_best_options)
-            log_always('Best %s with %r = %s%s', optimization_metric, preprocessor_opts or 'no preprocessing', _frmt_score(do_abs(this_best_result)), is_best)
-        # print 'Improvement over no l1=%.4f. Improvement over initial guess=%.4f' % (no_l1_result - best_result[0], initial_l1_result - best_result[0])
+            if len(preprocessor_variants) > 1:
+                if preprocessor_opts:
+                    log_always('Best options with %s = %s', preprocessor_opts or 'no preprocessing', this_best_options)
+                log_always('Best %s with %r = %s%s', optimization_metric, preprocessor_opts or 'no preprocessing', _frmt_score(do_abs(this_best_result)), is_best)
+            # print 'Improvement over no l1=%.4f. Improvement over initial guess=%.4f' % (no_l1_result - best_result[0], initial_l1_result - best_result[0])
+
+    finally:
+        unlink(*to_cleanup)
 
     # XXX don't show this if preprocessor is not enabled and not tuned
     if len(preprocessor_variants) > 1:
@@ -3316,7 +6538,7 @@ def print_toperrors(toperrors, y_true, y_pred, y_pred_text, filename, format, ig
 
     errors = []
 
-    for yp, yt, example in zip(y_pred, y_true, open_anything(filename, format, ignoreheader=ignoreheader)):
+    for yp, yt, example in zip(y_pred, y_true, open_rows(filename, format, ignoreheader)):
         # add hash of the example as a second item so that we get a mix of false positives and false negatives for a given error level
         try:
             err = abs(yp - yt)
@@ -3355,7 +6577,7 @@ def print_top_differences(topdiff, y_true, y_pred, y_pred_text, y_pred2, y_pred_
 
     differences = []
 
-    for yp, yp_text, yp2, yp_text2, yt, example in zip(y_pred, y_pred_text, y_pred2, y_pred_text2, y_true, open_anything(filename, format, ignoreheader=ignoreheader)):
+    for yp, yp_text, yp2, yp_text2, yt, example in zip(y_pred, y_pred_text, y_pred2, y_pred_text2, y_true, open_rows(filename, format, ignoreheader)):
         diff = abs(yp - yp2)
         # XXX for multiclass, fetch raw scores
         if yp2 * yp > 0:
@@ -3625,7 +6847,14 @@ def main(to_cleanup):
 
     parser.add_option('--tmpid')
     parser.add_option('--tmp', default='.vwoptimize /tmp/vwoptimize')
-    parser.add_option('--foldscript')
+    parser.add_option('--convert_cache', help='Keep converted files and parsed columns of csv/tsv inputs under TMP/cache for reuse by later runs, evicting least recently used ones above SIZE (e.g. 10G)')
+    parser.add_option('--foldscript', help='How --kfold splits the data: files (split once into fold files, default), fanout (one reader streams the data to all the folds through named pipes), awk or perl (filter the data for every fold), filter (perl on Mac OS X, awk elsewhere)')
+    parser.add_option('--foldassign', help='How --kfold assigns examples to folds: mod (example N goes to fold N mod K, default), random or stratified (shuffled, with each label spread evenly across the folds)')
+    parser.add_option('--foldseed', type=int, default=0, help='Random seed of --foldassign random/stratified [%default]')
+    parser.add_option('--tmpcompress', action='store_true', help='Keep converted temp files gzipped, trading CPU for disk I/O')
+    parser.add_option('--dedup', action='store_true', help='Merge duplicate training examples into one with their importance weights summed. The metrics are then calculated on the merged examples')
+    parser.add_option('--max_collision_rate', type=float, help='When tuning -b, count the distinct features of the data first and only try the smallest -b whose expected rate of hash collisions is within this (e.g. 0.01)')
+    parser.add_option('--prebuilt_cache', action='store_true', help='Build vw cache of the data once and have all the multi-pass (-c) runs read it, rather than each of them parsing the data again')
 
     # enable hyperopt
     parser.add_option('--hyperopt', type=int)
@@ -3673,13 +6902,32 @@ def main(to_cleanup):
     if options.tmpid:
         globals()['TMPID'] = options.tmpid
 
+    if options.convert_cache:
+        globals()['CONVERT_CACHE'] = PersistentCache(os.path.join(tmp_prefix, 'cache'), parse_size(options.convert_cache))
+
+    if options.tmpcompress:
+        globals()['COMPRESS_TMP'] = True
+
+    if options.prebuilt_cache:
+        globals()['PREBUILT_VW_CACHE'] = True
+
     if options.foldscript:
-        assert options.foldscript in ('perl', 'awk'), options.foldscript
-        globals()['FOLDSCRIPT'] = options.foldscript
+        assert options.foldscript in ('files', 'fanout', 'perl', 'awk', 'filter'), options.foldscript
+        globals()['FOLDSCRIPT'] = FOLDFILTER if options.foldscript == 'filter' else options.foldscript
+
+    if options.foldassign:
+        if options.foldassign not in ('mod', 'random', 'stratified'):
+            sys.exit('--foldassign must be one of mod, random, stratified')
+        globals()['FOLD_ASSIGN'] = options.foldassign
+
+    globals()['FOLD_SEED'] = options.foldseed
 
     if options.kfold is not None and options.kfold <= 1:
         sys.exit('kfold parameter must > 1')
 
+    if options.kfold is not None and FOLD_ASSIGN != 'mod' and options.kfold > np.iinfo(np.int8).max:
+        sys.exit('--foldassign %s supports up to %s folds' % (FOLD_ASSIGN, np.iinfo(np.int8).max))
+
     if options.breakdown:
         options.breakdown = re.compile(options.breakdown)
 
@@ -3711,10 +6959,14 @@ def main(to_cleanup):
         used_stdin = True
         filename = None
     else:
-        filename = options.data
-        if not os.path.exists(filename):
+        filename = get_shards(options.data)
+        if not isinstance(filename, list) and not os.path.exists(filename):
             sys.exit('File not found: %s' % filename)
 
+    for name in ('validation', 'test'):
+        if getattr(options, name):
+            setattr(options, name, get_shards(getattr(options, name)))
+
     named_labels = _make_proper_list(options.named_labels, proper_label)
     if options.named_labels_file:
         named_labels_file = [x.strip() for x in open(options.named_labels_file).readlines()]
@@ -3802,15 +7054,22 @@ def main(to_cleanup):
     sample_weight = None
     need_y_true_and_y_pred = calculated_metrics or options.toperrors or options.classification_report or options.topdiffs
 
-    if need_y_true_and_y_pred or options.kfold or need_tuning:
+    examples = read_argument(args, '--examples', type=int)
+
+    if options.dedup and options.toperrors:
+        sys.exit('--toperrors cannot be used with --dedup: the examples no longer match the rows of the input')
+
+    if need_y_true_and_y_pred or options.kfold or need_tuning or options.dedup:
         # cannot work with stdin, write it to a temp file
         if filename is None:
             filename = get_temp_filename(format)
             to_cleanup.append(filename)
-            fobj = open(filename, 'wb')
-            for line in sys.stdin:
-                fobj.write(line)
-            flush_and_close(fobj)
+            if need_y_true_and_y_pred and not options.validation and not options.tovw:
+                # read the labels while stdin is being copied
+                y_true, sample_weight = tee_stdin(filename, lambda fobj: read_y_true(
+                    fobj, format, config.get('columnspec'), options.ignoreheader, config.get('named_labels'), config.get('remap_label'), examples=examples))
+            else:
+                spill_stdin(filename)
 
     if options.tovw:
         convert_any_to_vw(
@@ -3823,20 +7082,20 @@ def main(to_cleanup):
             remap_label=config.get('remap_label'),
             weights=config.get('weight_train'),
             ignoreheader=options.ignoreheader,
-            workers=options.workers)
+            workers=options.workers,
+            dedup=options.dedup)
         sys.exit(0)
 
     is_multiclass = any([read_argument(args, '--' + x) for x in 'oaa ect csoaa log_multi recall_tree'.split()])
 
-    examples = read_argument(args, '--examples', type=int)
-
     if need_y_true_and_y_pred:
         if options.validation:
             y_true, sample_weight = read_y_true(options.validation, format, config.get('columnspec'), options.ignoreheader, config.get('named_labels'), config.get('remap_label'))
             if not len(y_true):
                 sys.exit('%s is empty' % options.validation)
         else:
-            y_true, sample_weight = read_y_true(filename, format, config.get('columnspec'), options.ignoreheader, config.get('named_labels'), config.get('remap_label'), examples=examples)
+            if y_true is None:
+                y_true, sample_weight = read_y_true(filename, format, config.get('columnspec'), options.ignoreheader, config.get('named_labels'), config.get('remap_label'), examples=examples)
             if not len(y_true):
                 sys.exit('%s is empty' % filename)
         if not config.get('named_labels') and not is_multiclass:
@@ -3920,6 +7179,8 @@ def main(to_cleanup):
             ignoreheader=options.ignoreheader,
             workers=options.workers,
             hyperopt_rounds=options.hyperopt,
+            dedup=options.dedup,
+            max_collision_rate=options.max_collision_rate,
         )
         if vw_args is None:
             sys.exit('tuning failed')
@@ -3933,27 +7194,39 @@ def main(to_cleanup):
             config['vw_train_options'] = cleanup_vw_train_options(vw_args)
 
     vw_filename = None
+    stream_conversion = None
 
     weight_train = config.get('weight_train')
 
     if filename:
-        if format == 'vw' and not weight_train and not preprocessor:
+        if format == 'vw' and not weight_train and not preprocessor and not options.dedup:
             vw_filename = filename
         else:
-            vw_filename = get_temp_filename('vw')
-            to_cleanup.append(vw_filename)
-
-            convert_any_to_vw(
+            convert_args = dict(
                 source=filename,
                 format=format,
-                output_filename=vw_filename,
                 preprocessor=config.get('preprocessor'),
                 columnspec=config.get('columnspec'),
                 named_labels=config.get('named_labels'),
                 remap_label=config.get('remap_label'),
                 weights=weight_train,
                 ignoreheader=options.ignoreheader,
-                workers=options.workers)
+                workers=options.workers,
+                dedup=options.dedup)
+
+            if options.dedup or (options.kfold and not need_tuning) or (read_argument(vw_args.split(), '--passes', int) or 1) > 1:
+                vw_filename = get_temp_vw_filename('vw')
+                to_cleanup.append(vw_filename)
+                convert_any_to_vw(output_filename=vw_filename, **convert_args)
+                if options.dedup and need_y_true_and_y_pred and not options.validation:
+                    # the examples of vw_filename are no longer those of filename
+                    y_true, sample_weight = read_y_true(vw_filename, 'vw', None, False, config.get('named_labels'), None)
+            else:
+                # vw reads the data only once, let it consume the examples while they are being converted
+                vw_filename = get_temp_filename('vw')
+                to_cleanup.append(vw_filename)
+                os.mkfifo(vw_filename)
+                stream_conversion = dict(output_filename=vw_filename, **convert_args)
 
     reported = False
 
@@ -4054,7 +7327,8 @@ def main(to_cleanup):
             predictions=predictions_fname,
             raw_predictions=options.raw_predictions,
             audit=options.audit,
-            readable_model=readable_model)
+            readable_model=readable_model,
+            fix_cache_file=PREBUILT_VW_CACHE and '--cache_file' not in my_args.split())
 
         if len(vw_cmd) == 1 and vw_filename is None:
             vw_cmd = vw_cmd[-1]
@@ -4067,21 +7341,39 @@ def main(to_cleanup):
                 popen = Popen(vw_cmd, stdin=sys.stdin, importance=1)
             else:
                 log('preprocessor = %s', preprocessor, importance=1 if preprocessor else 0)
+                workers = _workers(options.workers)
+                if workers > 1:
+                    # fork the conversion workers before vw starts, otherwise they inherit and hold open vw's pipes
+                    get_conversion_pool(workers)
                 popen = Popen(vw_cmd, stdin=subprocess.PIPE, importance=1)
-                for row in open_anything(sys.stdin, format, ignoreheader=options.ignoreheader, force_unbuffered=options.linemode):
-                    line = convert_row_to_vw(
-                        row,
-                        columnspec=config.get('columnspec'),
-                        preprocessor=preprocessor,
-                        weights=weight_train,
-                        named_labels=config.get('named_labels'),
-                        remap_label=config.get('remap_label'))
-                    popen.stdin.write(line)
-                    # subprocess.Popen is unbuffered by default
+                header = []
+                chunks = read_records(
+                    sys.stdin.fileno(),
+                    format,
+                    ignoreheader=options.ignoreheader,
+                    deadline=LINEMODE_DEADLINE if options.linemode else None,
+                    header=header)
+                # subprocess.Popen is unbuffered by default
+                convert_stream(
+                    chunks,
+                    popen.stdin,
+                    workers,
+                    format,
+                    preprocessor=preprocessor,
+                    columnspec=config.get('columnspec'),
+                    weights=weight_train,
+                    named_labels=config.get('named_labels'),
+                    remap_label=config.get('remap_label'),
+                    header=header)
                 popen.stdin.close()
 
             if popen.wait() != 0:
                 sys.exit(1)
+        elif stream_conversion is not None:
+            if _workers(options.workers) > 1:
+                # fork the conversion workers before vw starts, otherwise they inherit and hold open vw's pipes
+                get_conversion_pool(_workers(options.workers))
+            run_with_streamed_input(vw_cmd, vw_filename, lambda: convert_any_to_vw(**stream_conversion))
         else:
             system(vw_cmd)
 
@@ -4127,4 +7419,7 @@ if __name__ == '__main__':
     try:
         main(TO_CLEANUP)
     finally:
+        shutdown_conversion_pool()
+        remove_prebuilt_vw_caches()
+        remove_fold_stores()
         unlink(*TO_CLEANUP)